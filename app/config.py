@@ -13,6 +13,69 @@ class Settings(BaseSettings):
     access_token_expire_minutes: int
     auth_email_service_password: str
     auth_email_service_sender_address: str
-    auth_email_service_smtp_server: str    
+    auth_email_service_smtp_server: str
+    auth_email_service_smtp_port: int = 587
+    # Disable for a local SMTP stand-in without TLS, an empty password skips the login as well
+    auth_email_service_starttls: bool = True
+    # Emails are sent from an in-process outbox, requests only wait for the message to be queued
+    email_outbox_size: int = 1000
+    email_batch_size: int = 20
+    email_max_attempts: int = 5
+    email_retry_backoff_seconds: float = 2
+    email_connection_idle_seconds: float = 30
+    expose_internal_endpoints: bool = False
+    # GET /metrics has no authentication, only enable it where the port isn't reachable from the internet
+    expose_metrics_endpoint: bool = False
+    # Serves requests from an asyncpg engine and AsyncSessions instead of the thread pool
+    database_async: bool = False
+    # Per worker process, multiply by the number of workers to get the connections a deployment may open
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout_seconds: float = 30
+    database_pool_recycle_seconds: int = 1800
+    database_pool_pre_ping: bool = True
+    # Applied to every connection, 0 disables the timeout like in Postgres
+    database_statement_timeout_ms: int = 0
+    database_idle_in_transaction_timeout_ms: int = 0
+    # Read-only endpoints are served from this streaming replica when set, with the credentials and database of the primary.
+    # Clients that wrote read from the primary until the replica replayed their write, at most for this long.
+    database_replica_hostname: str | None = None
+    database_replica_pin_seconds: int = 60
+    # bcrypt cost factor, hashes with a different cost are rehashed on the next login
+    password_bcrypt_rounds: int = 12
+    # Hashing runs on its own threads, requests beyond workers + queue size are answered with 503
+    password_hash_workers: int = 2
+    password_hash_queue_size: int = 32
+    password_hash_retry_after_seconds: int = 1
+    # Decoded access tokens and users of recent requests, invalidated in-process on password changes and account deletion
+    principal_cache_size: int = 10000
+    user_cache_ttl_seconds: int = 60
+    # Board memberships of recent requests, invalidated in-process once a membership change committed
+    permission_cache_size: int = 10000
+    permission_cache_ttl_seconds: int = 60
+    # Stages and tasks whose rank grew longer than this get new, evenly spread ranks in the background
+    rank_rebalance_length: int = 16
+    # Operations accepted by one POST /boards/{id}/batch
+    batch_max_operations: int = 100
+    # Also match users whose full name contains the query, only enable where the pg_trgm index exists
+    user_search_infix: bool = False
+    # Snapshots are invalidated in-process, with several workers the TTL bounds how stale another worker can be
+    board_cache_size: int = 256
+    board_cache_ttl_seconds: int = 30
+    # Number of revisions a client can fall behind before GET /boards/{id}/changes answers with a full snapshot
+    board_changes_retention: int = 1000
+    # Tasks, stages or tombstones the reaper removes per transaction, and how often it looks for deletions left over by other workers or restarts
+    reaper_batch_size: int = 500
+    reaper_interval_seconds: float = 30
+    # Rows a POST /boards/import may hold, and the statement timeout of its COPY, 0 disables the timeout like in Postgres
+    board_import_max_rows: int = 1000000
+    board_import_statement_timeout_ms: int = 0
+    # Statements, rows and database time of every request, sent as Server-Timing header and logged by app.utils.instrumentation.
+    # A statement shape repeated this often within one request is logged as possible N+1.
+    sql_instrumentation: bool = True
+    server_timing_header: bool = True
+    sql_repeated_statement_threshold: int = 5
+    # Events buffered per WebSocket connection before the client is dropped and has to resync
+    live_queue_size: int = 64
 
 settings = Settings()
@@ -1,20 +1,246 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import IO, List
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker, DeclarativeBase
+from sqlalchemy.util import await_only
 from .config import settings
+from .utils.pool import InstrumentedAsyncQueuePool, InstrumentedAsyncReplicaQueuePool, InstrumentedQueuePool, InstrumentedReplicaQueuePool
+
+DB_CREDENTIALS = f'{settings.database_username}:{settings.database_password}@{settings.database_hostname}/{settings.database_name}'
+SQLALCHEMY_DB_URL = f'postgresql://{DB_CREDENTIALS}'
+SQLALCHEMY_ASYNC_DB_URL = f'postgresql+asyncpg://{DB_CREDENTIALS}'
+
+REPLICA_CREDENTIALS = f'{settings.database_username}:{settings.database_password}@{settings.database_replica_hostname}/{settings.database_name}'
+SQLALCHEMY_REPLICA_URL = f'postgresql://{REPLICA_CREDENTIALS}'
+SQLALCHEMY_ASYNC_REPLICA_URL = f'postgresql+asyncpg://{REPLICA_CREDENTIALS}'
+
+POOL_OPTIONS = {
+    "pool_size": settings.database_pool_size,
+    "max_overflow": settings.database_max_overflow,
+    "pool_timeout": settings.database_pool_timeout_seconds,
+    "pool_recycle": settings.database_pool_recycle_seconds,
+    "pool_pre_ping": settings.database_pool_pre_ping,
+}
+
+SERVER_SETTINGS = {
+    "statement_timeout": str(settings.database_statement_timeout_ms),
+    "idle_in_transaction_session_timeout": str(settings.database_idle_in_transaction_timeout_ms),
+}
 
-SQLALCHEMY_DB_URL = f'postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}/{settings.database_name}'
+SYNC_CONNECT_ARGS = {"options": " ".join(f"-c {name}={value}" for name, value in SERVER_SETTINGS.items())}
 
-engine = create_engine(SQLALCHEMY_DB_URL)
+engine = create_engine(SQLALCHEMY_DB_URL, poolclass=InstrumentedQueuePool, **POOL_OPTIONS, connect_args=SYNC_CONNECT_ARGS)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Only created when selected, the sync deployment doesn't need asyncpg
+if settings.database_async:
+    async_engine = create_async_engine(SQLALCHEMY_ASYNC_DB_URL, poolclass=InstrumentedAsyncQueuePool, **POOL_OPTIONS,
+                                       connect_args={"server_settings": SERVER_SETTINGS})
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False)
+
+# Sessions on the replica are marked in their info, see is_replica
+if settings.database_replica_hostname:
+    replica_engine = create_engine(SQLALCHEMY_REPLICA_URL, poolclass=InstrumentedReplicaQueuePool, **POOL_OPTIONS, connect_args=SYNC_CONNECT_ARGS)
+    ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine, info={"replica": True})
+
+    if settings.database_async:
+        async_replica_engine = create_async_engine(SQLALCHEMY_ASYNC_REPLICA_URL, poolclass=InstrumentedAsyncReplicaQueuePool, **POOL_OPTIONS,
+                                                   connect_args={"server_settings": SERVER_SETTINGS})
+        AsyncReplicaSessionLocal = async_sessionmaker(async_replica_engine, autoflush=False, info={"replica": True})
+
 class Base(DeclarativeBase):
     pass
 
 # Dependency
-def get_db():
+def get_sync_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+get_db = get_async_db if settings.database_async else get_sync_db
+
+
+# The WAL position of the primary after a write, handed to the client by ReadYourWritesMiddleware and sent back with its reads
+LSN_HEADER = "X-Primary-LSN"
+LSN_COOKIE = "primary_lsn"
+LSN_PATTERN = re.compile(r"[0-9A-F]{1,8}/[0-9A-F]{1,8}", re.IGNORECASE)
+
+CURRENT_LSN = text("SELECT pg_current_wal_lsn()::text")
+# A replica pointed at the primary itself, e.g. in development, is never behind
+REPLAYED_LSN = text("SELECT (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END)::text")
+# How often a replica that is behind is asked again, clients waiting for it read from the primary in between
+REPLAY_CHECK_INTERVAL = 0.05
+
+
+def parse_lsn(lsn: str | None) -> int | None:
+    # Written as the high and low 32 bits in hex, e.g. 16/B374D848
+    if not lsn or not LSN_PATTERN.fullmatch(lsn):
+        return None
+
+    (high, low) = lsn.split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+def current_lsn(db: Session) -> str:
+    return db.execute(CURRENT_LSN).scalar()
+
+
+# Set by ReadYourWritesMiddleware for the request it handles. run_db stores the WAL position in it once a session committed.
+written_lsn: ContextVar[dict | None] = ContextVar("written_lsn", default=None)
+
+
+@event.listens_for(Session, "after_commit")
+def mark_committed(session: Session):
+    session.info["committed"] = True
+
+
+def run_and_record_lsn(db: Session, fn, *args):
+    result = fn(db, *args)
+
+    # Read on the session that wrote, a second connection from the pool would double what a write needs.
+    # A read-only handler doesn't commit and background tasks run after the response started, neither records anything.
+    written = written_lsn.get()
+    if db.info.pop("committed", False) and not is_replica(db) and "sent" not in written:
+        written["lsn"] = current_lsn(db)
+
+    return result
+
+
+class ReplicaLag():
+    """
+    The WAL position the replica replayed, as last seen by this process. The replica is only asked
+    for a client whose write is newer than that, and at most every check_interval seconds.
+    """
+
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self.replayed = 0
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def has_replayed(self, lsn: int) -> bool | None:
+        # None if the replica has to be asked, the caller reports the answer to update
+        with self._lock:
+            if lsn <= self.replayed:
+                return True
+            if time.monotonic() - self._checked_at < self.check_interval:
+                return False
+
+            self._checked_at = time.monotonic()
+            return None
+
+    def update(self, replayed: int | None) -> int:
+        with self._lock:
+            self.replayed = max(self.replayed, replayed or 0)
+            return self.replayed
+
+
+replica_lag = ReplicaLag(check_interval=REPLAY_CHECK_INTERVAL)
+
+
+def read_after_lsn(request: Request) -> int | None:
+    return parse_lsn(request.headers.get(LSN_HEADER) or request.cookies.get(LSN_COOKIE))
+
+
+def is_replica(db: Session | AsyncSession) -> bool:
+    return db.info.get("replica", False)
+
+
+def get_sync_read_db(request: Request):
+    lsn = read_after_lsn(request)
+    db = ReplicaSessionLocal()
+    try:
+        if lsn and not replica_has_replayed(db, lsn):
+            db.close()
+            db = SessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+def replica_has_replayed(db: Session, lsn: int) -> bool:
+    has_replayed = replica_lag.has_replayed(lsn)
+    if has_replayed is None:
+        has_replayed = replica_lag.update(parse_lsn(db.execute(REPLAYED_LSN).scalar())) >= lsn
+    return has_replayed
+
+
+async def get_async_read_db(request: Request):
+    lsn = read_after_lsn(request)
+    db = AsyncReplicaSessionLocal()
+    try:
+        if lsn and not await db.run_sync(replica_has_replayed, lsn):
+            await db.close()
+            db = AsyncSessionLocal()
+        yield db
+    finally:
+        await db.close()
+
+
+# For read-only endpoints. Clients read from the replica unless they wrote something the replica hasn't replayed yet.
+# Reads that fill one of the in-process caches have to check is_replica, a cache is shared by all clients.
+if not settings.database_replica_hostname:
+    get_read_db = get_db
+elif settings.database_async:
+    get_read_db = get_async_read_db
+else:
+    get_read_db = get_sync_read_db
+
+
+async def run_db(db: Session | AsyncSession, fn, *args):
+    """
+    Runs fn(session, *args) with a sync Session, so the routers are written once for both database modes.
+    The async session runs it on the event loop, the sync session on Starlette's thread pool.
+    Relationships are configured to raise instead of lazy loading, fn has to load and serialize
+    everything the response needs before it returns.
+    """
+    if written_lsn.get() is not None:
+        (fn, args) = (run_and_record_lsn, (fn, *args))
+
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args)
+
+    return await run_in_threadpool(fn, db, *args)
+
+
+async def run_in_session(fn, *args):
+    # For callers outside of a request, e.g. WebSocket handlers that must not hold a connection for their lifetime
+    if settings.database_async:
+        async with AsyncSessionLocal() as db:
+            return await run_db(db, fn, *args)
+
+    with SessionLocal() as db:
+        return await run_db(db, fn, *args)
+
+
+def copy_rows(db: Session, table: str, columns: List[str], source: IO[bytes]):
+    """
+    Loads the rows of source, in the text format of COPY, into table with COPY FROM STDIN within the transaction of the session.
+    COPY isn't part of the DB-API, psycopg2 and asyncpg each have their own call for it. The transaction
+    has to be started by a statement before, asyncpg would run the COPY on its own otherwise.
+    """
+    connection = db.connection()
+    dbapi_connection = connection.connection
+
+    if connection.dialect.driver == "asyncpg":
+        await_only(dbapi_connection.driver_connection.copy_to_table(table, source=source, columns=columns))
+        return
+
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", source)
@@ -1,35 +1,220 @@
+import heapq
+import logging
+import queue
 import smtplib
+import threading
+import time
+from dataclasses import dataclass, field
 
 from pydantic import EmailStr
 from .config import settings
 
 
-class Auth_email_service():
-    sender_address = settings.auth_email_service_sender_address
-    app_password = settings.auth_email_service_password
+logger = logging.getLogger(__name__)
+
+
+@dataclass(order=True)
+class OutgoingEmail:
+    not_before: float
+    recipient: str = field(compare=False)
+    subject: str = field(compare=False)
+    message: str = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+class Email_outbox():
+    """
+    Queue of outgoing emails, sent by one background thread so no request ever waits for SMTP.
+
+    The worker keeps its authenticated connection open while there is mail to send and closes it
+    once it has been idle for a while. Queued messages are sent in batches over that connection.
+    A failed message is retried with exponential backoff, after the last attempt it is logged and dropped.
+    The outbox lives in memory, messages still queued when the process is killed are lost.
+    """
+
+    def __init__(self, sender_address: str, password: str, host: str, port: int, use_starttls: bool,
+                 maxsize: int, batch_size: int, max_attempts: int, backoff: float, idle_timeout: float):
+        self.sender_address = sender_address
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_starttls = use_starttls
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.sent = 0
+        self.failed = 0
+
+        self._queue: queue.Queue[OutgoingEmail | None] = queue.Queue(maxsize=maxsize)
+        # Messages waiting for their next attempt, ordered by not_before. Only touched by the worker.
+        self._retries: list[OutgoingEmail] = []
+        self._connection: smtplib.SMTP | None = None
+        self._worker: threading.Thread | None = None
+        # Set by stop, a new one is created with every worker
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def enqueue(self, recipient: EmailStr, subject: str, message: str) -> bool:
+        # Returns False if the outbox is full, the caller decides how to tell the client
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(OutgoingEmail(not_before=time.monotonic(), recipient=recipient, subject=subject, message=message))
+            return True
+        except queue.Full:
+            return False
+
+    def stop(self, timeout: float | None = None):
+        # Sends what is already queued, retries that aren't due yet are given up.
+        # Returns after at most timeout seconds, the worker is a daemon thread and mail it hasn't sent by then is lost.
+        with self._lock:
+            worker = self._worker
+            stopping = self._stopping
+            self._worker = None
+
+        if not worker:
+            return
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stopping.set()
+        try:
+            # Wakes a worker waiting for mail. A full queue keeps the worker busy, it stops once it emptied the queue.
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "retrying": len(self._retries), "sent": self.sent, "failed": self.failed}
+
+    def _ensure_worker(self):
+        with self._lock:
+            # A worker that died of an error nobody expected is replaced
+            if not self._worker or not self._worker.is_alive():
+                self._stopping = threading.Event()
+                self._worker = threading.Thread(target=self._run, args=(self._stopping,), name="email-outbox", daemon=True)
+                self._worker.start()
+
+    def _run(self, stopping: threading.Event):
+        while True:
+            try:
+                email = self._queue.get(timeout=self._next_timeout(stopping))
+            except queue.Empty:
+                email = None
+                if stopping.is_set():
+                    break
+                if not self._retries:
+                    self._disconnect()
+            else:
+                if email is None:
+                    break
+
+            batch = [email] if email else []
+            while len(batch) < self.batch_size and self._retries and self._retries[0].not_before <= time.monotonic():
+                batch.append(heapq.heappop(self._retries))
+            while len(batch) < self.batch_size:
+                try:
+                    email = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if email is None:
+                    self._send_batch(batch)
+                    self._disconnect()
+                    return
+                batch.append(email)
+
+            self._send_batch(batch)
 
+        self._disconnect()
+
+    def _next_timeout(self, stopping: threading.Event):
+        if stopping.is_set():
+            # stop couldn't queue its None, the queue is drained without waiting for retries
+            return 0
+        if self._retries:
+            return max(self._retries[0].not_before - time.monotonic(), 0)
+        return self.idle_timeout if self._connection else None
+
+    def _send_batch(self, batch: list[OutgoingEmail]):
+        for email in batch:
+            try:
+                self._send(email)
+                self.sent += 1
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+                # Permanent for this message, retrying won't help
+                self.failed += 1
+                logger.error("Dropping email to %s: %s", email.recipient, e)
+            except (smtplib.SMTPException, OSError) as e:
+                # The connection may be unusable after any other error, the next attempt opens a new one
+                self._disconnect()
+                self._retry(email, e)
+            except Exception:
+                # E.g. an address smtplib can't encode. Retrying won't help and the worker has to keep going for the other messages.
+                self.failed += 1
+                self._disconnect()
+                logger.exception("Dropping email to %s", email.recipient)
+
+    def _send(self, email: OutgoingEmail):
+        if not self._connection:
+            self._connection = self._connect()
+
+        self._connection.sendmail(from_addr=self.sender_address,
+                                  to_addrs=email.recipient,
+                                  msg=f"Subject:{email.subject}\n\n{email.message}")
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            if self.use_starttls:
+                connection.starttls()
+            if self.password:
+                connection.login(user=self.sender_address, password=self.password)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def _disconnect(self):
+        if not self._connection:
+            return
+
+        try:
+            self._connection.quit()
+        except (smtplib.SMTPException, OSError):
+            self._connection.close()
+        self._connection = None
+
+    def _retry(self, email: OutgoingEmail, error: Exception):
+        email.attempts += 1
+
+        if email.attempts >= self.max_attempts:
+            self.failed += 1
+            logger.error("Giving up on email to %s after %s attempts: %s", email.recipient, email.attempts, error)
+            return
+
+        email.not_before = time.monotonic() + self.backoff * 2 ** (email.attempts - 1)
+        heapq.heappush(self._retries, email)
+        logger.warning("Email to %s failed, attempt %s of %s: %s", email.recipient, email.attempts, self.max_attempts, error)
+
+
+class Auth_email_service():
     _instance = None
 
-    def __new__(cls):
+    def __new__(cls, outbox: Email_outbox):
         if cls._instance:
             raise ValueError(
                 "The auth_email_service singleton was already instantiated")
         cls._instance = super().__new__(cls)
         return cls._instance
-    
-    async def password_forgotten(self, recipient: EmailStr, reset_link):
-        message = message_generator.password_forgotten(link=reset_link)
 
-        return self.__send_email(recipient=recipient, subject="Reset your password", message=message)
+    def __init__(self, outbox: Email_outbox):
+        self.outbox = outbox
+
+    def password_forgotten(self, recipient: EmailStr, reset_link) -> bool:
+        # Only queues the message, True if the outbox accepted it
+        message = message_generator.password_forgotten(link=reset_link)
 
-    def __send_email(self, recipient: EmailStr, subject: str, message: str):
-        with smtplib.SMTP(settings.auth_email_service_smtp_server, 587) as connection:
-            connection.starttls()
-            connection.login(user=self.sender_address, password=self.app_password)
-            result = connection.sendmail(from_addr=self.sender_address,
-                                to_addrs=recipient, 
-                                msg=f"Subject:{subject}\n\n{message}")
-            return result
+        return self.outbox.enqueue(recipient=recipient, subject="Reset your password", message=message)
 
 class Message_generator():
     def password_forgotten(self, link: str):
@@ -54,4 +239,14 @@ class Message_generator():
 """
 
 message_generator = Message_generator()
-auth_email_service = Auth_email_service()
+email_outbox = Email_outbox(sender_address=settings.auth_email_service_sender_address,
+                            password=settings.auth_email_service_password,
+                            host=settings.auth_email_service_smtp_server,
+                            port=settings.auth_email_service_smtp_port,
+                            use_starttls=settings.auth_email_service_starttls,
+                            maxsize=settings.email_outbox_size,
+                            batch_size=settings.email_batch_size,
+                            max_attempts=settings.email_max_attempts,
+                            backoff=settings.email_retry_backoff_seconds,
+                            idle_timeout=settings.email_connection_idle_seconds)
+auth_email_service = Auth_email_service(email_outbox)
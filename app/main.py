@@ -1,6 +1,14 @@
+import os
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .router import users, auth, boards, stages, tasks, subtasks
+from .config import settings
+from .email_service import email_outbox
+from .utils.instrumentation import SQLInstrumentationMiddleware, instrument_engines
+from .utils.prometheus import PrometheusMiddleware, mark_process_dead
+from .utils.reaper import reaper
+from .utils.replica import ReadYourWritesMiddleware
+from .router import users, auth, boards, batch, deletions, search, stages, tasks, subtasks, transfer, internal, metrics
 
 
 app = FastAPI()
@@ -13,14 +21,55 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=['*'],
     allow_headers=['*'],
+    expose_headers=['X-Next-Cursor', 'Location', 'Server-Timing', 'X-Primary-LSN'],
 )
 
+if settings.database_replica_hostname:
+    app.add_middleware(ReadYourWritesMiddleware)
+
+if settings.sql_instrumentation:
+    instrument_engines()
+    app.add_middleware(SQLInstrumentationMiddleware)
+
+# Outermost, so the request duration includes the other middlewares
+app.add_middleware(PrometheusMiddleware)
+
 app.include_router(users.router)
 app.include_router(auth.router)
 app.include_router(boards.router)
+app.include_router(batch.router)
+app.include_router(search.router)
+app.include_router(transfer.router)
 app.include_router(stages.router)
 app.include_router(tasks.router)
 app.include_router(subtasks.router)
+app.include_router(deletions.router)
+
+if settings.expose_internal_endpoints:
+    app.include_router(internal.router)
+
+if settings.expose_metrics_endpoint:
+    app.include_router(metrics.router)
+
+
+@app.on_event("startup")
+async def start_reaper():
+    reaper.start()
+
+
+@app.on_event("shutdown")
+def flush_email_outbox():
+    email_outbox.stop(timeout=10)
+
+
+@app.on_event("shutdown")
+async def stop_reaper():
+    await reaper.stop()
+
+
+@app.on_event("shutdown")
+def remove_metrics_of_worker():
+    mark_process_dead(os.getpid())
 
 
 @app.get("/")
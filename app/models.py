@@ -1,6 +1,7 @@
 from typing import List
 import uuid
-from sqlalchemy import TIMESTAMP, Column, ForeignKey, Table, asc, text, UUID
+from sqlalchemy import TIMESTAMP, Column, Computed, ForeignKey, ForeignKeyConstraint, Index, String, Table, UniqueConstraint, asc, func, text, UUID
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from .database import Base
 
@@ -9,9 +10,13 @@ boards_users = Table(
     Base.metadata,
     Column("board_id", ForeignKey("boards.id"), primary_key=True),
     Column("user_id", ForeignKey("users.id"), primary_key=True),
+    # The primary key starts with board_id, "boards I contribute to" needs its own index
+    Index("ix_boards_users_user_id_board_id", "user_id", "board_id"),
 )
 
 
+# Relationships raise instead of lazy loading, they have to be loaded explicitly (see app/utils/loaders.py).
+# A lazy load would block the event loop or fail outside of the greenlet of an AsyncSession.
 class User(Base):
     __tablename__ = "users"
 
@@ -22,28 +27,43 @@ class User(Base):
     email: Mapped[str] = mapped_column(nullable=False, unique=True)
     is_email_verified: Mapped[bool] = mapped_column(nullable=False, server_default='False')
     password: Mapped[str] = mapped_column(nullable=False)
+    # Set when the account is deleted, the row is removed later by the reaper (see app/utils/reaper.py)
+    deleted_at: Mapped[str] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
+    # Access tokens issued before are revoked, set when the password changes (see app/oauth2.py)
+    tokens_valid_after: Mapped[str] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
 
-    own_boards: Mapped[List["Board"]] = relationship(back_populates="owner", order_by='asc(Board.created_at)')
-    boards_contributing: Mapped[List["Board"]] = relationship(secondary=boards_users, back_populates="contributors")
-    assigned_tasks: Mapped[List['Task']] = relationship(back_populates='assigned_user', order_by='asc(Task.created_at)')
+    own_boards: Mapped[List["Board"]] = relationship(back_populates="owner", order_by='asc(Board.created_at)', lazy='raise_on_sql')
+    boards_contributing: Mapped[List["Board"]] = relationship(secondary=boards_users, back_populates="contributors", lazy='raise_on_sql')
+    assigned_tasks: Mapped[List['Task']] = relationship(back_populates='assigned_user', order_by='asc(Task.created_at)', lazy='raise_on_sql')
 
     def __repr__(self) -> str:
         return f"<User username={self.first_name} {self.last_name}>"
 
 
+# Used by the user search, LIKE 'query%' on the lowered names and = on the lowered email
+Index("ix_users_lower_first_name", func.lower(User.first_name).label("lower_first_name"), postgresql_ops={"lower_first_name": "text_pattern_ops"})
+Index("ix_users_lower_last_name", func.lower(User.last_name).label("lower_last_name"), postgresql_ops={"lower_last_name": "text_pattern_ops"})
+Index("ix_users_lower_email", func.lower(User.email))
+
+
 class Board(Base):
     __tablename__ = "boards"
+    __table_args__ = (Index("ix_boards_owner_id_created_at", "owner_id", "created_at"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     title: Mapped[str] = mapped_column(nullable=False)
     created_at: Mapped[str] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    # Bumped once per transaction that changes the board, see app/utils/changes.py
+    revision: Mapped[int] = mapped_column(nullable=False, server_default='0')
+    # Set when the board is deleted, it is hidden from then on and removed later by the reaper (see app/utils/reaper.py)
+    deleted_at: Mapped[str] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
     
     owner_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
 
-    owner: Mapped["User"] = relationship(back_populates="own_boards")
-    contributors: Mapped[List["User"]] = relationship(secondary=boards_users, back_populates="boards_contributing")
+    owner: Mapped["User"] = relationship(back_populates="own_boards", lazy='raise_on_sql')
+    contributors: Mapped[List["User"]] = relationship(secondary=boards_users, back_populates="boards_contributing", lazy='raise_on_sql')
     
-    stages: Mapped[List["Stage"]] = relationship(order_by='asc(Stage.index)')
+    stages: Mapped[List["Stage"]] = relationship(order_by='[Stage.rank, Stage.id]', lazy='raise_on_sql')
 
     def __repr__(self) -> str:
         return f"<Board title={self.title} created by {self.owner.first_name} {self.owner.last_name}>"
@@ -51,6 +71,11 @@ class Board(Base):
 
 class Stage(Base):
     __tablename__ = "stages"
+    __table_args__ = (
+        Index("ix_stages_board_id_rank", "board_id", "rank"),
+        # Referenced by the tasks together with the board, see Task
+        UniqueConstraint("board_id", "id", name="uq_stages_board_id_id"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     created_at: Mapped[str] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
@@ -58,26 +83,52 @@ class Stage(Base):
     index: Mapped[int] = mapped_column(nullable=False)
     color: Mapped[str] = mapped_column(nullable=False)
     board_id: Mapped[str] = mapped_column(ForeignKey("boards.id", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
+    revision: Mapped[int] = mapped_column(nullable=False, server_default='0')
+    # Position on the board, see app/utils/ranks.py. index is only kept for clients that still send it.
+    rank: Mapped[str] = mapped_column(String(collation="C"), nullable=False)
 
-    tasks: Mapped[List["Task"]] = relationship(back_populates="status")
+    tasks: Mapped[List["Task"]] = relationship(back_populates="status", primaryjoin='Stage.id == foreign(Task.stage_id)',
+                                               order_by='[Task.rank, Task.id]', lazy='raise_on_sql')
 
     def __repr__(self) -> str:
         return f"<Stage title={self.title} of board {self.board_id}>"
 
 
+# Tasks and subtasks carry the id of their board, so they are authorized and loaded per board without a join.
+# The foreign keys include the board, the database keeps it consistent and cascades it when a stage changes its board.
+# Every reference to a task already contains board_id, the tables can be hash partitioned by it with (board_id, id)
+# as primary key. The relationships join on the ids alone, that's enough to load them.
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        ForeignKeyConstraint(["board_id", "stage_id"], ["stages.board_id", "stages.id"], name="fk_tasks_board_id_stage_id",
+                             ondelete="CASCADE", onupdate="CASCADE"),
+        UniqueConstraint("board_id", "id", name="uq_tasks_board_id_id"),
+        Index("ix_tasks_board_id_revision", "board_id", "revision"),
+        # The order tasks are paged through in, see GET /stages/{id}/tasks
+        Index("ix_tasks_stage_id_rank_id", "stage_id", "rank", "id"),
+        # Only assigned tasks are ever looked up by their assignee
+        Index("ix_tasks_assigned_user_id", "assigned_user_id", postgresql_where=text("assigned_user_id IS NOT NULL")),
+        Index("ix_tasks_search_vector", "search_vector", postgresql_using="gin"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    stage_id: Mapped[str] = mapped_column(ForeignKey("stages.id", ondelete="CASCADE"), nullable=False)
+    board_id = Column(UUID(as_uuid=True), nullable=False)
+    stage_id = Column(UUID(as_uuid=True), nullable=False)
     created_at: Mapped[str] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
     title: Mapped[str] = mapped_column(nullable=False)
     description: Mapped[str] = mapped_column(nullable=False)
     assigned_user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=True)
-    assigned_user: Mapped["User"] = relationship()
+    revision: Mapped[int] = mapped_column(nullable=False, server_default='0')
+    # Position in its stage, see app/utils/ranks.py
+    rank: Mapped[str] = mapped_column(String(collation="C"), nullable=False)
+    # Full-text search of GET /boards/{id}/search, a title match weighs more than a description match
+    search_vector = mapped_column(TSVECTOR, Computed("setweight(to_tsvector('simple', title), 'A') || "
+                                                     "setweight(to_tsvector('simple', description), 'B')", persisted=True), deferred=True)
+    assigned_user: Mapped["User"] = relationship(back_populates="assigned_tasks", lazy='raise_on_sql')
 
-    status: Mapped["Stage"] = relationship()
-    subtasks: Mapped[List["Subtask"]] = relationship(order_by='asc(Subtask.index)')
+    status: Mapped["Stage"] = relationship(back_populates="tasks", primaryjoin='foreign(Task.stage_id) == Stage.id', lazy='raise_on_sql')
+    subtasks: Mapped[List["Subtask"]] = relationship(primaryjoin='Task.id == foreign(Subtask.task_id)', order_by='asc(Subtask.index)', lazy='raise_on_sql')
 
     def __repr__(self) -> str:
         return f"<Task title={self.title} in stage {self.stage_id}>"
@@ -86,12 +137,58 @@ class Task(Base):
 
 class Subtask(Base):
     __tablename__ = "subtasks"
+    __table_args__ = (
+        ForeignKeyConstraint(["board_id", "task_id"], ["tasks.board_id", "tasks.id"], name="fk_subtasks_board_id_task_id",
+                             ondelete="CASCADE", onupdate="CASCADE"),
+        Index("ix_subtasks_board_id_revision", "board_id", "revision"),
+        Index("ix_subtasks_task_id_index", "task_id", "index"),
+        Index("ix_subtasks_search_vector", "search_vector", postgresql_using="gin"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    task_id: Mapped[str] = mapped_column(ForeignKey("tasks.id", ondelete="CASCADE"), nullable=False)
+    board_id = Column(UUID(as_uuid=True), nullable=False)
+    task_id = Column(UUID(as_uuid=True), nullable=False)
     title: Mapped[str] = mapped_column(nullable=False)
     index: Mapped[int] = mapped_column(nullable=False)
     is_completed: Mapped[bool] = mapped_column(nullable=False)
+    revision: Mapped[int] = mapped_column(nullable=False, server_default='0')
+    # A generated column can't read other tables, subtask titles are searched here and ranked with their task
+    search_vector = mapped_column(TSVECTOR, Computed("setweight(to_tsvector('simple', title), 'C')", persisted=True), deferred=True)
 
     def __repr__(self) -> str:
         return f"<Subtask title={self.title} status {self.is_completed}>"
+
+
+# Deleted stages, tasks and subtasks, so clients can sync deletions through GET /boards/{id}/changes.
+# Deleting a stage or a task implicitly deletes its children, those don't get a tombstone of their own.
+class Tombstone(Base):
+    __tablename__ = "tombstones"
+    __table_args__ = (Index("ix_tombstones_board_id_revision", "board_id", "revision"),)
+
+    id = Column(UUID(as_uuid=True), primary_key=True)
+    board_id: Mapped[str] = mapped_column(ForeignKey("boards.id", ondelete="CASCADE"), nullable=False)
+    entity: Mapped[str] = mapped_column(nullable=False)
+    revision: Mapped[int] = mapped_column(nullable=False)
+
+    def __repr__(self) -> str:
+        return f"<Tombstone {self.entity} {self.id} of board {self.board_id}>"
+
+
+# Deletions of boards and accounts that were requested but may not be done yet, the status resource of DELETE /boards/{id}
+# and DELETE /users/. There is no foreign key to the deleted row, this row outlives it.
+class Deletion(Base):
+    __tablename__ = "deletions"
+    __table_args__ = (Index("ix_deletions_pending_created_at", "created_at", postgresql_where=text("status = 'pending'")),)
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    entity: Mapped[str] = mapped_column(nullable=False)
+    target_id = Column(UUID(as_uuid=True), nullable=False)
+    requested_by = Column(UUID(as_uuid=True), nullable=False)
+    status: Mapped[str] = mapped_column(nullable=False, server_default='pending')
+    # Batches the reaper has removed so far
+    batches: Mapped[int] = mapped_column(nullable=False, server_default='0')
+    created_at: Mapped[str] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    completed_at: Mapped[str] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
+
+    def __repr__(self) -> str:
+        return f"<Deletion of {self.entity} {self.target_id} {self.status}>"
@@ -1,13 +1,19 @@
+import hashlib
+import math
+import time
 from typing_extensions import Annotated
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status
 from app.utils.fastapi import OAuth2PasswordBearerWithCookie
-from sqlalchemy.orm import Session
-from jose import JWTError, jwt
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import Session, make_transient_to_detached
+from jose import ExpiredSignatureError, JWTError, jwt
 from app.config import settings
-from app.database import get_db
+from app.database import get_db, run_db, run_in_session
 from app.models import User
-from app.schemas import TokenData
+from app.schemas import Principal, TokenData
+from app.utils.cache import LRUCache
+from app.utils.prometheus import JWT_DECODE_FAILURES
 
 
 oauth2_scheme = OAuth2PasswordBearerWithCookie(tokenUrl="login")
@@ -17,6 +23,14 @@ SECRET_KEY = settings.secret_key
 ALGORITHM = settings.algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
+# Keyed by the digest of the token, so the cache never holds usable tokens. Entries expire with the token.
+token_cache = LRUCache(name="tokens", maxsize=settings.principal_cache_size)
+# Column values of users without their password hash, keyed by user id
+user_cache = LRUCache(name="users", maxsize=settings.principal_cache_size)
+# Tokens issued before this timestamp are revoked, keyed by user id. Infinite for deleted and unknown users.
+# Revocations of this process take effect right away, other workers read them from the database after at most user_cache_ttl_seconds.
+revocation_cache = LRUCache(name="revocations", maxsize=settings.principal_cache_size)
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
 
@@ -25,12 +39,19 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
-    to_encode.update({ "exp": expire })
+    # A float, a token issued right after a revocation in the same second has to stay valid
+    to_encode.update({ "exp": expire, "iat": time.time() })
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
 def verify_access_token(token: str):
+    token_digest = hashlib.sha256(token.encode()).hexdigest()
+    token_data = token_cache.get(token_digest)
+
+    if token_data:
+        return token_data
+
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                                           detail="Could not validate token", 
                                           headers={"WWW-Authenticate": "Bearer"})
@@ -39,17 +60,94 @@ def verify_access_token(token: str):
         user_id: str = payload.get("user_id")
 
         if user_id is None:
+            JWT_DECODE_FAILURES.labels("missing_user_id").inc()
             raise credentials_exception
         
-        token_data = TokenData(user_id=user_id)
+        token_data = TokenData(user_id=user_id, issued_at=payload.get("iat", 0))
+    except ExpiredSignatureError:
+        JWT_DECODE_FAILURES.labels("expired").inc()
+        raise credentials_exception
     except JWTError:
+        JWT_DECODE_FAILURES.labels("invalid").inc()
         raise credentials_exception
+
+    if payload.get("exp"):
+        token_cache.put(token_digest, token_data, expires_at=payload["exp"])
     
     return token_data
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
-    token = verify_access_token(token)
-    user = db.query(User).filter(User.id == token.user_id).first()
+async def authenticate(token: str):
+    # Verifies the token and that it wasn't revoked by a password change or the deletion of the account
+    token_data = verify_access_token(token)
+    tokens_valid_after = revocation_cache.get(token_data.user_id)
+
+    if tokens_valid_after is None:
+        tokens_valid_after = await run_in_session(get_tokens_valid_after, token_data.user_id)
+        revocation_cache.put(token_data.user_id, tokens_valid_after, expires_at=time.time() + settings.user_cache_ttl_seconds)
+
+    if token_data.issued_at < tokens_valid_after:
+        JWT_DECODE_FAILURES.labels("revoked").inc()
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Could not validate token",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+    return token_data
+
+
+async def get_current_principal(token: Annotated[str, Depends(oauth2_scheme)]):
+    # For handlers that only need the id of the user, only reads the database when the user isn't in the revocation cache
+    return Principal(id=(await authenticate(token)).user_id)
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
+    token = await authenticate(token)
+
+    return await run_db(db, get_cached_user, token.user_id)
+
+
+def get_cached_user(db: Session, user_id: str):
+    user_data = user_cache.get(user_id)
+
+    if not user_data:
+        user = get_user_by_id(db, user_id)
+        if user:
+            user_cache.put(user_id, {column.key: getattr(user, column.key) for column in inspect(User).column_attrs if column.key != 'password'},
+                           expires_at=time.time() + settings.user_cache_ttl_seconds)
+        return user
+
+    # Attached to the session without a query, the password hash is loaded on access
+    user = User(**user_data)
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+
+def invalidate_principal(user_id: str, tokens_valid_after: float):
+    # Call once the revocation committed, pass math.inf for a deleted account
+    revocation_cache.put(str(user_id), tokens_valid_after, expires_at=time.time() + settings.user_cache_ttl_seconds)
+    user_cache.pop(str(user_id))
+    token_cache.pop_where(lambda token_digest, token_data: token_data.user_id == str(user_id))
+
+
+def remember_tokens_valid_after(user: User):
+    # For a user that was just read or created anyway, the first request with its new token doesn't have to read it again
+    revocation_cache.put(str(user.id), tokens_valid_after_of(user.deleted_at, user.tokens_valid_after),
+                         expires_at=time.time() + settings.user_cache_ttl_seconds)
+
+
+def get_tokens_valid_after(db: Session, user_id: str) -> float:
+    row = db.execute(select(User.deleted_at, User.tokens_valid_after).where(User.id == user_id)).first()
+
+    return tokens_valid_after_of(row.deleted_at, row.tokens_valid_after) if row else math.inf
+
+
+def tokens_valid_after_of(deleted_at: datetime | None, tokens_valid_after: datetime | None) -> float:
+    if deleted_at:
+        return math.inf
+
+    return tokens_valid_after.timestamp() if tokens_valid_after else 0
+
 
-    return user
\ No newline at end of file
+def get_user_by_id(db: Session, user_id: str):
+    # Deleted accounts can't sign in anymore, even before the reaper removed them
+    return db.query(User).filter(User.id == user_id, User.deleted_at.is_(None)).first()
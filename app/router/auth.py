@@ -1,15 +1,16 @@
-from datetime import timedelta
+import time
+from datetime import datetime, timedelta, timezone
 from typing_extensions import Annotated
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import UUID4
 from sqlalchemy.orm import Session
 from fastapi import APIRouter, Depends, HTTPException, Response, status
 
-from app.database import get_db
+from app.database import get_db, run_db
 from app.models import User
-from app.oauth2 import create_access_token, verify_access_token
+from app.oauth2 import authenticate, create_access_token, get_user_by_id, invalidate_principal, remember_tokens_valid_after
 from app.schemas import NewUserPassword, UserPasswordResetRequest, UserInfoReturn
-from app.utils.helpers import verify, hash
+from app.utils.passwords import hash_password, verify_password
 from app.email_service import auth_email_service
 
 import os
@@ -24,20 +25,28 @@ router = APIRouter(tags=["Authentication"])
 
 
 @router.post("/login", status_code=status.HTTP_200_OK, response_model=UserInfoReturn)
-def login(user_credentials: Annotated[OAuth2PasswordRequestForm, Depends()], response: Response,
-          db: Session = Depends(get_db)):
+async def login(user_credentials: Annotated[OAuth2PasswordRequestForm, Depends()], response: Response,
+                db: Session = Depends(get_db)):
 
-    user = db.query(User).filter(
-        User.email == user_credentials.username).first()
+    user = await run_db(db, get_user_by_email, user_credentials.username)
 
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Incorrect e-mail")
 
-    if not verify(user_credentials.password, user.password):
+    (is_valid, new_hash) = await verify_password(user_credentials.password, user.password)
+
+    if not is_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Wrong password")
 
+    # Before the rehash below commits and expires the user
+    remember_tokens_valid_after(user)
+
+    # The hash was made with another cost factor, the plain password is only available right now
+    if new_hash:
+        await run_db(db, update_user_password, user.id, new_hash)
+
     access_token = create_access_token({"user_id": str(user.id)})
 
     response.set_cookie(
@@ -47,7 +56,7 @@ def login(user_credentials: Annotated[OAuth2PasswordRequestForm, Depends()], res
 
 
 @router.post("/logout", status_code=status.HTTP_200_OK)
-def logout(response: Response):
+async def logout(response: Response):
     response.delete_cookie("access_token", httponly=True, secure=True, samesite='none')
 
     return {"message": "Logout successful"}
@@ -56,7 +65,7 @@ def logout(response: Response):
 @router.post("/password/request-reset")
 async def send_password_reset_email(client_data: UserPasswordResetRequest, db: Session = Depends(get_db)):
 
-    user = db.query(User).filter(User.email == client_data.email).first()
+    user = await run_db(db, get_user_by_email, client_data.email)
 
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -64,36 +73,50 @@ async def send_password_reset_email(client_data: UserPasswordResetRequest, db: S
 
     reset_link = generate_reset_link(user.id)
 
-    result = await auth_email_service.password_forgotten(recipient=client_data.email, reset_link=reset_link)
-    has_errors = len(result) > 0
+    is_queued = auth_email_service.password_forgotten(recipient=client_data.email, reset_link=reset_link)
 
-    if has_errors:
+    if not is_queued:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                             detail=f"Could not send email. Please try again later.")
 
 
 @router.post('/password/new', status_code=status.HTTP_201_CREATED)
-def update_password(client_data: NewUserPassword, response: Response, db: Session = Depends(get_db)):
-    token_data = verify_access_token(client_data.access_token)
+async def update_password(client_data: NewUserPassword, response: Response, db: Session = Depends(get_db)):
+    # A reset token is revoked by the password change it was used for, it only works once
+    token_data = await authenticate(client_data.access_token)
 
-    user_query = db.query(User).filter(User.id == token_data.user_id)
-    user = user_query.first()
+    user = await run_db(db, get_user_by_id, token_data.user_id)
 
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    new_password = hash(client_data.password)
-    user_query.update({'password': new_password})
+    new_password = await hash_password(client_data.password)
+    # Every token issued until now is revoked, the one created below is issued after it
+    tokens_valid_after = time.time()
+    await run_db(db, update_user_password, user.id, new_password, tokens_valid_after)
+    invalidate_principal(token_data.user_id, tokens_valid_after)
 
-    db.commit()
-
-    access_token = create_access_token({"user_id": str(user.id)})
+    access_token = create_access_token({"user_id": str(token_data.user_id)})
 
     response.set_cookie(
         key="access_token", value=f"Bearer {access_token}", httponly=True, secure=True, samesite='none')
 
 
+def get_user_by_email(db: Session, email: str):
+    return db.query(User).filter(User.email == email, User.deleted_at.is_(None)).first()
+
+
+def update_user_password(db: Session, user_id: UUID4, password: str, tokens_valid_after: float | None = None):
+    # Rehashing the same password leaves the tokens valid, a new password revokes them
+    values = {'password': password}
+    if tokens_valid_after is not None:
+        values['tokens_valid_after'] = datetime.fromtimestamp(tokens_valid_after, timezone.utc)
+
+    db.query(User).filter(User.id == user_id).update(values)
+    db.commit()
+
+
 def generate_reset_link(id: UUID4):
     pwd_reset_token = create_access_token(
         data={'user_id': str(id)}, expires_delta=timedelta(minutes=5))
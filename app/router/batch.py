@@ -0,0 +1,199 @@
+from typing import Dict, List
+
+from pydantic import UUID4
+from sqlalchemy import UUID, Boolean, String, case, cast, column, delete, func, select, update, values
+from sqlalchemy.orm import Session, selectinload
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
+
+from app.config import settings
+from app.database import get_db, run_db
+from app.models import Stage, Subtask, Task
+from app.oauth2 import get_current_principal
+from app.schemas import BatchOperationResult, BoardBatch, BoardBatchReturn, Principal
+from app.utils.changes import bump_board_revision, record_tombstones
+from app.utils.live import record_change
+from app.utils.ranks import rank_for_position, rebalance_stages, rebalance_tasks, rebalancer
+from app.utils.validation import authorize_board, check_assignee
+
+
+router = APIRouter(prefix="/boards", tags=["Boards"])
+
+
+@router.post("/{id}/batch", response_model=BoardBatchReturn)
+async def apply_batch(id: UUID4, client_data: BoardBatch, background_tasks: BackgroundTasks,
+                      db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    result = await run_db(db, apply_batch_sync, id, client_data, current_user)
+
+    for task in result.tasks:
+        rebalancer.schedule(background_tasks, task.rank, rebalance_tasks, task.stage_id)
+    for stage in result.stages:
+        rebalancer.schedule(background_tasks, stage.rank, rebalance_stages, id)
+
+    return result
+
+
+def apply_batch_sync(db: Session, board_id: UUID4, client_data: BoardBatch, current_user: Principal):
+    """
+    Applies the operations in their order within one transaction, either all of them or none.
+    Moves need the ranks written by the moves before them and run one by one. Edits, assignments and
+    toggles only leave their final value per row, those are written with one statement per entity at the end.
+    """
+    operations = client_data.operations
+
+    if len(operations) > settings.batch_max_operations:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"A batch can hold at most {settings.batch_max_operations} operations")
+
+    authorize_board(board_id, current_user.id, db)
+
+    # Locks the board, every row written by this batch is stamped with the same revision.
+    # The rows are read after the lock, a concurrent batch can't toggle a subtask or move a task in between.
+    revision = bump_board_revision(db, board_id)
+
+    (task_stages, stage_ids, subtasks) = load_batch_rows(operations, board_id, db)
+    for user_id in {op.assigned_user_id for op in operations if op.op == 'assign_task' and op.assigned_user_id}:
+        check_assignee(board_id, user_id, db)
+
+    task_edits: Dict[UUID4, dict] = {}
+    stage_edits: Dict[UUID4, dict] = {}
+    completed: Dict[UUID4, bool] = {}
+    moved_tasks: List[UUID4] = []
+    moved_stages: List[UUID4] = []
+    deleted_tasks: List[UUID4] = []
+    results: List[BatchOperationResult] = []
+
+    for (index, op) in enumerate(operations):
+        task_id = getattr(op, 'task_id', None) or (subtasks[op.subtask_id].task_id if op.op == 'toggle_subtask' else None)
+        if task_id in deleted_tasks:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f"Operation {index} ({op.op}) refers to a task deleted by an earlier operation")
+
+        if op.op == 'move_task':
+            stage_id = op.stage_id or task_stages[op.task_id]
+            rank = rank_for_position(Task, Task.stage_id, stage_id, op.task_id, op.after_id, op.before_id, db)
+            db.execute(update(Task)
+                       .where(Task.id == op.task_id)
+                       .values(stage_id=stage_id, rank=rank, revision=revision)
+                       .execution_options(synchronize_session=False))
+            task_stages[op.task_id] = stage_id
+            moved_tasks.append(op.task_id)
+        elif op.op == 'assign_task':
+            task_edits.setdefault(op.task_id, {})['assigned_user_id'] = op.assigned_user_id
+        elif op.op == 'edit_task':
+            task_edits.setdefault(op.task_id, {}).update(op.model_dump(include={'title', 'description'}, exclude_none=True))
+        elif op.op == 'delete_task':
+            deleted_tasks.append(op.task_id)
+        elif op.op == 'toggle_subtask':
+            is_completed = completed.get(op.subtask_id, subtasks[op.subtask_id].is_completed)
+            completed[op.subtask_id] = op.is_completed if op.is_completed is not None else not is_completed
+        elif op.op == 'move_stage':
+            rank = rank_for_position(Stage, Stage.board_id, board_id, op.stage_id, op.after_id, op.before_id, db)
+            db.execute(update(Stage)
+                       .where(Stage.id == op.stage_id)
+                       .values(rank=rank, revision=revision)
+                       .execution_options(synchronize_session=False))
+            moved_stages.append(op.stage_id)
+        elif op.op == 'edit_stage':
+            stage_edits.setdefault(op.stage_id, {}).update(op.model_dump(include={'title', 'color'}, exclude_none=True))
+
+        results.append(BatchOperationResult(op=op.op, id=getattr(op, 'task_id', None) or getattr(op, 'stage_id', None) or op.subtask_id))
+
+    # Whatever else happened to a deleted task doesn't need to be written
+    for id in deleted_tasks:
+        task_edits.pop(id, None)
+    moved_tasks = [id for id in moved_tasks if id not in deleted_tasks]
+    completed = {id: is_completed for (id, is_completed) in completed.items() if subtasks[id].task_id not in deleted_tasks}
+
+    update_tasks(task_edits, db, revision)
+    update_stages(stage_edits, db, revision)
+    update_subtasks(completed, db, revision)
+    if deleted_tasks:
+        # Subtasks are deleted by the FK cascade
+        db.execute(delete(Task).where(Task.id.in_(deleted_tasks)).execution_options(synchronize_session=False))
+        record_tombstones(db, board_id, 'task', deleted_tasks, revision)
+
+    for (entity, action, ids) in [('task', 'moved', moved_tasks), ('task', 'updated', list(task_edits)), ('task', 'deleted', deleted_tasks),
+                                  ('subtask', 'updated', list(completed)), ('stage', 'moved', moved_stages), ('stage', 'updated', list(stage_edits))]:
+        if ids:
+            record_change(db, board_id, entity, action, ids)
+
+    db.commit()
+
+    changed_tasks = set(moved_tasks) | set(task_edits)
+    changed_stages = set(moved_stages) | set(stage_edits)
+    return BoardBatchReturn.model_validate({
+        "revision": revision,
+        "results": results,
+        "tasks": db.query(Task).options(selectinload(Task.assigned_user)).filter(Task.id.in_(changed_tasks)).all() if changed_tasks else [],
+        "stages": db.query(Stage).filter(Stage.id.in_(changed_stages)).all() if changed_stages else [],
+        "subtasks": db.query(Subtask).filter(Subtask.id.in_(list(completed))).all() if completed else [],
+        "deleted": [{"id": id, "entity": "task", "revision": revision} for id in deleted_tasks],
+    }, from_attributes=True)
+
+
+def load_batch_rows(operations: list, board_id: UUID4, db: Session):
+    # Everything the batch refers to has to be on this board, checked with one query per entity
+    task_ids = {op.task_id for op in operations if hasattr(op, 'task_id')}
+    stage_ids = {op.stage_id for op in operations if getattr(op, 'stage_id', None)}
+    subtask_ids = {op.subtask_id for op in operations if op.op == 'toggle_subtask'}
+
+    task_stages = dict(db.execute(select(Task.id, Task.stage_id)
+                                  .where(Task.id.in_(task_ids), Task.board_id == board_id)).all()) if task_ids else {}
+    found_stages = set(db.execute(select(Stage.id).where(Stage.id.in_(stage_ids), Stage.board_id == board_id)).scalars()) if stage_ids else set()
+    subtasks = {row.id: row for row in db.execute(select(Subtask.id, Subtask.task_id, Subtask.is_completed)
+                                                  .where(Subtask.id.in_(subtask_ids), Subtask.board_id == board_id))} if subtask_ids else {}
+
+    for (entity, ids, found) in [('Task', task_ids, task_stages), ('Stage', stage_ids, found_stages), ('Subtask', subtask_ids, subtasks)]:
+        for id in ids:
+            if id not in found:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                    detail=f"{entity} with id {id} not found on this board")
+
+    return (task_stages, found_stages, subtasks)
+
+
+def update_tasks(edits: Dict[UUID4, dict], db: Session, revision: int):
+    if not edits:
+        return
+
+    # Left out fields keep their value, the flag tells an unassignment apart from an assignment that wasn't changed.
+    # A NULL in VALUES is text to Postgres, the assignee needs the explicit cast.
+    incoming = values(column('id', UUID(as_uuid=True)), column('title', String), column('description', String),
+                      column('assigned_user_id', UUID(as_uuid=True)), column('is_assigned', Boolean), name='incoming') \
+        .data([(id, edit.get('title'), edit.get('description'), edit.get('assigned_user_id'), 'assigned_user_id' in edit)
+               for (id, edit) in edits.items()])
+
+    db.execute(update(Task)
+               .where(Task.id == incoming.c.id)
+               .values(title=func.coalesce(incoming.c.title, Task.title),
+                       description=func.coalesce(incoming.c.description, Task.description),
+                       assigned_user_id=case((incoming.c.is_assigned, cast(incoming.c.assigned_user_id, UUID(as_uuid=True))), else_=Task.assigned_user_id),
+                       revision=revision)
+               .execution_options(synchronize_session=False))
+
+
+def update_stages(edits: Dict[UUID4, dict], db: Session, revision: int):
+    if not edits:
+        return
+
+    incoming = values(column('id', UUID(as_uuid=True)), column('title', String), column('color', String), name='incoming') \
+        .data([(id, edit.get('title'), edit.get('color')) for (id, edit) in edits.items()])
+
+    db.execute(update(Stage)
+               .where(Stage.id == incoming.c.id)
+               .values(title=func.coalesce(incoming.c.title, Stage.title),
+                       color=func.coalesce(incoming.c.color, Stage.color),
+                       revision=revision)
+               .execution_options(synchronize_session=False))
+
+
+def update_subtasks(completed: Dict[UUID4, bool], db: Session, revision: int):
+    if not completed:
+        return
+
+    incoming = values(column('id', UUID(as_uuid=True)), column('is_completed', Boolean), name='incoming').data(list(completed.items()))
+
+    db.execute(update(Subtask)
+               .where(Subtask.id == incoming.c.id)
+               .values(is_completed=incoming.c.is_completed, revision=revision)
+               .execution_options(synchronize_session=False))
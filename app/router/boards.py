@@ -1,43 +1,177 @@
+import asyncio
+import uuid
+from collections import defaultdict
 from typing import List
+from typing_extensions import Annotated
 
 from pydantic import UUID4
-from app.database import get_db
-from app.router.stages import create_new_stage, delete_stage, update_stages
-from app.schemas import BoardCreateResponse, BoardDataReturn, BoardListReturn, BoardCreate, BoardUpdate, ContributorUpdate, StageCreate, StageUpdate, UserInfoReturn
-from app.models import Task, User, Board, boards_users
-from app.oauth2 import get_current_user
-from sqlalchemy.orm import Session
-from fastapi import APIRouter, Depends, HTTPException, Response, status
-from app.utils.helpers import get_index, getListDiff
-
-from app.utils.validation import get_board_from_db
+from app.database import get_db, get_read_db, is_replica, run_db, run_in_session
+from app.router.stages import assign_ranks, encode_task_cursor, insert_stages, update_stages
+from app.schemas import BoardChangesReturn, BoardCreateResponse, BoardDataReturn, BoardListReturn, BoardCreate, BoardPageReturn, BoardUpdate, ContributorUpdate, DeletionReturn, StageCreate, StageUpdate, UserInfoReturn, Principal
+from app.models import Deletion, User, Board, boards_users
+from app.oauth2 import authenticate, get_current_principal, get_current_user, oauth2_scheme
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, selectinload
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, WebSocket, WebSocketDisconnect, status
+from app.utils.cache import board_cache, etag_matches
+from app.utils.changes import is_revision_syncable, load_board_changes
+from app.utils.live import live_hub, record_change
+from app.utils.helpers import getListDiff
+from app.utils.loaders import load_board_header, load_board_outline, load_board_snapshot, load_first_tasks, load_user_boards
+from app.utils.reaper import reaper
+
+from app.utils.validation import check_board_permission, get_board_from_db, invalidate_board_permissions
 
 
 router = APIRouter(prefix="/boards", tags=["Boards"])
 
 
 @router.get("/", response_model=BoardListReturn)
-def get_users_boards(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_users_boards(db: Session = Depends(get_read_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, get_users_boards_sync, current_user)
+
 
+def get_users_boards_sync(db: Session, current_user: Principal):
     # Easiest way is to simply get the user from the database since our Model holds a direct relationship to all boards that the user is owning or contributing to.
-    user = db.query(User).filter(User.id == current_user.id).first()
+    user = load_user_boards(current_user.id, db)
 
-    return {"own_boards": user.own_boards, "contributing": user.boards_contributing}
+    return BoardListReturn.model_validate({"own_boards": user.own_boards, "contributing": user.boards_contributing}, from_attributes=True)
 
 
-@router.get("/{id}", response_model=BoardDataReturn)
-def get_board_data(id: UUID4, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    (board_query, board) = get_board_from_db(id, db, current_user)
+@router.get("/{id}", response_model=BoardDataReturn | BoardPageReturn, responses={304: {"description": "Board unchanged since the given ETag"}})
+async def get_board_data(id: UUID4, if_none_match: Annotated[str | None, Header()] = None,
+                         tasks_per_stage: Annotated[int | None, Query(ge=1, le=100)] = None,
+                         db: Session = Depends(get_read_db), current_user: Principal = Depends(get_current_principal)):
+
+    # Large stages are loaded page by page, only the full board is cached
+    if tasks_per_stage:
+        return await run_db(db, get_board_page_sync, id, tasks_per_stage, current_user)
+
+    # Only the principal is needed to answer from the cache, the database is not touched on a hit
+    user_id = str(current_user.id)
+
+    revision = board_cache.revision(id)
+    snapshot = board_cache.get(id, revision)
+
+    if not snapshot or user_id not in snapshot.member_ids:
+        # The snapshot is served to every member until the next write, a replica could still be missing the last one
+        if is_replica(db):
+            (body, member_ids) = await run_in_session(serialize_board_snapshot, id, current_user.id)
+        else:
+            (body, member_ids) = await run_db(db, serialize_board_snapshot, id, current_user.id)
+        snapshot = board_cache.put(id, revision, body, member_ids)
+
+    if etag_matches(if_none_match, snapshot.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": snapshot.etag})
+
+    return Response(content=snapshot.body, media_type="application/json", headers={"ETag": snapshot.etag})
+
+
+def serialize_board_snapshot(db: Session, id: UUID4, user_id: UUID4):
+    # Stages are already ordered by their index through the relationship
+    board = load_board_snapshot(id, db)
+    check_board_permission(board, user_id)
+
+    body = BoardDataReturn.model_validate(board, from_attributes=True).model_dump_json().encode()
+    member_ids = frozenset([str(board.owner_id), *(str(user.id) for user in board.contributors)])
+
+    return (body, member_ids)
+
+
+def get_board_page_sync(db: Session, id: UUID4, tasks_per_stage: int, current_user: Principal):
+    board = load_board_outline(id, db)
+    check_board_permission(board, current_user.id)
+
+    # One more task per stage than returned tells whether the stage has a next page
+    tasks_by_stage = defaultdict(list)
+    for task in load_first_tasks(id, tasks_per_stage + 1, db):
+        tasks_by_stage[task.stage_id].append(task)
+
+    stages = [{
+        "id": stage.id,
+        "title": stage.title,
+        "index": stage.index,
+        "color": stage.color,
+        "rank": stage.rank,
+        "tasks": tasks_by_stage[stage.id][:tasks_per_stage],
+        "tasks_cursor": encode_task_cursor(tasks_by_stage[stage.id][tasks_per_stage - 1]) if len(tasks_by_stage[stage.id]) > tasks_per_stage else None,
+    } for stage in board.stages]
+
+    return BoardPageReturn.model_validate({"id": board.id, "title": board.title, "revision": board.revision, "owner": board.owner,
+                                           "contributors": board.contributors, "stages": stages}, from_attributes=True)
+
+
+@router.get("/{id}/changes", response_model=BoardChangesReturn)
+async def get_board_changes(id: UUID4, since: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, get_board_changes_sync, id, since, current_user)
+
+
+def get_board_changes_sync(db: Session, id: UUID4, since: int, current_user: Principal):
+    board = load_board_header(id, db)
+    check_board_permission(board, current_user.id)
+
+    if not is_revision_syncable(board, since):
+        snapshot = load_board_snapshot(id, db)
+        return BoardChangesReturn.model_validate({"revision": snapshot.revision, "title": snapshot.title, "owner": snapshot.owner,
+                                                  "contributors": snapshot.contributors, "snapshot": snapshot}, from_attributes=True)
+
+    return BoardChangesReturn.model_validate(load_board_changes(board, since, db), from_attributes=True)
+
+
+@router.websocket("/{id}/live")
+async def board_live_updates(websocket: WebSocket, id: UUID4):
+    try:
+        token = await oauth2_scheme(websocket)
+        user_id = uuid.UUID((await authenticate(token)).user_id)
+        # The session is closed right after the check, a long lived connection must not hold on to a pooled connection
+        revision = await run_in_session(get_live_board_revision, id, user_id)
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
 
-    stages = board.stages
-    stages.sort(key=get_index)
+    await websocket.accept()
+    subscription = live_hub.subscribe(id)
 
-    return board
+    async def forward_events():
+        await websocket.send_json({"type": "subscribed", "board_id": str(id), "revision": revision})
+        while True:
+            event = await subscription.queue.get()
+            await websocket.send_json(event)
+
+            if event["type"] == "resync":
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+
+    async def wait_for_disconnect():
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            return
+
+    tasks = [asyncio.create_task(forward_events()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        live_hub.unsubscribe(subscription)
+
+
+def get_live_board_revision(db: Session, id: UUID4, user_id: UUID4):
+    board = load_board_header(id, db)
+    check_board_permission(board, user_id)
+
+    return board.revision
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=BoardCreateResponse)
-def create_board(board: BoardCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_board(board: BoardCreate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, create_board_sync, board)
+
 
+def create_board_sync(db: Session, board: BoardCreate):
     board_dict = board.model_dump()
     stages: List[StageCreate] = board_dict.pop('stages')
     contributors: List[UUID4] = get_new_contributors(
@@ -46,29 +180,30 @@ def create_board(board: BoardCreate, db: Session = Depends(get_db), current_user
     new_board = Board(**board_dict)
 
     db.add(new_board)
-    db.commit()
-    db.refresh(new_board)
-
-    # After board creation we can access its ID to create the stages with the fkey board_id
-    for stage in stages:
-        create_new_stage(stage, db, new_board.id)
+    db.flush()
 
-    add_contributors(contributors, db, new_board)
+    # After the flush we can access its ID to create the stages and contributors with the fkey board_id
+    assign_ranks(stages)
+    insert_stages(stages, db, new_board.id)
+    add_contributors(contributors, db, new_board.id)
 
-    if len(stages) > 0 or len(contributors) > 0:
-        db.commit()  # Only commit a second time if we really have stages or contributors that were created
+    db.commit()
 
-    return new_board
+    return BoardCreateResponse.model_validate(load_board_snapshot(new_board.id, db), from_attributes=True)
 
 
 @router.put("/{id}", response_model=BoardDataReturn)
-def update_board(id: UUID4, client_data: BoardUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_board(id: UUID4, client_data: BoardUpdate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, update_board_sync, id, client_data, current_user)
 
+
+def update_board_sync(db: Session, id: UUID4, client_data: BoardUpdate, current_user: Principal):
     (board_query, board) = get_board_from_db(id, db, current_user)
 
     is_client_owner = current_user.id == board.owner_id
 
-    board_dict = client_data.model_dump()
+    # The owner only changes through PATCH /boards/{id}/owner/{owner_id}, which checks the new owner
+    board_dict = client_data.model_dump(exclude={'owner_id'})
     incoming_stages: List[StageUpdate] = board_dict.pop("stages")
     incoming_contributors: List[ContributorUpdate] = board_dict.pop(
         "contributors")
@@ -77,78 +212,103 @@ def update_board(id: UUID4, client_data: BoardUpdate, db: Session = Depends(get_
         incoming_contributors)
     new_contributors: List[UUID4] = get_new_contributors(incoming_contributors)
 
+    revision = record_change(db, id, 'board', 'updated', [id])
     board_query.update(board_dict, synchronize_session=False)
 
-    update_stages(incoming_stages, db, id)
+    update_stages(incoming_stages, db, id, revision)
     if is_client_owner:
-        add_contributors(new_contributors, db, board)
-        remove_contributors(removed_contributors, db, board)
+        add_contributors(new_contributors, db, id)
+        remove_contributors(removed_contributors, db, id)
 
     db.commit()
 
-    return board_query.first()
+    return BoardDataReturn.model_validate(load_board_snapshot(id, db), from_attributes=True)
 
 
 @router.patch("/{board_id}/owner/{owner_id}", response_model=BoardDataReturn)
-def change_board_owner(board_id: UUID4, owner_id: UUID4, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def change_board_owner(board_id: UUID4, owner_id: UUID4, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    return await run_db(db, change_board_owner_sync, board_id, owner_id, current_user)
+
 
-    (board_query, board) = get_board_from_db(board_id, db, current_user)
-    new_owner = db.query(User).filter(User.id == owner_id).first()
+def change_board_owner_sync(db: Session, board_id: UUID4, owner_id: UUID4, current_user: User):
+    (board_query, board) = get_board_from_db(board_id, db, current_user, selectinload(Board.contributors))
+    new_owner = db.query(User).filter(User.id == owner_id, User.deleted_at.is_(None)).first()
 
     if board.owner_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail=f"Only the owner of this board can set a new owner.")
 
+    if not new_owner:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"User with id {owner_id} not found")
+
+    # Only a contributor can become the owner, the old owner takes their place among the contributors
+    if new_owner not in board.contributors:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="The new owner has to be a contributor of this board")
+
     board.contributors.remove(new_owner)
     board_query.update({'owner_id': owner_id})
     board.contributors.append(current_user)
+    invalidate_board_permissions(db, board_id, [current_user.id, owner_id])
 
+    record_change(db, board_id, 'board', 'updated', [board_id])
     db.commit()
 
-    return board_query.first()
+    return BoardDataReturn.model_validate(load_board_snapshot(board_id, db), from_attributes=True)
+
+
+@router.delete("/{id}", status_code=status.HTTP_202_ACCEPTED, response_model=DeletionReturn)
+async def delete_board(id: UUID4, response: Response, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    deletion = await run_db(db, delete_board_sync, id, current_user)
+    reaper.wake()
 
+    response.headers["Location"] = f"/deletions/{deletion.id}"
+    return deletion
 
-@router.delete("/{id}")
-def delete_board(id: UUID4, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
 
+def delete_board_sync(db: Session, id: UUID4, current_user: Principal):
+    # The board is only marked as deleted and hidden from here on, the reaper removes its rows in the background
     (board_query, board) = get_board_from_db(id, db, current_user)
 
     if not current_user.id == board.owner_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail=f'Only the owner of this board can delete it!')
 
-    for stage in board.stages:
-        delete_stage(stage.__dict__, db)
+    board_query.update({'deleted_at': func.now()}, synchronize_session=False)
+    record_change(db, id, 'board', 'deleted', [id])
+    invalidate_board_permissions(db, id)
 
-    for contributor in board.contributors:
-        board.contributors.remove(contributor)
+    deletion = Deletion(entity='board', target_id=id, requested_by=current_user.id)
+    db.add(deletion)
     db.commit()
 
-    board_query.delete()
-    db.commit()
-
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
-
+    return DeletionReturn.model_validate(deletion, from_attributes=True)
 
-def get_tasks_by_stage(db: Session, stage_id: UUID4):
-    tasks = db.query(Task).filter(Task.stage_id == stage_id).all()
 
-    return tasks
+def add_contributors(users: List[UUID4], db: Session, board_id: UUID4):
+    if not users:
+        return
 
-
-def add_contributors(users: List[UUID4], db: Session, board: Board):
+    found = set(db.execute(select(User.id).where(User.id.in_(users), User.deleted_at.is_(None))).scalars())
     for contributor in users:
-        new_contributor = db.query(User).filter(User.id == contributor).first()
-        if not new_contributor:
+        if contributor not in found:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail=f'User with ID {contributor} not found.')
-        board.contributors.append(new_contributor)
 
+    # Adding someone who already contributes is a no-op
+    db.execute(insert(boards_users).on_conflict_do_nothing(), [{"board_id": board_id, "user_id": user_id} for user_id in found])
 
-def remove_contributors(users: List[UUID4], db: Session, board: Board):
-    for contributor in users:
-        user = db.query(User).filter(User.id == contributor).first()
-        board.contributors.remove(user)
+    invalidate_board_permissions(db, board_id, users)
+
+
+def remove_contributors(users: List[UUID4], db: Session, board_id: UUID4):
+    if not users:
+        return
+
+    db.execute(delete(boards_users).where(boards_users.c.board_id == board_id, boards_users.c.user_id.in_(users)))
+
+    invalidate_board_permissions(db, board_id, users)
 
 
 def get_removed_contributors(contributors: ContributorUpdate):
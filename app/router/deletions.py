@@ -0,0 +1,26 @@
+from pydantic import UUID4
+from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from app.database import get_db, run_db
+from app.models import Deletion
+from app.oauth2 import get_current_principal
+from app.schemas import DeletionReturn, Principal
+
+
+router = APIRouter(prefix="/deletions", tags=["Deletions"])
+
+
+@router.get("/{id}", response_model=DeletionReturn)
+async def get_deletion(id: UUID4, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, get_deletion_sync, id, current_user)
+
+
+def get_deletion_sync(db: Session, id: UUID4, current_user: Principal):
+    # Only whoever requested the deletion may follow it
+    deletion = db.query(Deletion).filter(Deletion.id == id, Deletion.requested_by == current_user.id).first()
+
+    if not deletion:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Couldn't find deletion with id {id}")
+
+    return DeletionReturn.model_validate(deletion, from_attributes=True)
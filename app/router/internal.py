@@ -0,0 +1,39 @@
+from fastapi import APIRouter
+
+from app import database
+from app.config import settings
+from app.email_service import email_outbox
+from app.oauth2 import token_cache, user_cache
+from app.utils.cache import board_cache
+from app.utils.passwords import password_hasher
+
+
+# Only mounted when settings.expose_internal_endpoints is set, see app/main.py
+router = APIRouter(prefix="/internal", tags=["Internal"], include_in_schema=False)
+
+
+@router.get("/cache")
+def get_cache_stats():
+    return {"board_snapshots": board_cache.stats(), "tokens": token_cache.stats(), "users": user_cache.stats()}
+
+
+@router.get("/outbox")
+def get_outbox_stats():
+    return email_outbox.stats()
+
+
+@router.get("/pool")
+def get_pool_stats():
+    pools = {"sync": database.engine.pool.report()}
+
+    if settings.database_async:
+        pools["async"] = database.async_engine.pool.report()
+
+    if settings.database_replica_hostname:
+        pools["sync_replica"] = database.replica_engine.pool.report()
+        if settings.database_async:
+            pools["async_replica"] = database.async_replica_engine.pool.report()
+
+    pools["password_hasher"] = password_hasher.stats()
+
+    return pools
@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Response
+
+from app.utils.prometheus import render_metrics
+
+
+# Only mounted when settings.expose_metrics_endpoint is set, see app/main.py
+router = APIRouter(tags=["Metrics"], include_in_schema=False)
+
+
+@router.get("/metrics")
+def get_metrics():
+    # A sync handler, in multiprocess mode the files of all workers are read from disk
+    (body, content_type) = render_metrics()
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,97 @@
+import html
+import uuid
+from typing import List
+from typing_extensions import Annotated
+
+from pydantic import UUID4
+from sqlalchemy import REAL, and_, cast, func, or_, select, union_all
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+
+from app.database import get_db, run_db
+from app.models import Subtask, Task
+from app.oauth2 import get_current_principal
+from app.schemas import Principal, SubtaskSearchHit, TaskSearchHit
+from app.utils.pagination import decode_cursor, encode_cursor
+from app.utils.validation import authorize_board, validate_uuid
+
+
+router = APIRouter(prefix="/boards", tags=["Boards"])
+
+# Has to match the configuration of the generated search_vector columns in app/models.py
+SEARCH_CONFIG = "simple"
+# ts_headline marks matches with private use characters, the text is HTML escaped before they become <mark></mark>
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_STOP = "\ue001"
+TITLE_HEADLINE = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, HighlightAll=true"
+DESCRIPTION_HEADLINE = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxFragments=2, MaxWords=20, MinWords=5"
+
+
+@router.get("/{id}/search", response_model=List[TaskSearchHit], responses={200: {"headers": {"X-Next-Cursor": {"description": "Pass as cursor to get the next page"}}}})
+async def search_board(id: UUID4, response: Response, q: Annotated[str, Query(min_length=1, max_length=200)],
+                       limit: Annotated[int, Query(ge=1, le=50)] = 20, cursor: str | None = None,
+                       db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+
+    (hits, next_cursor) = await run_db(db, search_board_sync, id, q, limit, cursor, current_user)
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    return hits
+
+
+def search_board_sync(db: Session, board_id: UUID4, q: str, limit: int, cursor: str | None, current_user: Principal):
+    """
+    Tasks whose title, description or subtask titles match the query, best matches first. The query takes the
+    syntax of web search engines: quoted phrases, OR and -word. A task's rank is the sum of the ranks of
+    its own match and of its matching subtasks. Highlights are only computed for the returned page.
+    """
+    authorize_board(board_id, current_user.id, db)
+
+    query = func.websearch_to_tsquery(cast(SEARCH_CONFIG, REGCONFIG), q)
+
+    hits = union_all(
+        select(Task.id.label("task_id"), func.ts_rank(Task.search_vector, query).label("rank"))
+        .where(Task.board_id == board_id, Task.search_vector.op("@@")(query)),
+        select(Subtask.task_id, func.ts_rank(Subtask.search_vector, query))
+        .where(Subtask.board_id == board_id, Subtask.search_vector.op("@@")(query)),
+    ).subquery("hits")
+    ranked = select(hits.c.task_id, func.sum(hits.c.rank).label("rank")).group_by(hits.c.task_id).subquery("ranked")
+
+    statement = select(ranked.c.task_id, ranked.c.rank)
+
+    if cursor:
+        (last_rank, last_id) = decode_cursor(cursor, 2)
+        if not isinstance(last_rank, (int, float)) or not validate_uuid(last_id):
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor")
+        # Ranks are compared as the real they were computed as, a double would never be equal again
+        last_rank = cast(last_rank, REAL)
+        statement = statement.where(or_(ranked.c.rank < last_rank, and_(ranked.c.rank == last_rank, ranked.c.task_id > uuid.UUID(last_id))))
+
+    rows = db.execute(statement.order_by(ranked.c.rank.desc(), ranked.c.task_id).limit(limit + 1)).all()
+    page = rows[:limit]
+    next_cursor = encode_cursor([page[-1].rank, page[-1].task_id]) if len(rows) > limit else None
+
+    if not page:
+        return ([], None)
+
+    ids = [row.task_id for row in page]
+    tasks = {row.id: row for row in db.execute(select(Task.id, Task.stage_id,
+                                                      func.ts_headline(cast(SEARCH_CONFIG, REGCONFIG), Task.title, query, TITLE_HEADLINE).label("title"),
+                                                      func.ts_headline(cast(SEARCH_CONFIG, REGCONFIG), Task.description, query, DESCRIPTION_HEADLINE).label("description"))
+                                               .where(Task.id.in_(ids)))}
+    subtasks = db.execute(select(Subtask.id, Subtask.task_id,
+                                 func.ts_headline(cast(SEARCH_CONFIG, REGCONFIG), Subtask.title, query, TITLE_HEADLINE).label("title"))
+                          .where(Subtask.task_id.in_(ids), Subtask.search_vector.op("@@")(query))
+                          .order_by(Subtask.index)).all()
+
+    return ([TaskSearchHit(id=row.task_id, stage_id=tasks[row.task_id].stage_id, rank=row.rank,
+                           title=to_html(tasks[row.task_id].title), description=to_html(tasks[row.task_id].description),
+                           subtasks=[SubtaskSearchHit(id=subtask.id, title=to_html(subtask.title)) for subtask in subtasks if subtask.task_id == row.task_id])
+             # A task deleted since the first statement is left out
+             for row in page if row.task_id in tasks], next_cursor)
+
+
+def to_html(headline: str):
+    return html.escape(headline).replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_STOP, "</mark>")
@@ -1,80 +1,200 @@
+import uuid
 from typing import List
+from typing_extensions import Annotated
 
 from pydantic import UUID4
+from sqlalchemy import UUID, Integer, String, column, delete, insert, select, update, values
 from sqlalchemy.orm import Session
-from fastapi import APIRouter, Depends, HTTPException, status
-from app.database import get_db
-
-from app.models import Board, Stage, User
-from app.oauth2 import get_current_user
-from app.schemas import StageCreate, StageResponse, StageUpdate
-from app.utils.validation import check_board_permission, validate_uuid
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response, status
+from app.database import get_db, run_db
+
+from app.models import Stage, Task
+from app.oauth2 import get_current_principal
+from app.schemas import StageCreate, StageMove, StageResponse, StageUpdate, TaskResponse, Principal
+from app.utils.changes import bump_board_revision, record_tombstones
+from app.utils.live import record_change
+from app.utils.loaders import load_stage, load_task_page
+from app.utils.pagination import decode_cursor, encode_cursor
+from app.utils.ranks import rank_between, rank_for_position, rebalance_stages, rebalancer, spread_ranks
+from app.utils.validation import authorize_board, validate_uuid
 
 router = APIRouter(prefix="/stages", tags=["Stages"])
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=StageResponse)
-def create_stage(client_data: StageCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_stage(client_data: StageCreate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, create_stage_sync, client_data, current_user)
+
 
+def create_stage_sync(db: Session, client_data: StageCreate, current_user: Principal):
     if not validate_uuid(client_data.board_id):
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                             detail="Please provide a valid UUID4 as reference to the board of this stage")
 
-    board = db.query(Board).filter(Board.id == client_data.board_id).first()
-    check_board_permission(board, current_user.id)
+    authorize_board(client_data.board_id, current_user.id, db)
 
-    new_stage = Stage(**client_data.model_dump())
+    revision = bump_board_revision(db, client_data.board_id)
+    rank = rank_for_position(Stage, Stage.board_id, uuid.UUID(client_data.board_id), None, None, None, db)
+    new_stage = Stage(**client_data.model_dump(), revision=revision, rank=rank)
     db.add(new_stage)
+    db.flush()
+    record_change(db, client_data.board_id, 'stage', 'created', [new_stage.id])
     db.commit()
-    db.refresh(new_stage)
 
-    return new_stage
+    return StageResponse.model_validate(load_stage(new_stage.id, db), from_attributes=True)
+
+
+@router.get("/{id}/tasks", response_model=List[TaskResponse], responses={200: {"headers": {"X-Next-Cursor": {"description": "Pass as cursor to get the next page"}}}})
+async def get_stage_tasks(id: UUID4, response: Response, limit: Annotated[int, Query(ge=1, le=100)] = 50, cursor: str | None = None,
+                          db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+
+    (tasks, next_cursor) = await run_db(db, get_stage_tasks_sync, id, limit, cursor, current_user)
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    return tasks
+
+
+def get_stage_tasks_sync(db: Session, id: UUID4, limit: int, cursor: str | None, current_user: Principal):
+    board_id = db.execute(select(Stage.board_id).where(Stage.id == id)).scalar()
+
+    if not board_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Stage with id {id} not found")
+
+    authorize_board(board_id, current_user.id, db)
+
+    tasks = load_task_page(id, decode_task_cursor(cursor) if cursor else None, limit + 1, db)
+
+    return ([TaskResponse.model_validate(task, from_attributes=True) for task in tasks[:limit]],
+            encode_task_cursor(tasks[limit - 1]) if len(tasks) > limit else None)
+
+
+def encode_task_cursor(task: Task):
+    return encode_cursor([task.rank, task.id])
+
+
+def decode_task_cursor(cursor: str):
+    (last_rank, last_id) = decode_cursor(cursor, 2)
+
+    if not isinstance(last_rank, str) or not validate_uuid(last_id):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor")
+
+    return (last_rank, uuid.UUID(last_id))
+
 
+@router.patch("/{id}/move", response_model=StageResponse)
+async def move_stage(id: UUID4, client_data: StageMove, background_tasks: BackgroundTasks,
+                     db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    (stage, board_id) = await run_db(db, move_stage_sync, id, client_data, current_user)
+    rebalancer.schedule(background_tasks, stage.rank, rebalance_stages, board_id)
 
-def update_stages(stages: List[StageUpdate], db: Session, board_id):
+    return stage
+
+
+def move_stage_sync(db: Session, id: UUID4, client_data: StageMove, current_user: Principal):
+    board_id = db.execute(select(Stage.board_id).where(Stage.id == id)).scalar()
+
+    if not board_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Stage with id {id} not found")
+
+    authorize_board(board_id, current_user.id, db)
+
+    # Only the moved stage is written
+    revision = record_change(db, board_id, 'stage', 'moved', [id])
+    rank = rank_for_position(Stage, Stage.board_id, board_id, id, client_data.after_id, client_data.before_id, db)
+    db.execute(update(Stage).where(Stage.id == id).values(rank=rank, revision=revision).execution_options(synchronize_session=False))
+    db.commit()
+
+    return (StageResponse.model_validate(load_stage(id, db), from_attributes=True), board_id)
+
+
+def update_stages(stages: List[StageUpdate], db: Session, board_id, revision: int):
+    # A constant number of statements no matter how many stages the board has
     for stage in stages:
-        create_new_stage(stage, db, board_id)
         validate_stage_id(stage)
-        process_marked_for_deletion(stage, db)
-        update_stage(stage, db)
 
+    new_stages = [stage for stage in stages if not stage.get('id') and not stage.get('markedForDeletion')]
+    changed_stages = [stage for stage in stages if stage.get('id') and not stage.get('markedForDeletion')]
+    deleted_stages = [stage['id'] for stage in stages if stage.get('id') and stage.get('markedForDeletion')]
+
+    # Clients that edit the whole board still order it by index. Moves only change the rank, so an index
+    # the client sent unchanged says nothing about the order and the ranks are only rebuilt once an index changed.
+    current = {row.id: row for row in db.execute(select(Stage.id, Stage.index, Stage.rank).where(Stage.board_id == board_id))}
+    if any(uuid.UUID(stage['id']) in current and stage['index'] != current[uuid.UUID(stage['id'])].index for stage in changed_stages):
+        assign_ranks(new_stages + changed_stages)
+    else:
+        keep_ranks(new_stages, changed_stages, current)
 
-def create_new_stage(stage: StageUpdate, db: Session, board_id: UUID4):
-    if not stage.get('id') and not stage.get('markedForDeletion'):
-        stage_data: StageCreate = {
-            "title": stage['title'],
-            "index": stage['index'],
-            "color": stage['color'],
-            "board_id": board_id
-        }
-        new_stage = Stage(**stage_data)
-        db.add(new_stage)
-        return new_stage
+    insert_stages(new_stages, db, board_id, revision)
+    update_changed_stages(changed_stages, db, board_id, revision)
+    # Only stages that were deleted from this board get a tombstone, ids of other boards are ignored
+    record_tombstones(db, board_id, 'stage', delete_stages(deleted_stages, db, board_id), revision)
+
+
+def assign_ranks(stages: List[StageCreate | StageUpdate]):
+    for (stage, rank) in zip(sorted(stages, key=lambda stage: stage['index']), spread_ranks(len(stages))):
+        stage['rank'] = rank
+
+
+def keep_ranks(new_stages: List[StageCreate], changed_stages: List[StageUpdate], current: dict):
+    # Changed stages keep their rank, new stages go to the end of the board in the order of their index
+    for stage in changed_stages:
+        row = current.get(uuid.UUID(stage['id']))
+        stage['rank'] = row.rank if row else None
+
+    last = max((row.rank for row in current.values()), default=None)
+    for stage in sorted(new_stages, key=lambda stage: stage['index']):
+        stage['rank'] = last = rank_between(last, None)
+
+
+def insert_stages(stages: List[StageCreate], db: Session, board_id: UUID4, revision: int = 0):
+    # The stages need their rank assigned, see assign_ranks
+    if not stages:
+        return
+
+    # One multi-row INSERT
+    db.execute(insert(Stage), [{
+        "title": stage['title'],
+        "index": stage['index'],
+        "color": stage['color'],
+        "rank": stage['rank'],
+        "board_id": board_id,
+        "revision": revision
+    } for stage in stages])
 
 
 def validate_stage_id(stage: StageUpdate):
     if stage.get('id') and not validate_uuid(stage.get('id')):
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                            detail=f"Invalid ID for stage with title {stage.title}")
+                            detail=f"Invalid ID for stage with title {stage['title']}")
+
 
+def update_changed_stages(stages: List[StageUpdate], db: Session, board_id: UUID4, revision: int):
+    if not stages:
+        return
 
-def process_marked_for_deletion(stage: StageUpdate, db: Session):
-    if stage.get('markedForDeletion'):
-        db.query(Stage).filter(Stage.id == stage['id']).delete()
+    incoming = values(column('id', UUID(as_uuid=True)), column('title', String), column('index', Integer), column('color', String),
+                      column('rank', String), name='incoming').data([(uuid.UUID(stage['id']), stage['title'], stage['index'], stage['color'], stage['rank'])
+                                                                     for stage in stages])
 
+    # UPDATE ... FROM (VALUES ...), stages of other boards are never touched
+    db.execute(update(Stage)
+               .where(Stage.id == incoming.c.id, Stage.board_id == board_id)
+               .values(title=incoming.c.title, index=incoming.c.index, color=incoming.c.color, rank=incoming.c.rank, revision=revision)
+               .execution_options(synchronize_session=False))
 
-def update_stage(stage: StageUpdate, db: Session):
-    if stage.get('id') and not stage.get('markedForDeletion'):
-        updated_stage_data = {
-            'title': stage['title'],
-            'index': stage['index'],
-            'color': stage['color']
-        }
 
-        db.query(Stage).filter(
-            Stage.id == stage['id']).update(updated_stage_data)
+def delete_stages(ids: List[str], db: Session, board_id: UUID4) -> List[UUID4]:
+    # Returns the ids that were deleted
+    if not ids:
+        return []
 
+    # Tasks and subtasks go with the FK cascade
+    return db.execute(delete(Stage)
+                      .where(Stage.id.in_(ids), Stage.board_id == board_id)
+                      .returning(Stage.id)
+                      .execution_options(synchronize_session=False)).scalars().all()
 
-def delete_stage(stage: StageUpdate, db: Session):
-    stage.update({'markedForDeletion': True})
-    process_marked_for_deletion(stage, db)
@@ -1,71 +1,108 @@
+import uuid
 from typing import List
 
 from pydantic import UUID4
+from sqlalchemy import UUID, Boolean, Integer, String, column, delete, insert, not_, select, update, values
 from sqlalchemy.orm import Session
 from fastapi import APIRouter, Depends, HTTPException, status
 
-from app.database import get_db
-from app.schemas import SubtaskCreate, SubtaskResponse, SubtaskUpdate
+from app.database import get_db, run_db
+from app.schemas import Principal, SubtaskCreate, SubtaskResponse, SubtaskUpdate
 from app.models import Subtask
-from app.utils.validation import validate_uuid
+from app.oauth2 import get_current_principal
+from app.utils.changes import record_tombstones
+from app.utils.live import record_change
+from app.utils.validation import authorize_board, validate_uuid
 
 
 router = APIRouter(prefix="/subtasks", tags=["Subtasks"])
 
 
 @router.put("/{id}", response_model=SubtaskResponse)
-def toggle_subtask_complete(id: UUID4, db: Session = Depends(get_db)):
+async def toggle_subtask_complete(id: UUID4, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, toggle_subtask_complete_sync, id, current_user)
 
-    subtask_query = db.query(Subtask).filter(Subtask.id == id)
-    subtask = subtask_query.first()
 
-    subtask_query.update({'is_completed': not subtask.is_completed})
+def toggle_subtask_complete_sync(db: Session, id: UUID4, current_user: Principal):
+    board_id = db.execute(select(Subtask.board_id).where(Subtask.id == id)).scalar()
+
+    if not board_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Subtask with id {id} not found")
+
+    authorize_board(board_id, current_user.id, db)
+
+    # Flipped by the database, two toggles at the same time can't both read the old value
+    revision = record_change(db, board_id, 'subtask', 'updated', [id])
+    subtask = db.execute(update(Subtask)
+                         .where(Subtask.id == id)
+                         .values(is_completed=not_(Subtask.is_completed), revision=revision)
+                         .returning(Subtask.id, Subtask.task_id, Subtask.title, Subtask.index, Subtask.is_completed)).one()
 
     db.commit()
 
-    return subtask
+    return SubtaskResponse.model_validate(subtask, from_attributes=True)
 
 
-def update_subtasks(subtasks: List[SubtaskCreate | SubtaskUpdate], db: Session, task_id):
+def update_subtasks(subtasks: List[SubtaskCreate | SubtaskUpdate], db: Session, task_id, board_id, revision: int):
+    # A constant number of statements no matter how many subtasks the task has
     for subtask in subtasks:
-        create_new_subtask(subtask, db, task_id)
         validate_subtask_id(subtask)
-        process_marked_for_deletion(subtask, db)
-        update_subtask(subtask, db)
 
+    new_subtasks = [subtask for subtask in subtasks if subtask.get('is_new') and not subtask.get('markedForDeletion')]
+    changed_subtasks = [subtask for subtask in subtasks
+                        if subtask.get('id') and not subtask.get('is_new') and not subtask.get('markedForDeletion')]
+    deleted_subtasks = [subtask['id'] for subtask in subtasks
+                        if subtask.get('id') and subtask.get('markedForDeletion') and not subtask.get('is_new')]
+
+    insert_subtasks(new_subtasks, db, task_id, board_id, revision)
+    update_changed_subtasks(changed_subtasks, db, task_id, revision)
+    # Only subtasks that were deleted from this task get a tombstone, ids of other tasks are ignored
+    record_tombstones(db, board_id, 'subtask', delete_subtasks(deleted_subtasks, db, task_id), revision)
+
+
+def insert_subtasks(subtasks: List[SubtaskCreate], db: Session, task_id: UUID4, board_id: UUID4, revision: int):
+    if not subtasks:
+        return
 
-def create_new_subtask(subtask: SubtaskCreate | SubtaskUpdate, db: Session, task_id: UUID4):
-    print(subtask)
-    if subtask.get('is_new'):
-        new_subtask = Subtask(task_id=task_id, title=subtask['title'],
-                              index=subtask['index'], is_completed=subtask['is_completed'])
-        db.add(new_subtask)
+    # One multi-row INSERT
+    db.execute(insert(Subtask), [{
+        "task_id": task_id,
+        "board_id": board_id,
+        "title": subtask['title'],
+        "index": subtask['index'],
+        "is_completed": subtask['is_completed'],
+        "revision": revision
+    } for subtask in subtasks])
 
 
 def validate_subtask_id(subtask: SubtaskUpdate):
     if subtask.get('id') and not validate_uuid(subtask.get('id')):
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                            detail=f"Invalid ID for subtask with title {subtask.title}")
+                            detail=f"Invalid ID for subtask with title {subtask['title']}")
 
 
-def process_marked_for_deletion(subtask: SubtaskUpdate, db: Session):
-    if subtask.get('markedForDeletion'):
-        db.query(Subtask).filter(Subtask.id == subtask['id']).delete()
+def update_changed_subtasks(subtasks: List[SubtaskUpdate], db: Session, task_id: UUID4, revision: int):
+    if not subtasks:
+        return
 
+    incoming = values(column('id', UUID(as_uuid=True)), column('title', String), column('index', Integer), column('is_completed', Boolean),
+                      name='incoming').data([(uuid.UUID(str(subtask['id'])), subtask['title'], subtask['index'], subtask['is_completed'])
+                                             for subtask in subtasks])
 
-def update_subtask(subtask: SubtaskUpdate, db: Session):
-    if subtask.get('id') and not subtask.get('markedForDeletion'):
-        updated_subtask_data = {
-            'title': subtask['title'],
-            'index': subtask['index'],
-            'is_completed': subtask['is_completed']
-        }
+    # UPDATE ... FROM (VALUES ...), subtasks of other tasks are never touched
+    db.execute(update(Subtask)
+               .where(Subtask.id == incoming.c.id, Subtask.task_id == task_id)
+               .values(title=incoming.c.title, index=incoming.c.index, is_completed=incoming.c.is_completed, revision=revision)
+               .execution_options(synchronize_session=False))
 
-        db.query(Subtask).filter(Subtask.id ==
-                                 subtask['id']).update(updated_subtask_data)
 
+def delete_subtasks(ids: List[UUID4 | str], db: Session, task_id: UUID4) -> List[UUID4]:
+    # Returns the ids that were deleted
+    if not ids:
+        return []
 
-def delete_subtask(subtask: Subtask, db: Session):
-    dict = subtask.__dict__
-    dict.update({'markedForDeletion': True})
-    process_marked_for_deletion(dict, db)
+    return db.execute(delete(Subtask)
+                      .where(Subtask.id.in_(ids), Subtask.task_id == task_id)
+                      .returning(Subtask.id)
+                      .execution_options(synchronize_session=False)).scalars().all()
@@ -1,53 +1,66 @@
+import uuid
 from typing import List
 
 from pydantic import UUID4
+from sqlalchemy import delete, select, update
 from sqlalchemy.orm import Session
-from fastapi import APIRouter, Depends, HTTPException, Response, status
-
-from app.database import get_db
-from app.router.subtasks import create_new_subtask, delete_subtask, update_subtasks
-from app.schemas import SubtaskCreate, TaskCreate, TaskDeleteResponse, TaskResponse, TaskUpdate, TaskUpdateAssignedUser, TaskUpdateStage
-from app.models import Stage, Task, User, Board
-from app.oauth2 import get_current_user
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response, status
+
+from app.database import get_db, run_db
+from app.router.subtasks import insert_subtasks, update_subtasks
+from app.schemas import SubtaskCreate, TaskCreate, TaskDeleteResponse, TaskResponse, TaskUpdate, TaskMove, TaskUpdateAssignedUser, TaskUpdateStage, Principal
+from app.models import Stage, Task
+from app.oauth2 import get_current_principal
+from app.utils.changes import bump_board_revision, record_tombstones
+from app.utils.live import record_change
 from app.utils.helpers import get_index
-from app.utils.validation import check_board_permission
+from app.utils.loaders import load_task
+from app.utils.ranks import rank_for_position, rebalance_tasks, rebalancer
+from app.utils.validation import authorize_board, check_assignee, validate_uuid
 
 
 router = APIRouter(prefix="/tasks", tags=["Tasks"])
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=TaskResponse)
-def create_task(client_data: TaskCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_task(client_data: TaskCreate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, create_task_sync, client_data, current_user)
+
 
-    board = db.query(Board).filter(Board.id == client_data.board_id).first()
-    check_board_permission(board, current_user.id)
+def create_task_sync(db: Session, client_data: TaskCreate, current_user: Principal):
+    board_id = client_data.board_id
+    authorize_board(board_id, current_user.id, db)
 
     task = client_data.model_dump(exclude='board_id')
     subtasks = task.pop('subtasks')
 
-    new_task = Task(**task)
+    check_stage_on_board(task['stage_id'], board_id, db)
+    if task['assigned_user_id']:
+        check_assignee(board_id, task['assigned_user_id'], db)
+    revision = bump_board_revision(db, board_id)
+    new_task = Task(**task, board_id=board_id, revision=revision, rank=rank_for_position(Task, Task.stage_id, uuid.UUID(task['stage_id']), None, None, None, db))
     db.add(new_task)
-    db.commit()
-    db.refresh(new_task)
+    db.flush()
 
-    # After task creation we can access its ID to create the subtasks with the fkey task_id
-    subtasks_exist = len(subtasks) > 0
-    if subtasks_exist:
-        for subtask in subtasks:
-            create_new_subtask(subtask, db, new_task.id)
-
-        db.commit()
+    # After the flush we can access its ID to create the subtasks with the fkey task_id
+    insert_subtasks([subtask for subtask in subtasks if subtask.get('is_new')], db, new_task.id, board_id, revision)
+    record_change(db, board_id, 'task', 'created', [new_task.id])
+    db.commit()
 
-    return new_task
+    return TaskResponse.model_validate(load_task(new_task.id, db), from_attributes=True)
 
 
 @router.put("/{id}", response_model=TaskResponse)
-def update_task(id: UUID4, client_data: TaskUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_task(id: UUID4, client_data: TaskUpdate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, update_task_sync, id, client_data, current_user)
 
-    board = db.query(Board).filter(Board.id == client_data.board_id).first()
-    check_board_permission(board, current_user.id)
 
-    task_query = db.query(Task).filter(Task.id == id)
+def update_task_sync(db: Session, id: UUID4, client_data: TaskUpdate, current_user: Principal):
+    board_id = client_data.board_id
+    authorize_board(board_id, current_user.id, db)
+
+    # Tasks of other boards are not found, the authorized board is the one the task is on
+    task_query = db.query(Task).filter(Task.id == id, Task.board_id == board_id)
     task = task_query.first()
 
     if not task:
@@ -57,62 +70,121 @@ def update_task(id: UUID4, client_data: TaskUpdate, db: Session = Depends(get_db
     new_task_data = client_data.model_dump(exclude=['board_id'])
     subtasks: List[SubtaskCreate] = new_task_data.pop('subtasks')
 
-    task_query.update(new_task_data, synchronize_session=False)
-    update_subtasks(subtasks, db, task.id)
+    if new_task_data['assigned_user_id'] and new_task_data['assigned_user_id'] != str(task.assigned_user_id):
+        check_assignee(board_id, new_task_data['assigned_user_id'], db)
+
+    revision = record_change(db, board_id, 'task', 'updated', [task.id])
+
+    # A task that changes its stage here goes to the end of the new stage
+    if new_task_data['stage_id'] != str(task.stage_id):
+        check_stage_on_board(new_task_data['stage_id'], board_id, db)
+        new_task_data['rank'] = rank_for_position(Task, Task.stage_id, uuid.UUID(new_task_data['stage_id']), id, None, None, db)
+
+    task_query.update({**new_task_data, 'revision': revision}, synchronize_session=False)
+    update_subtasks(subtasks, db, task.id, board_id, revision)
     db.commit()
 
-    return task
+    return TaskResponse.model_validate(load_task(id, db), from_attributes=True)
 
 @router.patch("/stage/{id}",response_model=TaskResponse)
-def update_assigned_user(id: UUID4, client_data: TaskUpdateStage, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_task_stage(id: UUID4, client_data: TaskUpdateStage, background_tasks: BackgroundTasks,
+                            db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    task = await run_db(db, move_task_sync, id, TaskMove(stage_id=client_data.new_stage_id, after_id=client_data.after_id,
+                                                          before_id=client_data.before_id), current_user)
+    rebalancer.schedule(background_tasks, task.rank, rebalance_tasks, task.status.id)
 
-    task_query = db.query(Task).filter(Task.id == id)
-    task = task_query.first()
-    stage = db.query(Stage).filter(Stage.id == task.stage_id).first()
-    board = db.query(Board).filter(Board.id == stage.board_id).first()
+    return task
 
-    check_board_permission(board, current_user.id)
 
-    task_query.update({ "stage_id": client_data.new_stage_id })
-    db.commit()
+@router.patch("/{id}/move", response_model=TaskResponse)
+async def move_task(id: UUID4, client_data: TaskMove, background_tasks: BackgroundTasks,
+                    db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    task = await run_db(db, move_task_sync, id, client_data, current_user)
+    rebalancer.schedule(background_tasks, task.rank, rebalance_tasks, task.status.id)
 
     return task
 
 
+def move_task_sync(db: Session, id: UUID4, client_data: TaskMove, current_user: Principal):
+    (stage_id, board_id) = get_task_location(id, db)
+    authorize_board(board_id, current_user.id, db)
+
+    stage_id = client_data.stage_id or stage_id
+    check_stage_on_board(stage_id, board_id, db)
+
+    # Only the moved task is written
+    revision = record_change(db, board_id, 'task', 'moved', [id])
+    rank = rank_for_position(Task, Task.stage_id, stage_id, id, client_data.after_id, client_data.before_id, db)
+    db.execute(update(Task).where(Task.id == id).values(stage_id=stage_id, rank=rank, revision=revision).execution_options(synchronize_session=False))
+    db.commit()
+
+    return TaskResponse.model_validate(load_task(id, db), from_attributes=True)
+
+
 @router.patch("/assignment/{id}",response_model=TaskResponse)
-def update_assigned_user(id: UUID4, client_data: TaskUpdateAssignedUser, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_assigned_user(id: UUID4, client_data: TaskUpdateAssignedUser, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, update_assigned_user_sync, id, client_data, current_user)
 
-    task_query = db.query(Task).filter(Task.id == id)
-    task = task_query.first()
-    stage = db.query(Stage).filter(Stage.id == task.stage_id).first()
-    board = db.query(Board).filter(Board.id == stage.board_id).first()
 
-    check_board_permission(board, current_user.id)
-    check_board_permission(board, client_data.assigned_user_id)
+def update_assigned_user_sync(db: Session, id: UUID4, client_data: TaskUpdateAssignedUser, current_user: Principal):
+    board_id = get_task_board_id(id, db)
+    authorize_board(board_id, current_user.id, db)
+    check_assignee(board_id, client_data.assigned_user_id, db)
 
-    task_query.update({ 'assigned_user_id': client_data.assigned_user_id })
+    task_query = db.query(Task).filter(Task.id == id)
+    revision = record_change(db, board_id, 'task', 'updated', [id])
+    task_query.update({ 'assigned_user_id': client_data.assigned_user_id, 'revision': revision })
     db.commit()
 
-    return task
+    return TaskResponse.model_validate(load_task(id, db), from_attributes=True)
 
 
 @router.delete("/{id}", response_description="Task successfully deleted", response_model=TaskDeleteResponse)
-def delete_task(id: UUID4, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_task(id: UUID4, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return await run_db(db, delete_task_sync, id, current_user)
 
-    task_query = db.query(Task).filter(Task.id == id)
-    task = task_query.first()
-    stage = db.query(Stage).filter(Stage.id == task.stage_id).first()
-    board = db.query(Board).filter(Board.id == stage.board_id).first()
-    check_board_permission(board, current_user.id)
 
-    for subtask in task.subtasks:
-        delete_subtask(subtask, db)
+def delete_task_sync(db: Session, id: UUID4, current_user: Principal):
+    board_id = get_task_board_id(id, db)
+    authorize_board(board_id, current_user.id, db)
 
-    task_query.delete()
+    # Locks the board before the task row, in the same order as every other write to the board
+    revision = record_change(db, board_id, 'task', 'deleted', [id])
 
+    # Subtasks are deleted by the FK cascade
+    stage_id = db.execute(delete(Task).where(Task.id == id).returning(Task.stage_id).execution_options(synchronize_session=False)).scalar()
+
+    if not stage_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Task with id {id} not found")
+
+    record_tombstones(db, board_id, 'task', [id], revision)
     db.commit()
 
     return {
-        "board_id": board.id,
-        "stage_id": stage.id
+        "board_id": board_id,
+        "stage_id": stage_id
     }
+
+
+def get_task_board_id(id: UUID4, db: Session):
+    (stage_id, board_id) = get_task_location(id, db)
+
+    return board_id
+
+
+def get_task_location(id: UUID4, db: Session):
+    # The task knows its board, neither the stage nor the board has to be read to authorize
+    location = db.execute(select(Task.stage_id, Task.board_id).where(Task.id == id)).first()
+
+    if not location:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Task with id {id} not found")
+
+    return location
+
+
+def check_stage_on_board(stage_id: UUID4 | str, board_id: UUID4 | str, db: Session):
+    if not validate_uuid(stage_id) or str(db.execute(select(Stage.board_id).where(Stage.id == stage_id)).scalar()) != str(board_id):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Stage {stage_id} doesn't belong to this board")
@@ -0,0 +1,245 @@
+import logging
+import time
+import uuid
+from tempfile import SpooledTemporaryFile
+from typing import Dict
+
+from pydantic import UUID4, TypeAdapter, ValidationError
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from app import database
+from app.config import settings
+from app.database import copy_rows, get_db, run_db, run_in_session
+from app.models import Board, Stage, Subtask, Task
+from app.oauth2 import get_current_principal
+from app.schemas import BoardExportRecord, BoardImportReturn, BoardRecord, Principal, StageRecord, SubtaskRecord, TaskRecord
+from app.utils.validation import authorize_board
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/boards", tags=["Boards"])
+
+NDJSON = "application/x-ndjson"
+# Rows fetched from the server side cursor at a time
+EXPORT_BATCH_SIZE = 1000
+# Spooled rows move from memory to a temporary file beyond this size
+IMPORT_SPOOL_SIZE = 1 << 20
+IMPORT_MAX_LINE_BYTES = 1 << 20
+
+# Tables in the order they are loaded, parents before their children
+IMPORT_COLUMNS = {
+    "stages": ["id", "board_id", "title", "index", "color", "rank"],
+    "tasks": ["id", "board_id", "stage_id", "title", "description", "rank", "assigned_user_id"],
+    "subtasks": ["id", "board_id", "task_id", "title", "index", "is_completed"],
+}
+
+record_adapter = TypeAdapter(BoardExportRecord)
+
+
+@router.get("/{id}/export", response_class=StreamingResponse, responses={200: {"content": {NDJSON: {}}}})
+async def export_board(id: UUID4, current_user: Principal = Depends(get_current_principal)):
+    # The export holds its own connection while it streams, the permission check doesn't keep one for that long
+    await run_in_session(authorize_board_export, id, current_user.id)
+
+    return StreamingResponse(stream_board_export_async(id) if settings.database_async else stream_board_export(id), media_type=NDJSON,
+                             headers={"Content-Disposition": f'attachment; filename="board-{id}.ndjson"'})
+
+
+def authorize_board_export(db: Session, id: UUID4, user_id: UUID4):
+    authorize_board(id, user_id, db)
+
+
+def export_statements(board_id: UUID4):
+    return [
+        (BoardRecord, select(Board.title).where(Board.id == board_id, Board.deleted_at.is_(None))),
+        (StageRecord, select(Stage.id, Stage.title, Stage.index, Stage.color, Stage.rank)
+         .where(Stage.board_id == board_id).order_by(Stage.rank, Stage.id)),
+        (TaskRecord, select(Task.id, Task.stage_id, Task.title, Task.description, Task.rank, Task.assigned_user_id)
+         .where(Task.board_id == board_id).order_by(Task.stage_id, Task.rank, Task.id)),
+        (SubtaskRecord, select(Subtask.id, Subtask.task_id, Subtask.title, Subtask.index, Subtask.is_completed)
+         .where(Subtask.board_id == board_id).order_by(Subtask.task_id, Subtask.index)),
+    ]
+
+
+def serialize_records(record, rows):
+    return "".join(record.model_validate(row, from_attributes=True).model_dump_json() + "\n" for row in rows).encode()
+
+
+def stream_board_export(board_id: UUID4):
+    """
+    The board as NDJSON, read through server side cursors so memory doesn't grow with the board.
+    All statements read the same snapshot, a write committed during the export is either entirely in it or not at all.
+    """
+    with database.engine.connect() as connection:
+        connection.execution_options(isolation_level="REPEATABLE READ")
+        for (record, statement) in export_statements(board_id):
+            for rows in connection.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE)).partitions():
+                yield serialize_records(record, rows)
+
+
+async def stream_board_export_async(board_id: UUID4):
+    # Same as stream_board_export with the asyncpg engine
+    async with database.async_engine.connect() as connection:
+        await connection.execution_options(isolation_level="REPEATABLE READ")
+        for (record, statement) in export_statements(board_id):
+            result = await connection.stream(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+            async for rows in result.partitions():
+                yield serialize_records(record, rows)
+
+
+class BoardImport():
+    """
+    Validates a board export line by line while it is received and spools the rows for COPY,
+    memory only grows with the ids of the stages and tasks. Rows get new ids, the board is imported as a copy
+    owned by the importing user. Assignments to other users are dropped, they aren't members of the copy.
+    """
+
+    def __init__(self, user_id: UUID4):
+        self.user_id = user_id
+        self.board_id = uuid.uuid4()
+        self.title: str | None = None
+        self.stage_ids: Dict[UUID4, uuid.UUID] = {}
+        self.task_ids: Dict[UUID4, uuid.UUID] = {}
+        self.subtasks = 0
+        self.files = {table: SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE) for table in IMPORT_COLUMNS}
+        self._line_number = 0
+        self._pending = b""
+
+    @property
+    def rows(self):
+        return len(self.stage_ids) + len(self.task_ids) + self.subtasks
+
+    def feed(self, chunk: bytes):
+        lines = (self._pending + chunk).split(b"\n")
+        self._pending = lines.pop()
+
+        if len(self._pending) > IMPORT_MAX_LINE_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"Line {self._line_number + len(lines) + 1} is longer than {IMPORT_MAX_LINE_BYTES} bytes")
+
+        for line in lines:
+            self.add_line(line)
+
+    def finish(self):
+        self.add_line(self._pending)
+        self._pending = b""
+
+        if self.title is None:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="The export doesn't contain a board")
+
+        for file in self.files.values():
+            file.seek(0)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+    def add_line(self, line: bytes):
+        self._line_number += 1
+        if not line.strip():
+            return
+
+        try:
+            record = record_adapter.validate_json(line)
+        except ValidationError as e:
+            error = e.errors()[0]
+            raise self.invalid(f"{error['msg']} at {'.'.join(str(part) for part in error['loc'])}")
+
+        if (self.title is None) != isinstance(record, BoardRecord):
+            raise self.invalid("The board has to come first and only once")
+
+        if self.rows >= settings.board_import_max_rows:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"An import can hold at most {settings.board_import_max_rows} rows")
+
+        if isinstance(record, BoardRecord):
+            self.title = record.title
+
+        elif isinstance(record, StageRecord):
+            self.stage_ids[record.id] = self.new_id(record.id, self.stage_ids)
+            self.write("stages", [self.stage_ids[record.id], self.board_id, record.title, record.index, record.color, record.rank])
+
+        elif isinstance(record, TaskRecord):
+            if record.stage_id not in self.stage_ids:
+                raise self.invalid(f"Stage {record.stage_id} has to come before its tasks")
+            self.task_ids[record.id] = self.new_id(record.id, self.task_ids)
+            self.write("tasks", [self.task_ids[record.id], self.board_id, self.stage_ids[record.stage_id], record.title, record.description,
+                                 record.rank, self.user_id if record.assigned_user_id == self.user_id else None])
+
+        else:
+            if record.task_id not in self.task_ids:
+                raise self.invalid(f"Task {record.task_id} has to come before its subtasks")
+            self.subtasks += 1
+            self.write("subtasks", [uuid.uuid4(), self.board_id, self.task_ids[record.task_id], record.title, record.index, record.is_completed])
+
+    def new_id(self, id: UUID4, seen: Dict[UUID4, uuid.UUID]):
+        if id in seen:
+            raise self.invalid(f"Duplicate id {id}")
+        return uuid.uuid4()
+
+    def write(self, table: str, row: list):
+        self.files[table].write(("\t".join(copy_value(value) for value in row) + "\n").encode())
+
+    def invalid(self, reason: str):
+        return HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Line {self._line_number}: {reason}")
+
+
+def copy_value(value):
+    # The text format of COPY: tab separated, \N for NULL, backslashes and control characters escaped
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+@router.post("/import", status_code=status.HTTP_201_CREATED, response_model=BoardImportReturn)
+async def import_board(request: Request, response: Response, dry_run: bool = False,
+                       db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    """
+    Creates a board from the NDJSON of GET /boards/{id}/export. A dry run validates and loads
+    everything like an import and rolls back at the end.
+    """
+    started = time.perf_counter()
+    board_import = BoardImport(current_user.id)
+
+    try:
+        # Parsed on the thread pool, a large import would block the event loop otherwise
+        async for chunk in request.stream():
+            await run_in_threadpool(board_import.feed, chunk)
+        await run_in_threadpool(board_import.finish)
+
+        result = await run_db(db, import_board_sync, board_import, dry_run, started)
+    finally:
+        board_import.close()
+
+    if dry_run:
+        response.status_code = status.HTTP_200_OK
+
+    return result
+
+
+def import_board_sync(db: Session, board_import: BoardImport, dry_run: bool, started: float):
+    # The insert of the board starts the transaction the COPYs run in
+    db.add(Board(id=board_import.board_id, title=board_import.title, owner_id=board_import.user_id))
+    db.flush()
+    db.execute(text(f"SET LOCAL statement_timeout = {int(settings.board_import_statement_timeout_ms)}"))
+
+    for (table, columns) in IMPORT_COLUMNS.items():
+        copy_rows(db, table, columns, board_import.files[table])
+
+    if dry_run:
+        db.rollback()
+    else:
+        db.commit()
+
+    seconds = time.perf_counter() - started
+    rows = board_import.rows
+    logger.info("%s %s rows of board %s in %.3f seconds", "Checked" if dry_run else "Imported", rows, board_import.board_id, seconds)
+
+    return BoardImportReturn(board_id=None if dry_run else board_import.board_id, dry_run=dry_run, stages=len(board_import.stage_ids),
+                             tasks=len(board_import.task_ids), subtasks=board_import.subtasks, seconds=round(seconds, 3),
+                             rows_per_second=round(rows / seconds, 1) if seconds else float(rows))
@@ -1,24 +1,31 @@
-from operator import or_
+import math
+import uuid
 from typing import List
+from typing_extensions import Annotated
 from urllib.parse import unquote
-from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from fastapi.responses import JSONResponse
 from pydantic import UUID4
-from sqlalchemy import exc, func
-from sqlalchemy.orm import Session
-from app.oauth2 import create_access_token, get_current_user
-from app.database import get_db
-from app.schemas import UserContributingUpdate, UserCreate, UserInfoReturn, UserReturn
-from app.models import Board, User
-from app.utils.helpers import getFirstAndLastName, hash
-from app.utils.validation import get_board_from_db
+from sqlalchemy import case, delete, exc, exists, func, or_, select, tuple_
+from sqlalchemy.orm import Session, selectinload
+from app.oauth2 import create_access_token, get_current_principal, get_current_user, get_user_by_id, invalidate_principal, remember_tokens_valid_after
+from app.database import get_db, get_read_db, run_db
+from app.schemas import DeletionReturn, UserContributingUpdate, UserCreate, UserInfoReturn, UserReturn, Principal
+from app.config import settings
+from app.models import Board, Deletion, User, boards_users
+from app.utils.live import record_change
+from app.utils.helpers import getFirstAndLastName
+from app.utils.passwords import hash_password
+from app.utils.pagination import decode_cursor, encode_cursor
+from app.utils.reaper import reaper
+from app.utils.validation import authorize_board, get_board_from_db, invalidate_board_permissions, validate_uuid
 
 
 router = APIRouter(prefix="/users", tags=["Users"])
 
 
 @router.get("/current", response_model=UserInfoReturn)
-def get_current_user_data(current_user: User = Depends(get_current_user)):
+async def get_current_user_data(current_user: User = Depends(get_current_user)):
 
     if not current_user:
         raise HTTPException(
@@ -27,8 +34,9 @@ def get_current_user_data(current_user: User = Depends(get_current_user)):
     return current_user
 
 
-@router.get("/", response_model=List[UserReturn])
-def get_users(q: str | None = None, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+@router.get("/", response_model=List[UserReturn], responses={200: {"headers": {"X-Next-Cursor": {"description": "Pass as cursor to get the next page"}}}})
+async def get_users(response: Response, q: str | None = None, limit: Annotated[int, Query(ge=1, le=50)] = 20, cursor: str | None = None,
+                    exclude_board_id: UUID4 | None = None, db: Session = Depends(get_read_db), current_user: Principal = Depends(get_current_principal)):
 
     if not current_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
@@ -36,18 +44,60 @@ def get_users(q: str | None = None, db: Session = Depends(get_db), current_user:
     if not q:
         return JSONResponse(content=[])
 
-    query = unquote(q).lower()
+    query = unquote(q).strip().lower()
 
-    users = db.query(User).filter(User.id != current_user.id, or_(func.lower(User.first_name).startswith(
-        query), or_(func.lower(User.last_name).startswith(query), func.lower(User.email) == query))).all()
+    (users, next_cursor) = await run_db(db, get_users_sync, query, limit, cursor, exclude_board_id, current_user)
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
     return users
 
 
+def get_users_sync(db: Session, query: str, limit: int, cursor: str | None, exclude_board_id: UUID4 | None, current_user: Principal):
+    """
+    An exact email match comes first, then users whose first or last name starts with the query, then (with
+    settings.user_search_infix) users whose full name contains it. Every match is served from an index,
+    see the indexes on users in app/models.py.
+    """
+    first_name = func.lower(User.first_name)
+    last_name = func.lower(User.last_name)
+    email = func.lower(User.email)
+    is_prefix = or_(first_name.startswith(query, autoescape=True), last_name.startswith(query, autoescape=True))
+
+    matches = [email == query, is_prefix]
+    if settings.user_search_infix:
+        # Needs the trigram index, which is only created where pg_trgm is available
+        matches.append(func.lower(User.first_name + ' ' + func.coalesce(User.last_name, '')).contains(query, autoescape=True))
+
+    rank = case((email == query, 0), (is_prefix, 1), else_=2)
+    sort_key = (rank, first_name, func.coalesce(last_name, ''), User.id)
+
+    statement = select(User, *sort_key[:3]).where(User.id != current_user.id, User.deleted_at.is_(None), or_(*matches))
+
+    if exclude_board_id:
+        # Only members may see who is on a board
+        authorize_board(exclude_board_id, current_user.id, db)
+        statement = statement.where(~exists().where(boards_users.c.board_id == exclude_board_id, boards_users.c.user_id == User.id),
+                                    ~exists().where(Board.id == exclude_board_id, Board.owner_id == User.id))
+
+    if cursor:
+        (last_rank, last_first_name, last_last_name, last_id) = decode_cursor(cursor, 4)
+        if not validate_uuid(last_id):
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor")
+        statement = statement.where(tuple_(*sort_key) > tuple_(last_rank, last_first_name, last_last_name, uuid.UUID(str(last_id))))
+
+    rows = db.execute(statement.order_by(*sort_key).limit(limit + 1)).all()
+    page = rows[:limit]
+    next_cursor = encode_cursor([*page[-1][1:], page[-1][0].id]) if len(rows) > limit else None
+
+    return ([UserReturn.model_validate(row[0], from_attributes=True) for row in page], next_cursor)
+
+
 @router.get("/{id}", response_model=UserReturn)
-def get_user(id: UUID4, db: Session = Depends(get_db)):
+async def get_user(id: UUID4, db: Session = Depends(get_read_db)):
 
-    user = db.query(User).filter(User.id == id).first()
+    user = await run_db(db, get_user_by_id, id)
 
     print(user)
 
@@ -59,9 +109,22 @@ def get_user(id: UUID4, db: Session = Depends(get_db)):
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=UserReturn)
-def create_user(client_data: UserCreate, response: Response,  db: Session = Depends(get_db)):
+async def create_user(client_data: UserCreate, response: Response,  db: Session = Depends(get_db)):
 
     user_data = transform_client_data(client_data)
+    user_data["password"] = await hash_password(client_data.password)
+    new_user = await run_db(db, insert_user, user_data, client_data)
+    remember_tokens_valid_after(new_user)
+
+    access_token = create_access_token({"user_id": str(new_user.id)})
+
+    response.set_cookie(
+        key="access_token", value=f"Bearer {access_token}", httponly=True, secure=True, samesite='none')
+
+    return new_user
+
+
+def insert_user(db: Session, user_data: dict, client_data: UserCreate):
     new_user = User(**user_data)
 
     try:
@@ -80,36 +143,47 @@ def create_user(client_data: UserCreate, response: Response,  db: Session = Depe
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                                 detail="Database error, please check the server logs.")
 
-    access_token = create_access_token({"user_id": str(new_user.id)})
-
-    response.set_cookie(
-        key="access_token", value=f"Bearer {access_token}", httponly=True, secure=True, samesite='none')
-
     return new_user
 
 
 @router.put("/", status_code=status.HTTP_204_NO_CONTENT)
-def stop_contributing_to_board(client_data: UserContributingUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def stop_contributing_to_board(client_data: UserContributingUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    await run_db(db, stop_contributing_to_board_sync, client_data, current_user)
+
 
-    (board_query, board) = get_board_from_db(client_data.board_id, db, current_user)
+def stop_contributing_to_board_sync(db: Session, client_data: UserContributingUpdate, current_user: User):
+    (board_query, board) = get_board_from_db(client_data.board_id, db, current_user, selectinload(Board.contributors))
 
-    current_user.boards_contributing.remove(board)
+    board.contributors.remove(current_user)
+    invalidate_board_permissions(db, board.id, [current_user.id])
+    record_change(db, board.id, 'board', 'updated', [board.id])
 
     db.commit()
 
-@router.delete("/", status_code=status.HTTP_204_NO_CONTENT)
-def delete_user(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+@router.delete("/", status_code=status.HTTP_202_ACCEPTED, response_model=DeletionReturn)
+async def delete_user(response: Response, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    if not current_user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    # Read before the commit expires the user
+    user_id = current_user.id
+    deletion = await run_db(db, delete_user_sync, current_user)
+    invalidate_principal(user_id, math.inf)
+    reaper.wake()
+
+    response.headers["Location"] = f"/deletions/{deletion.id}"
+    return deletion
+
+
+def delete_user_sync(db: Session, current_user: User):
     unique_guest_user = db.query(User).filter(User.email == 'test@account.com').first()
 
-    if current_user.id == unique_guest_user.id:
+    if unique_guest_user and current_user.id == unique_guest_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="You can't delete the guest user.")
 
-    if not current_user:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
-    
     has_boards = db.query(Board).filter(
-        Board.owner_id == current_user.id).first()
+        Board.owner_id == current_user.id, Board.deleted_at.is_(None)).first()
 
     if has_boards:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
@@ -117,9 +191,21 @@ def delete_user(db: Session = Depends(get_db), current_user: User = Depends(get_
 
     # TODO Später wenn man User zu seinen Boards hinzufügen kann, soll der User bevor er seinen Account löscht für jedes seiner Boards einen neuen Owner festlegen!
 
-    db.query(User).filter(User.id == current_user.id).delete()
+    # The account is marked as deleted and can't sign in from here on, the reaper removes it in the background.
+    # Memberships are removed right away, the tokens of the account are revoked once the deletion is committed.
+    board_ids = db.execute(delete(boards_users).where(boards_users.c.user_id == current_user.id).returning(boards_users.c.board_id)).scalars().all()
+    for board_id in sorted(board_ids):
+        record_change(db, board_id, 'board', 'updated', [board_id])
+
+    db.query(User).filter(User.id == current_user.id).update({'deleted_at': func.now()}, synchronize_session=False)
+    invalidate_board_permissions(db, user_ids=[current_user.id])
+
+    deletion = Deletion(entity='user', target_id=current_user.id, requested_by=current_user.id)
+    db.add(deletion)
     db.commit()
 
+    return DeletionReturn.model_validate(deletion, from_attributes=True)
+
 
 def transform_client_data(data: UserCreate):
     (first_name, last_name) = getFirstAndLastName(data.user_name)
@@ -128,6 +214,5 @@ def transform_client_data(data: UserCreate):
     del user["user_name"]
     user["first_name"] = first_name
     user["last_name"] = last_name
-    user["password"] = hash(data.password)
 
     return user
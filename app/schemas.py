@@ -1,6 +1,11 @@
 from datetime import datetime
-from typing import List, Optional
-from pydantic import UUID4, BaseModel, EmailStr
+from typing import List, Literal, Optional, Union
+from typing_extensions import Annotated
+from pydantic import UUID4, BaseModel, EmailStr, Field
+
+
+# The alphabet of app/utils/ranks.py
+RANK_PATTERN = r"^[0-9a-z]+$"
 
 
 class User(BaseModel):
@@ -53,6 +58,12 @@ class NewUserPassword(Token):
 
 class TokenData(BaseModel):
     user_id: Optional[str] = None
+    # Unix timestamp, 0 for tokens issued before tokens had one
+    issued_at: float = 0
+
+
+class Principal(BaseModel):
+    id: UUID4
 
 
 class SubtaskCreate(BaseModel):
@@ -87,10 +98,26 @@ class TaskUpdate(TaskCreate):
     subtasks: List[SubtaskUpdate]
 
 
-class TaskUpdateStage(BaseModel):
+# Positions are given by neighbours: the moved row is placed after after_id and before before_id.
+# Either can be left out, without both it goes to the end of the list.
+class Position(BaseModel):
+    after_id: UUID4 | None = None
+    before_id: UUID4 | None = None
+
+
+class TaskUpdateStage(Position):
     new_stage_id: UUID4
 
 
+class TaskMove(Position):
+    # Stays in its stage if left out
+    stage_id: UUID4 | None = None
+
+
+class StageMove(Position):
+    pass
+
+
 class TaskUpdateAssignedUser(BaseModel):
     assigned_user_id: UUID4
 
@@ -102,6 +129,7 @@ class Status(BaseModel):
 
 class TaskResponse(TaskBase):
     id: UUID4
+    rank: str
     status: Status
     subtasks: List[SubtaskResponse]
     assigned_user: UserInfoReturn | None
@@ -131,6 +159,7 @@ class StageUpdate(StageCreate):
 
 class StageResponse(StageBase):
     id: UUID4
+    rank: str
     tasks: List[TaskResponse]
 
 
@@ -166,14 +195,188 @@ class BoardListReturn(BaseModel):
 
 class BoardDataReturn(BoardBase):
     id: UUID4
+    revision: int
     stages: List[StageResponse]
     owner: UserInfoReturn
     contributors: List[UserInfoReturn]
 
 
-class StageMigration(StageCreate):
-    tasks: List[TaskCreate]
+# Only the first tasks of the stage, the rest is paged through GET /stages/{id}/tasks starting at tasks_cursor
+class StagePageResponse(StageResponse):
+    tasks_cursor: str | None = None
+
+
+class BoardPageReturn(BoardDataReturn):
+    stages: List[StagePageResponse]
+
+
+class StageChange(StageBase):
+    id: UUID4
+    rank: str
+    revision: int
+
+
+class TaskChange(TaskBase):
+    id: UUID4
+    rank: str
+    stage_id: UUID4
+    assigned_user: UserInfoReturn | None
+    revision: int
+
+
+class SubtaskChange(SubtaskResponse):
+    revision: int
+
+
+class TombstoneReturn(BaseModel):
+    id: UUID4
+    entity: Literal['stage', 'task', 'subtask']
+    revision: int
+
+
+# Only the rows changed after the requested revision. Deleted stages and tasks take their children with them.
+# If the requested revision is too old to be synced, snapshot holds the full board and the lists are empty.
+class BoardChangesReturn(BoardBase):
+    revision: int
+    owner: UserInfoReturn
+    contributors: List[UserInfoReturn]
+    stages: List[StageChange] = []
+    tasks: List[TaskChange] = []
+    subtasks: List[SubtaskChange] = []
+    deleted: List[TombstoneReturn] = []
+    snapshot: BoardDataReturn | None = None
+
+
+class MoveTaskOperation(Position):
+    op: Literal['move_task']
+    task_id: UUID4
+    stage_id: UUID4 | None = None
+
+
+class AssignTaskOperation(BaseModel):
+    op: Literal['assign_task']
+    task_id: UUID4
+    assigned_user_id: UUID4 | None
+
+
+class EditTaskOperation(BaseModel):
+    op: Literal['edit_task']
+    task_id: UUID4
+    title: str | None = None
+    description: str | None = None
+
+
+class DeleteTaskOperation(BaseModel):
+    op: Literal['delete_task']
+    task_id: UUID4
+
+
+class ToggleSubtaskOperation(BaseModel):
+    op: Literal['toggle_subtask']
+    subtask_id: UUID4
+    # Toggles the current state if left out
+    is_completed: bool | None = None
+
+
+class MoveStageOperation(Position):
+    op: Literal['move_stage']
+    stage_id: UUID4
+
+
+class EditStageOperation(BaseModel):
+    op: Literal['edit_stage']
+    stage_id: UUID4
+    title: str | None = None
+    color: str | None = None
+
+
+BatchOperation = Annotated[Union[MoveTaskOperation, AssignTaskOperation, EditTaskOperation, DeleteTaskOperation,
+                                 ToggleSubtaskOperation, MoveStageOperation, EditStageOperation], Field(discriminator='op')]
+
+
+class BoardBatch(BaseModel):
+    operations: List[BatchOperation]
+
+
+class BatchOperationResult(BaseModel):
+    op: str
+    id: UUID4
+
+
+# All operations are applied in one transaction, the rows they touched are returned in their final state
+class BoardBatchReturn(BaseModel):
+    revision: int
+    results: List[BatchOperationResult]
+    stages: List[StageChange] = []
+    tasks: List[TaskChange] = []
+    subtasks: List[SubtaskChange] = []
+    deleted: List[TombstoneReturn] = []
+
+
+# Deleted boards and accounts are hidden right away and removed in the background, poll GET /deletions/{id} for the status
+class DeletionReturn(BaseModel):
+    id: UUID4
+    entity: Literal['board', 'user']
+    target_id: UUID4
+    status: Literal['pending', 'completed']
+    batches: int
+    created_at: datetime
+    completed_at: Optional[datetime]
+
+
+# HTML escaped text, the highlighted parts are wrapped in <mark></mark>
+class SubtaskSearchHit(BaseModel):
+    id: UUID4
+    title: str
+
+
+class TaskSearchHit(BaseModel):
+    id: UUID4
+    stage_id: UUID4
+    rank: float
+    title: str
+    description: str
+    # Only the subtasks that matched
+    subtasks: List[SubtaskSearchHit] = []
+
+
+# One line of a board export, see app/router/transfer.py. The board comes first, every row after its parent.
+class BoardRecord(BoardBase):
+    type: Literal['board'] = 'board'
+
+
+class StageRecord(StageBase):
+    type: Literal['stage'] = 'stage'
+    id: UUID4
+    rank: str = Field(pattern=RANK_PATTERN)
+
+
+class TaskRecord(TaskBase):
+    type: Literal['task'] = 'task'
+    id: UUID4
+    stage_id: UUID4
+    rank: str = Field(pattern=RANK_PATTERN)
+    assigned_user_id: UUID4 | None = None
+
+
+class SubtaskRecord(BaseModel):
+    type: Literal['subtask'] = 'subtask'
+    id: UUID4
+    task_id: UUID4
+    title: str
+    index: int
+    is_completed: bool
+
+
+BoardExportRecord = Annotated[Union[BoardRecord, StageRecord, TaskRecord, SubtaskRecord], Field(discriminator='type')]
+
 
-class BoardMigration(BoardBase):
-    user_id: UUID4
-    stages: List[StageMigration]
\ No newline at end of file
+class BoardImportReturn(BaseModel):
+    # None for a dry run, nothing was stored
+    board_id: UUID4 | None
+    dry_run: bool
+    stages: int
+    tasks: int
+    subtasks: int
+    seconds: float
+    rows_per_second: float
\ No newline at end of file
@@ -0,0 +1,213 @@
+import itertools
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, FrozenSet, Hashable, Tuple
+
+from pydantic import UUID4
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.utils.prometheus import CACHE_EVICTIONS, CACHE_REQUESTS
+
+
+def cache_counters(name: str):
+    # Bound once, looking up the labels on every get would cost more than the lookup itself
+    return (CACHE_REQUESTS.labels(name, "hit"), CACHE_REQUESTS.labels(name, "miss"), CACHE_EVICTIONS.labels(name))
+
+
+@dataclass(frozen=True)
+class BoardSnapshot:
+    revision: int
+    etag: str
+    body: bytes
+    member_ids: FrozenSet[str]
+    expires_at: float = field(compare=False)
+
+
+class BoardSnapshotCache():
+    """
+    In-process LRU/TTL cache of serialized board snapshots.
+
+    Every board has a revision that the mutating endpoints bump after they committed.
+    A snapshot is only served while it was stored under the current revision of its board.
+    Revisions are drawn from one process-wide counter, so a revision is never reused.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        (self._hits_counter, self._misses_counter, self._evictions_counter) = cache_counters(name)
+
+        # Random per process, so ETags handed out before a restart never match again
+        self._etag_prefix = secrets.token_hex(4)
+        self._counter = itertools.count(1)
+        self._floor = 0
+        self._revisions: OrderedDict[str, int] = OrderedDict()
+        self._snapshots: OrderedDict[str, BoardSnapshot] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def revision(self, board_id: UUID4) -> int:
+        with self._lock:
+            return self._revisions.get(str(board_id), self._floor)
+
+    def bump(self, board_id: UUID4) -> int:
+        key = str(board_id)
+        with self._lock:
+            revision = next(self._counter)
+            self._revisions[key] = revision
+            self._revisions.move_to_end(key)
+            self._snapshots.pop(key, None)
+
+            if len(self._revisions) > self.maxsize:
+                self._revisions.popitem(last=False)
+                # The pruned board falls back to the floor, which must be newer than anything still in flight
+                self._floor = next(self._counter)
+
+            return revision
+
+    def get(self, board_id: UUID4, revision: int) -> BoardSnapshot | None:
+        key = str(board_id)
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+
+            if snapshot and snapshot.expires_at <= time.monotonic():
+                del self._snapshots[key]
+                snapshot = None
+
+            if not snapshot or snapshot.revision != revision:
+                self.misses += 1
+                self._misses_counter.inc()
+                return None
+
+            self._snapshots.move_to_end(key)
+            self.hits += 1
+            self._hits_counter.inc()
+            return snapshot
+
+    def put(self, board_id: UUID4, revision: int, body: bytes, member_ids: FrozenSet[str]) -> BoardSnapshot:
+        key = str(board_id)
+        snapshot = BoardSnapshot(revision=revision,
+                                 etag=f'"{self._etag_prefix}-{revision}"',
+                                 body=body,
+                                 member_ids=member_ids,
+                                 expires_at=time.monotonic() + self.ttl)
+        with self._lock:
+            # A write committed while the snapshot was built, don't store outdated data
+            if self._revisions.get(key, self._floor) != revision:
+                return snapshot
+
+            self._snapshots[key] = snapshot
+            self._snapshots.move_to_end(key)
+
+            while len(self._snapshots) > self.maxsize:
+                self._snapshots.popitem(last=False)
+                self.evictions += 1
+                self._evictions_counter.inc()
+
+        return snapshot
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._snapshots),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class LRUCache():
+    """
+    Thread safe LRU cache where every entry expires at its own wall clock timestamp.
+    """
+
+    def __init__(self, name: str, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        (self._hits_counter, self._misses_counter, self._evictions_counter) = cache_counters(name)
+        self._entries: OrderedDict[Hashable, Tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+
+            if not entry:
+                self.misses += 1
+                self._misses_counter.inc()
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self._hits_counter.inc()
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, expires_at: float):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                self._evictions_counter.inc()
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_where(self, predicate: Callable[[Hashable, Any], bool]):
+        # Linear, only meant for rare invalidations
+        with self._lock:
+            for key in [key for key, (value, expires_at) in self._entries.items() if predicate(key, value)]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def etag_matches(if_none_match: str | None, etag: str):
+    if not if_none_match:
+        return False
+
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+board_cache = BoardSnapshotCache(name="board_snapshots", maxsize=settings.board_cache_size, ttl=settings.board_cache_ttl_seconds)
+
+
+def mark_board_changed(db: Session, board_id: UUID4):
+    # The revision is bumped once the transaction committed, never for a rollback
+    db.info.setdefault("changed_boards", set()).add(str(board_id))
+
+
+@event.listens_for(Session, "after_commit")
+def bump_changed_boards(session: Session):
+    for board_id in session.info.pop("changed_boards", ()):
+        board_cache.bump(board_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changed_boards(session: Session):
+    session.info.pop("changed_boards", None)
@@ -0,0 +1,72 @@
+from typing import List
+
+from pydantic import UUID4
+from sqlalchemy import delete, event, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, selectinload
+from app.config import settings
+from app.models import Board, Stage, Subtask, Task, Tombstone
+from app.utils.cache import mark_board_changed
+
+
+def bump_board_revision(db: Session, board_id: UUID4) -> int:
+    """
+    Returns the revision that every row written for this board in the current transaction is stamped with.
+    The board row stays locked until the transaction ends, so revisions of one board are committed in order.
+    """
+    revisions = db.info.setdefault("board_revisions", {})
+    key = str(board_id)
+
+    if key not in revisions:
+        revisions[key] = db.execute(update(Board)
+                                    .where(Board.id == board_id)
+                                    .values(revision=Board.revision + 1)
+                                    .returning(Board.revision)).scalar_one()
+        mark_board_changed(db, board_id)
+
+    return revisions[key]
+
+
+def record_tombstones(db: Session, board_id: UUID4, entity: str, ids: List[UUID4], revision: int):
+    if not ids:
+        return
+
+    # A row that was already deleted before keeps its first tombstone
+    db.execute(insert(Tombstone).on_conflict_do_nothing(), [{"id": id, "board_id": board_id, "entity": entity, "revision": revision}
+                                   for id in ids])
+    # Tombstones older than the retention window are never asked for, those clients get a full snapshot
+    db.execute(delete(Tombstone).where(Tombstone.board_id == board_id,
+                                       Tombstone.revision <= revision - settings.board_changes_retention))
+
+
+def is_revision_syncable(board: Board, since: int):
+    return board.revision - settings.board_changes_retention <= since <= board.revision
+
+
+def load_board_changes(board: Board, since: int, db: Session):
+    stages = db.query(Stage).filter(Stage.board_id == board.id, Stage.revision > since).all()
+
+    tasks = db.query(Task) \
+        .options(selectinload(Task.assigned_user)) \
+        .filter(Task.board_id == board.id, Task.revision > since).all()
+
+    subtasks = db.query(Subtask).filter(Subtask.board_id == board.id, Subtask.revision > since).all()
+
+    deleted = db.query(Tombstone).filter(Tombstone.board_id == board.id, Tombstone.revision > since).all()
+
+    return {
+        "revision": board.revision,
+        "title": board.title,
+        "owner": board.owner,
+        "contributors": board.contributors,
+        "stages": stages,
+        "tasks": tasks,
+        "subtasks": subtasks,
+        "deleted": deleted,
+    }
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def discard_board_revisions(session: Session):
+    session.info.pop("board_revisions", None)
@@ -1,6 +1,6 @@
 from fastapi.security import OAuth2
 from fastapi.openapi.models import OAuthFlows as OAuthFlowsModel
-from fastapi import Request
+from fastapi.requests import HTTPConnection
 from fastapi.security.utils import get_authorization_scheme_param
 from fastapi import HTTPException
 from fastapi import status
@@ -21,7 +21,8 @@ class OAuth2PasswordBearerWithCookie(OAuth2):
         flows = OAuthFlowsModel(password={"tokenUrl": tokenUrl, "scopes": scopes})
         super().__init__(flows=flows, scheme_name=scheme_name, auto_error=auto_error)
 
-    async def __call__(self, request: Request) -> Optional[str]:
+    # HTTPConnection instead of Request, so the scheme can authenticate WebSocket connections as well
+    async def __call__(self, request: HTTPConnection) -> Optional[str]:
         authorization: str = request.cookies.get("access_token")  #changed to accept access token from httpOnly Cookie
 
         scheme, param = get_authorization_scheme_param(authorization)
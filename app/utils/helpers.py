@@ -1,9 +1,14 @@
 from typing import List, TypeVar
+from app.config import settings
 from app.schemas import StageBase
 from .validation import validate_username
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes with more or less rounds than configured count as deprecated and are replaced by verify_and_update
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=settings.password_bcrypt_rounds,
+                           bcrypt__min_rounds=settings.password_bcrypt_rounds,
+                           bcrypt__max_rounds=settings.password_bcrypt_rounds)
 
 
 def getFirstAndLastName(name: str):
@@ -28,6 +33,11 @@ def verify(plain_password: str, hashed_password: str):
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def verify_and_update(plain_password: str, hashed_password: str):
+    # Returns (is_valid, new_hash), new_hash is only set if the stored hash was made with other settings
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
 def get_index(stage: StageBase):
     return stage.index
 
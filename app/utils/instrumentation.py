@@ -0,0 +1,158 @@
+import contextvars
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict
+
+import httpx
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+from app.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Expanded IN lists and multi-row VALUES differ by their number of parameters only, they count as the same statement
+PARAMETER_LIST = re.compile(r"\(\s*(?:%\(\w+\)s|\$\d+)(?:\s*,\s*(?:%\(\w+\)s|\$\d+))*\s*\)")
+SERVER_TIMING_DB = re.compile(r'\bdb;dur=([\d.]+);desc="(\d+) statements, (\d+) rows"')
+
+
+class RequestStats():
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.db_seconds = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement: str, rows: int, seconds: float):
+        self.statements += 1
+        self.rows += max(rows, 0)
+        self.db_seconds += seconds
+        self.shapes[PARAMETER_LIST.sub("(?)", statement)] += 1
+
+    def repeated(self):
+        # Statements run often enough with different parameters to be an N+1 pattern
+        return {shape: count for (shape, count) in self.shapes.items() if count >= settings.sql_repeated_statement_threshold}
+
+
+# Set by the middleware for the duration of a request. Requests are handled on the thread pool or in run_sync,
+# both run with a copy of the context, and the copy refers to the same RequestStats.
+request_stats: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar("request_stats", default=None)
+
+
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    # A connection runs one statement at a time, a failed statement is overwritten by the next one
+    conn.info["statement_started"] = time.perf_counter()
+
+
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.record(statement, cursor.rowcount, time.perf_counter() - conn.info["statement_started"])
+
+
+def instrument_engines():
+    # Every engine, the async engine runs its statements on a sync Engine as well
+    event.listen(Engine, "before_cursor_execute", start_statement)
+    event.listen(Engine, "after_cursor_execute", finish_statement)
+
+
+class SQLInstrumentationMiddleware():
+    """
+    Counts the statements, rows and database time of every HTTP request. They are sent in the Server-Timing
+    header and logged as one logfmt line per request once the response is complete. Statements that ran after
+    the response started, e.g. in background tasks, are only in the log line. Statement shapes repeated within
+    one request are logged as a warning, they are usually a relationship loaded row by row.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if settings.server_timing_header:
+                    MutableHeaders(scope=message).append("Server-Timing", server_timing(stats, time.perf_counter() - started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_stats.reset(token)
+            log_request(scope, status_code, stats, time.perf_counter() - started)
+
+
+def server_timing(stats: RequestStats, seconds: float):
+    return f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.statements} statements, {stats.rows} rows", app;dur={seconds * 1000:.2f}'
+
+
+def log_request(scope, status_code: int, stats: RequestStats, seconds: float):
+    # The route template instead of the path, like that the lines of an endpoint can be grouped
+    route = scope.get("route")
+    endpoint = f"{scope['method']} {route.path if route else scope['path']}"
+    repeated = stats.repeated()
+
+    logger.info('endpoint="%s" status=%s duration_ms=%.2f statements=%s db_ms=%.2f rows=%s repeated_statements=%s',
+                endpoint, status_code, seconds * 1000, stats.statements, stats.db_seconds * 1000, stats.rows, len(repeated))
+
+    for (shape, count) in repeated.items():
+        logger.warning('Possible N+1 in endpoint="%s": statement ran %s times: %s', endpoint, count, " ".join(shape.split())[:500])
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def statements_of(response: httpx.Response) -> int | None:
+    # Taken from the Server-Timing header, so it also works against a server running in another process
+    match = SERVER_TIMING_DB.search(response.headers.get("Server-Timing", ""))
+    return int(match.group(2)) if match else None
+
+
+def endpoint_of(app: FastAPI, request: httpx.Request) -> str | None:
+    for route in app.routes:
+        if isinstance(route, APIRoute) and request.method in route.methods and route.path_regex.match(request.url.path):
+            return f"{request.method} {route.path}"
+    return None
+
+
+@contextmanager
+def query_budget(client: httpx.Client, app: FastAPI, budgets: Dict[str, int]):
+    """
+    Fails a test once a request sent through client runs more statements than the budget of its endpoint,
+    e.g. {"GET /boards/{id}": 5}. Endpoints without a budget aren't checked.
+
+        with TestClient(app) as client, query_budget(client, app, {"GET /boards/{id}": 5}):
+            client.get(f"/boards/{id}")
+    """
+    def check_budget(response: httpx.Response):
+        endpoint = endpoint_of(app, response.request)
+        if endpoint not in budgets:
+            return
+
+        statements = statements_of(response)
+        if statements is None:
+            raise QueryBudgetExceeded(f"{endpoint} didn't report its statements, the Server-Timing header is missing")
+        if statements > budgets[endpoint]:
+            raise QueryBudgetExceeded(f"{endpoint} ran {statements} statements, its budget is {budgets[endpoint]}")
+
+    client.event_hooks["response"].append(check_budget)
+    try:
+        yield
+    finally:
+        client.event_hooks["response"].remove(check_budget)
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+from typing import Dict, List, Set
+
+from pydantic import UUID4
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.utils.changes import bump_board_revision
+
+
+class Subscription():
+    """
+    One live connection to a board. Events are buffered in a bounded queue,
+    a consumer that can't keep up is dropped and told to resync instead of growing the queue.
+    """
+
+    def __init__(self, board_id: str, loop: asyncio.AbstractEventLoop, maxsize: int):
+        self.board_id = board_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.is_dropped = False
+
+    # Always runs on the event loop of the connection
+    def offer(self, event: dict):
+        if self.is_dropped:
+            return
+
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.is_dropped = True
+            live_hub.unsubscribe(self)
+
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync", "board_id": self.board_id, "revision": event["revision"]})
+
+
+class BoardEventHub():
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, board_id: UUID4) -> Subscription:
+        subscription = Subscription(str(board_id), asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subscriptions.setdefault(subscription.board_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.board_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.board_id, None)
+
+    def publish(self, board_id: UUID4, event: dict):
+        # Publishing happens from the request threads, every subscription is handed the event on its own loop
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(str(board_id), ()))
+
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.offer, event)
+
+
+live_hub = BoardEventHub(queue_size=settings.live_queue_size)
+
+
+def record_change(db: Session, board_id: UUID4, entity: str, action: str, ids: List[UUID4]) -> int:
+    # Collected per transaction and published as one event per board once the transaction committed
+    revision = bump_board_revision(db, board_id)
+    board_event = db.info.setdefault("board_events", {}).setdefault(str(board_id), {
+        "type": "changed",
+        "board_id": str(board_id),
+        "revision": revision,
+        "changes": [],
+    })
+    board_event["changes"].append({"entity": entity, "action": action, "ids": [str(id) for id in ids]})
+
+    return revision
+
+
+@event.listens_for(Session, "after_commit")
+def publish_board_events(session: Session):
+    for board_id, board_event in session.info.pop("board_events", {}).items():
+        live_hub.publish(board_id, board_event)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_board_events(session: Session):
+    session.info.pop("board_events", None)
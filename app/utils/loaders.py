@@ -0,0 +1,92 @@
+from typing import Tuple
+
+from pydantic import UUID4
+from sqlalchemy import select, true, tuple_
+from sqlalchemy.orm import Session, joinedload, selectinload
+from app.models import Board, Stage, Task, User
+
+
+# Relationships never lazy load, every response shape has its loader here
+
+
+def task_response_options():
+    return (
+        joinedload(Task.status),
+        selectinload(Task.subtasks),
+        selectinload(Task.assigned_user),
+    )
+
+
+def stage_response_options():
+    # Task.status is populated from the stage through back_populates
+    return (
+        selectinload(Stage.tasks).options(
+            selectinload(Task.subtasks),
+            selectinload(Task.assigned_user),
+        ),
+    )
+
+
+def board_snapshot_options():
+    # One statement per level of the board tree, so the number of queries
+    # doesn't grow with the amount of stages, tasks or subtasks on the board.
+    return (
+        joinedload(Board.owner),
+        selectinload(Board.contributors),
+        selectinload(Board.stages).options(*stage_response_options()),
+    )
+
+
+def load_task(id: UUID4, db: Session):
+    return db.query(Task).options(*task_response_options()).filter(Task.id == id).first()
+
+
+def load_stage(id: UUID4, db: Session):
+    return db.query(Stage).options(*stage_response_options()).filter(Stage.id == id).first()
+
+
+# Tasks are paged in the order of the stage, by (rank, id), which is the index ix_tasks_stage_id_rank_id
+
+
+def load_task_page(stage_id: UUID4, after: Tuple[str, UUID4] | None, limit: int, db: Session):
+    query = db.query(Task).options(*task_response_options()).filter(Task.stage_id == stage_id)
+
+    if after:
+        query = query.filter(tuple_(Task.rank, Task.id) > tuple_(*after))
+
+    return query.order_by(Task.rank, Task.id).limit(limit).all()
+
+
+def load_first_tasks(board_id: UUID4, limit: int, db: Session):
+    # One statement for all stages of the board, each stage only reads its first tasks from the index.
+    # The stages have to be loaded into the session before, Task.status is taken from there.
+    stages = select(Stage.id).where(Stage.board_id == board_id).subquery("stages")
+    first = select(Task.id).where(Task.stage_id == stages.c.id).order_by(Task.rank, Task.id).limit(limit).lateral("first")
+
+    return db.query(Task) \
+        .options(selectinload(Task.subtasks), selectinload(Task.assigned_user)) \
+        .filter(Task.id.in_(select(first.c.id).select_from(stages).join(first, true()))) \
+        .order_by(Task.rank, Task.id).all()
+
+
+# Deleted boards are hidden until the reaper removed them, see app/utils/reaper.py
+
+
+def load_board_header(id: UUID4, db: Session):
+    # Only what a delta needs besides the changed rows, see app/utils/changes.py
+    return db.query(Board).options(joinedload(Board.owner), selectinload(Board.contributors)).filter(Board.id == id, Board.deleted_at.is_(None)).first()
+
+
+def load_board_outline(id: UUID4, db: Session):
+    # The stages without their tasks, see load_first_tasks
+    return db.query(Board).options(joinedload(Board.owner), selectinload(Board.contributors), selectinload(Board.stages)) \
+        .filter(Board.id == id, Board.deleted_at.is_(None)).first()
+
+
+def load_board_snapshot(id: UUID4, db: Session):
+    return db.query(Board).options(*board_snapshot_options()).filter(Board.id == id, Board.deleted_at.is_(None)).first()
+
+
+def load_user_boards(id: UUID4, db: Session):
+    return db.query(User).options(selectinload(User.own_boards.and_(Board.deleted_at.is_(None))),
+                                  selectinload(User.boards_contributing.and_(Board.deleted_at.is_(None)))).filter(User.id == id).first()
@@ -0,0 +1,32 @@
+import bisect
+import threading
+from typing import List, Sequence
+
+
+class Histogram():
+    """
+    Thread safe histogram with fixed upper bounds, the last bucket counts everything above the largest bound.
+    """
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds: List[float] = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        return {
+            "buckets": {**{str(bound): count for bound, count in zip(self.bounds, counts)}, "+Inf": counts[-1]},
+            "count": sum(counts),
+            "sum": total,
+        }
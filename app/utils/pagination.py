@@ -0,0 +1,25 @@
+import base64
+import json
+from typing import Any, List
+
+from fastapi import HTTPException, status
+
+
+# Keyset pagination: a cursor holds the sort key of the last row of a page, the next page continues after it.
+# Clients get it as an opaque string and hand it back unchanged.
+
+
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: str, length: int) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+
+    if not isinstance(values, list) or len(values) != length:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor")
+
+    return values
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+from app.config import settings
+from app.utils.helpers import hash, verify_and_update
+from app.utils.prometheus import PASSWORD_HASH_DURATION
+
+
+class PasswordHasher():
+    """
+    Runs bcrypt on a few dedicated threads instead of the request thread pool, so a burst of logins
+    can't stall the other endpoints. bcrypt releases the GIL while hashing, threads are enough.
+
+    Jobs beyond the workers plus the queue size are rejected right away with 503 and Retry-After,
+    a client waiting seconds in a queue for its login is worse off than one that retries.
+    """
+
+    def __init__(self, workers: int, queue_size: int, retry_after: int):
+        self.limit = workers + queue_size
+        self.retry_after = retry_after
+        self.pending = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self._lock = threading.Lock()
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.limit:
+                self.rejected += 1
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                    detail="Too many sign-ins at the moment, please try again shortly.",
+                                    headers={"Retry-After": str(self.retry_after)})
+            self.pending += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"pending": self.pending, "limit": self.limit, "rejected": self.rejected}
+
+
+password_hasher = PasswordHasher(workers=settings.password_hash_workers,
+                                 queue_size=settings.password_hash_queue_size,
+                                 retry_after=settings.password_hash_retry_after_seconds)
+
+
+def timed(fn, operation: str):
+    # Measured on the hasher thread, the time spent in the queue isn't part of it
+    histogram = PASSWORD_HASH_DURATION.labels(operation)
+
+    def run(*args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    return run
+
+
+timed_hash = timed(hash, "hash")
+timed_verify_and_update = timed(verify_and_update, "verify")
+
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.run(timed_hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str):
+    return await password_hasher.run(timed_verify_and_update, plain_password, hashed_password)
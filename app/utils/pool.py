@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from app.utils.metrics import Histogram
+from app.utils.prometheus import POOL_CHECKOUT_TIMEOUTS, POOL_CHECKOUT_WAIT, POOL_CONNECTIONS, POOL_MAX_CONNECTIONS
+
+
+# Upper bounds in milliseconds
+CHECKOUT_WAIT_BOUNDS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class PoolStats():
+    def __init__(self, name: str):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_ms = Histogram(CHECKOUT_WAIT_BOUNDS)
+        self._lock = threading.Lock()
+
+        self.wait_seconds = POOL_CHECKOUT_WAIT.labels(name)
+        self.timeouts_counter = POOL_CHECKOUT_TIMEOUTS.labels(name)
+        self.max_connections = POOL_MAX_CONNECTIONS.labels(name)
+        self.in_use = POOL_CONNECTIONS.labels(name, "in_use")
+        self.idle = POOL_CONNECTIONS.labels(name, "idle")
+
+    def record_checkout(self, started: float, timed_out: bool):
+        seconds = time.perf_counter() - started
+        self.wait_ms.observe(seconds * 1000)
+        self.wait_seconds.observe(seconds)
+        if timed_out:
+            self.timeouts_counter.inc()
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+
+    def record_connections(self, pool: "InstrumentedPoolMixin"):
+        self.in_use.set(pool.checkedout())
+        self.idle.set(pool.checkedin())
+
+
+class InstrumentedPoolMixin():
+    # Class level, so the stats survive Pool.recreate() which doesn't pass on custom arguments
+    stats: PoolStats
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats.max_connections.set(self.size() + self._max_overflow)
+
+    def connect(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.stats.record_checkout(started, timed_out)
+            self.stats.record_connections(self)
+
+    def _do_return_conn(self, record):
+        # Every connection goes back through here, the checkin event doesn't know its pool
+        super()._do_return_conn(record)
+        self.stats.record_connections(self)
+
+    def report(self):
+        return {
+            "pid": os.getpid(),
+            "size": self.size(),
+            "max_overflow": self._max_overflow,
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            # Negative while the pool hasn't opened all of its pool_size connections yet
+            "overflow": self.overflow(),
+            "checkouts": self.stats.checkouts,
+            "timeouts": self.stats.timeouts,
+            "checkout_wait_ms": self.stats.wait_ms.snapshot(),
+        }
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    stats = PoolStats("sync")
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    stats = PoolStats("async")
+
+
+class InstrumentedReplicaQueuePool(InstrumentedQueuePool):
+    stats = PoolStats("sync_replica")
+
+
+class InstrumentedAsyncReplicaQueuePool(InstrumentedAsyncQueuePool):
+    stats = PoolStats("async_replica")
@@ -0,0 +1,84 @@
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+
+# Set by the deployment before the workers start, prometheus_client reads it when it is imported.
+# Every worker writes its metrics to files in the directory and GET /metrics adds up the files of all workers.
+# The directory has to be emptied before the server starts, files of an earlier run would be counted as well.
+MULTIPROCESS_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# bcrypt takes tens to hundreds of milliseconds depending on its cost factor
+PASSWORD_HASH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2.5, 5)
+CHECKOUT_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Gauges of workers that exited are left out of the sum
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Duration of HTTP requests until the response is complete",
+                             ["method", "route", "status"])
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests being handled", multiprocess_mode="livesum")
+
+POOL_CONNECTIONS = Gauge("db_pool_connections", "Open database connections of the pools by state",
+                         ["pool", "state"], multiprocess_mode="livesum")
+POOL_MAX_CONNECTIONS = Gauge("db_pool_max_connections", "Pool size plus max overflow of the pools",
+                             ["pool"], multiprocess_mode="livesum")
+POOL_CHECKOUT_WAIT = Histogram("db_pool_checkout_wait_seconds", "Time waited for a connection from the pool",
+                               ["pool"], buckets=CHECKOUT_WAIT_BUCKETS)
+POOL_CHECKOUT_TIMEOUTS = Counter("db_pool_checkout_timeouts", "Checkouts that gave up after the pool timeout", ["pool"])
+
+PASSWORD_HASH_DURATION = Histogram("password_hash_duration_seconds", "Duration of bcrypt hashing and verification, without the queue",
+                                   ["operation"], buckets=PASSWORD_HASH_BUCKETS)
+JWT_DECODE_FAILURES = Counter("jwt_decode_failures", "Access tokens that were rejected", ["reason"])
+
+# The hit ratio of a cache is rate(cache_requests_total{result="hit"}) / rate(cache_requests_total)
+CACHE_REQUESTS = Counter("cache_requests", "Lookups of the in-process caches", ["cache", "result"])
+CACHE_EVICTIONS = Counter("cache_evictions", "Entries dropped from the in-process caches because they were full", ["cache"])
+
+
+class PrometheusMiddleware():
+    """
+    Observes the duration of every HTTP request by route template and status code, and counts the requests
+    in progress. Requests that didn't match a route share the route label "unmatched", so scanners
+    can't create a time series per path.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_PROGRESS.dec()
+            route = scope.get("route")
+            REQUEST_DURATION.labels(scope["method"], route.path if route else "unmatched", status_code).observe(time.perf_counter() - started)
+
+
+def render_metrics():
+    # Returns (body, content type) in the Prometheus text format
+    if MULTIPROCESS_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int):
+    # Removes the gauges of a worker that exits, its counters and histograms keep counting in the totals
+    if MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(pid)
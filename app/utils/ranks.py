@@ -0,0 +1,171 @@
+import string
+import threading
+from typing import List, Type
+
+from fastapi import BackgroundTasks, HTTPException, status
+from pydantic import UUID4
+from sqlalchemy import UUID, String, column, select, update, values
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import run_in_session
+from app.models import Stage, Task
+from app.utils.changes import bump_board_revision
+from app.utils.live import record_change
+
+
+# Stages and tasks are ordered by a string rank instead of a dense index. Moving a row computes a rank
+# between its new neighbours, so only the moved row is written. The rank columns use the "C" collation,
+# ranks compare by their bytes which matches the order of this alphabet.
+ALPHABET = string.digits + string.ascii_lowercase
+BASE = len(ALPHABET)
+
+
+def rank_between(lower: str | None, upper: str | None) -> str:
+    """
+    Returns a rank that sorts after `lower` and before `upper`, None stands for the start or end of the list.
+    Generated ranks never end in the lowest digit, so there is always room in front of every rank.
+    """
+    if lower is not None and upper is not None and lower >= upper:
+        raise ValueError(f"Rank {lower!r} doesn't sort before {upper!r}")
+
+    lower = lower or ""
+    rank = ""
+    position = 0
+
+    while True:
+        low = ALPHABET.index(lower[position]) if position < len(lower) else 0
+        high = ALPHABET.index(upper[position]) if upper is not None and position < len(upper) else BASE
+
+        if high - low > 1:
+            if position >= len(lower) and upper is not None:
+                # In front of the first rank, stay close to it so that prepending again still finds room
+                digit = high - 1
+            elif position < len(lower) and upper is None:
+                # Same for appending after the last rank
+                digit = low + 1
+            else:
+                digit = (low + high) // 2
+            return rank + ALPHABET[digit]
+
+        # No digit fits in between, keep the digit of `lower` and look at the next position.
+        # Once the digits differ, everything longer than `lower` already sorts before `upper`.
+        rank += ALPHABET[low]
+        if high != low:
+            upper = None
+        position += 1
+
+
+def spread_ranks(count: int) -> List[str]:
+    # Evenly spaced ranks of the same length, used for new lists and to rebalance long ranks
+    width = 1
+    while BASE ** width <= count:
+        width += 1
+
+    ranks = []
+    for position in range(1, count + 1):
+        value = position * BASE ** width // (count + 1)
+        digits = ""
+        for _ in range(width):
+            (value, digit) = divmod(value, BASE)
+            digits = ALPHABET[digit] + digits
+        ranks.append(digits.rstrip(ALPHABET[0]))
+
+    return ranks
+
+
+def rank_for_position(model: Type[Stage] | Type[Task], parent_column, parent_id: UUID4, moved_id: UUID4 | None,
+                      after_id: UUID4 | None, before_id: UUID4 | None, db: Session) -> str:
+    """
+    Rank for a row placed after the row `after_id` and before the row `before_id` of the same list,
+    either neighbour may be left out. Without any neighbour the row goes to the end of the list.
+    Callers lock the board first (see bump_board_revision), so the neighbours can't move in the meantime.
+    """
+    given = [id for id in (after_id, before_id) if id]
+    neighbours = {row.id: row for row in db.execute(select(model.id, model.rank, parent_column.label("parent_id"))
+                                                    .where(model.id.in_(given)))} if given else {}
+
+    for id in given:
+        if id == moved_id or id not in neighbours or neighbours[id].parent_id != parent_id:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f"{id} is not a valid neighbour in the target list")
+
+    others = select(model.rank).where(parent_column == parent_id, model.id != moved_id).limit(1)
+    lower = neighbours[after_id].rank if after_id else None
+    upper = neighbours[before_id].rank if before_id else None
+
+    if after_id:
+        # Directly behind after_id, even if the client's before_id isn't its direct successor anymore
+        successor = db.execute(others.where(model.rank > lower).order_by(model.rank)).scalar()
+        if successor is not None and (upper is None or successor < upper):
+            upper = successor
+    elif before_id:
+        lower = db.execute(others.where(model.rank < upper).order_by(model.rank.desc())).scalar()
+    else:
+        lower = db.execute(others.order_by(model.rank.desc())).scalar()
+
+    if lower is not None and upper is not None and lower >= upper:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="The neighbours are not in this order anymore, please reload the board")
+
+    return rank_between(lower, upper)
+
+
+class Rebalancer():
+    """
+    Respreads the ranks of one list once a move produced a rank longer than settings.rank_rebalance_length.
+    Runs after the response was sent, a list that is already scheduled isn't scheduled twice.
+    """
+
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def schedule(self, background_tasks: BackgroundTasks, rank: str, fn, parent_id: UUID4):
+        if len(rank) <= self.max_length:
+            return
+
+        with self._lock:
+            if parent_id in self._pending:
+                return
+            self._pending.add(parent_id)
+
+        background_tasks.add_task(self._run, fn, parent_id)
+
+    async def _run(self, fn, parent_id: UUID4):
+        try:
+            await run_in_session(fn, parent_id)
+        finally:
+            with self._lock:
+                self._pending.discard(parent_id)
+
+
+rebalancer = Rebalancer(max_length=settings.rank_rebalance_length)
+
+
+def rebalance_stages(db: Session, board_id: UUID4):
+    rebalance(db, Stage, Stage.board_id, board_id, board_id, 'stage')
+
+
+def rebalance_tasks(db: Session, stage_id: UUID4):
+    board_id = db.execute(select(Stage.board_id).where(Stage.id == stage_id)).scalar()
+
+    # The stage was deleted in the meantime
+    if board_id:
+        rebalance(db, Task, Task.stage_id, stage_id, board_id, 'task')
+
+
+def rebalance(db: Session, model: Type[Stage] | Type[Task], parent_column, parent_id: UUID4, board_id: UUID4, entity: str):
+    # The board row is locked first, like for every other write to the board, so no move can interleave
+    bump_board_revision(db, board_id)
+    ids = db.execute(select(model.id).where(parent_column == parent_id).order_by(model.rank, model.id)).scalars().all()
+
+    if ids:
+        revision = record_change(db, board_id, entity, 'updated', ids)
+        incoming = values(column('id', UUID(as_uuid=True)), column('rank', String), name='incoming').data(list(zip(ids, spread_ranks(len(ids)))))
+        db.execute(update(model)
+                   .where(model.id == incoming.c.id)
+                   .values(rank=incoming.c.rank, revision=revision)
+                   .execution_options(synchronize_session=False))
+
+    db.commit()
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from contextlib import suppress
+from typing import Dict, List, Tuple
+
+from pydantic import UUID4
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import run_in_session
+from app.models import Board, Deletion, Stage, Subtask, Task, Tombstone, User, boards_users
+from app.utils.live import record_change
+
+
+logger = logging.getLogger(__name__)
+
+
+class Reaper():
+    """
+    Removes deleted boards and accounts in the background, one bounded batch per transaction, so neither a
+    request nor a single transaction has to delete a whole board at once.
+
+    Every worker process runs a reaper on its event loop. A deletion is locked while a batch of it is removed,
+    the reapers of other workers skip it in the meantime. Deletions left over by a restart are picked up by the next poll.
+    """
+
+    def __init__(self, batch_size: int, interval: float):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._runs: Dict[asyncio.AbstractEventLoop, Tuple[asyncio.Task, asyncio.Event, asyncio.Event]] = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        (wakeup, stopping) = (asyncio.Event(), asyncio.Event())
+        with self._lock:
+            self._runs[asyncio.get_running_loop()] = (asyncio.create_task(self._run(wakeup, stopping)), wakeup, stopping)
+
+    async def stop(self):
+        with self._lock:
+            run = self._runs.pop(asyncio.get_running_loop(), None)
+
+        # A batch runs on a thread and can't be cancelled halfway, the reaper stops once the current batch is done
+        if run:
+            (task, wakeup, stopping) = run
+            stopping.set()
+            wakeup.set()
+            await task
+
+    def wake(self):
+        # Request handlers can run on other threads, every event belongs to the loop of its reaper
+        with self._lock:
+            for (loop, (task, wakeup, stopping)) in self._runs.items():
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(wakeup.set)
+
+    async def _run(self, wakeup: asyncio.Event, stopping: asyncio.Event):
+        while not stopping.is_set():
+            wakeup.clear()
+            try:
+                while not stopping.is_set() and await run_in_session(reap_next_batch, self.batch_size):
+                    pass
+            except Exception:
+                logger.exception("Reaping failed, retrying in %s seconds", self.interval)
+
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(wakeup.wait(), self.interval)
+
+
+reaper = Reaper(batch_size=settings.reaper_batch_size, interval=settings.reaper_interval_seconds)
+
+
+def reap_next_batch(db: Session, batch_size: int) -> bool:
+    # Returns False once no pending deletion is left that isn't already worked on by another reaper
+    deletion = db.execute(select(Deletion)
+                          .where(Deletion.status == 'pending')
+                          .order_by(Deletion.created_at)
+                          .limit(1)
+                          .with_for_update(skip_locked=True)).scalar()
+    if not deletion:
+        db.rollback()
+        return False
+
+    reap = reap_board if deletion.entity == 'board' else reap_user
+    is_done = reap(db, deletion.target_id, batch_size)
+
+    deletion.batches += 1
+    if is_done:
+        deletion.status = 'completed'
+        deletion.completed_at = func.now()
+
+    db.commit()
+    return True
+
+
+def reap_board(db: Session, board_id: UUID4, batch_size: int) -> bool:
+    # Children first, so each batch stays bounded. Subtasks are deleted before their tasks,
+    # otherwise the FK cascade would delete all subtasks of a task batch in the same statement.
+    for (model, ids) in [(Subtask, select(Subtask.id).where(Subtask.board_id == board_id)),
+                         (Task, select(Task.id).where(Task.board_id == board_id)),
+                         (Stage, select(Stage.id).where(Stage.board_id == board_id)),
+                         (Tombstone, select(Tombstone.id).where(Tombstone.board_id == board_id))]:
+        deleted = db.execute(delete(model)
+                             .where(model.id.in_(ids.limit(batch_size).scalar_subquery()))
+                             .execution_options(synchronize_session=False)).rowcount
+        if deleted:
+            return False
+
+    db.execute(delete(boards_users).where(boards_users.c.board_id == board_id))
+    db.execute(delete(Board).where(Board.id == board_id).execution_options(synchronize_session=False))
+    return True
+
+
+def reap_user(db: Session, user_id: UUID4, batch_size: int) -> bool:
+    # The boards of the user were deleted before the account (see delete_user), they have to be gone before the user row
+    board_id = db.execute(select(Board.id).where(Board.owner_id == user_id).limit(1)).scalar()
+    if board_id:
+        reap_board(db, board_id, batch_size)
+        return False
+
+    # Tasks on other boards are unassigned, their boards see that as a change
+    assigned = db.execute(select(Task.id, Task.board_id)
+                          .where(Task.assigned_user_id == user_id)
+                          .limit(batch_size)).all()
+    if assigned:
+        unassign_tasks(db, assigned)
+        return False
+
+    db.execute(delete(User).where(User.id == user_id).execution_options(synchronize_session=False))
+    return True
+
+
+def unassign_tasks(db: Session, assigned: List[Tuple[UUID4, UUID4]]):
+    tasks_by_board = defaultdict(list)
+    for (task_id, board_id) in assigned:
+        tasks_by_board[board_id].append(task_id)
+
+    # Boards are locked in a fixed order, like that two reapers can't deadlock on them
+    for (board_id, ids) in sorted(tasks_by_board.items()):
+        revision = record_change(db, board_id, 'task', 'updated', ids)
+        db.execute(update(Task)
+                   .where(Task.id.in_(ids))
+                   .values(assigned_user_id=None, revision=revision)
+                   .execution_options(synchronize_session=False))
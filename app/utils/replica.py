@@ -0,0 +1,43 @@
+from starlette.datastructures import MutableHeaders
+from app.config import settings
+from app.database import LSN_COOKIE, LSN_HEADER, written_lsn
+
+
+# Anything else counts as a write once it succeeded
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class ReadYourWritesMiddleware():
+    """
+    Hands a client that wrote the WAL position of the primary after its write, as cookie and header.
+    get_read_db sends the reads that come with it to the primary until the replica has replayed
+    that position. Only mounted with a replica configured, see app/main.py.
+
+    The position is read by run_db on the session of the handler right after it committed (see run_and_record_lsn),
+    requests that didn't commit anything, like a login, don't get one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            return await self.app(scope, receive, send)
+
+        written = {}
+
+        async def send_with_lsn(message):
+            if message["type"] == "http.response.start":
+                written["sent"] = True
+                if message["status"] < 400 and written.get("lsn"):
+                    lsn = written["lsn"]
+                    headers = MutableHeaders(scope=message)
+                    headers.append(LSN_HEADER, lsn)
+                    headers.append("Set-Cookie", f"{LSN_COOKIE}={lsn}; Max-Age={settings.database_replica_pin_seconds}; Path=/; HttpOnly; Secure; SameSite=none")
+            await send(message)
+
+        token = written_lsn.set(written)
+        try:
+            await self.app(scope, receive, send_with_lsn)
+        finally:
+            written_lsn.reset(token)
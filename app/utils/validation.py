@@ -1,9 +1,16 @@
+import time
 import uuid
+from typing import Iterable, Tuple
 from fastapi import HTTPException, status
 from pydantic import UUID4
 import regex as re
+from sqlalchemy import event, exists, or_, select
 from sqlalchemy.orm import Session
-from app.models import User, Board
+from app.config import settings
+from app.database import is_replica
+from app.models import User, Board, boards_users
+from app.schemas import Principal
+from app.utils.cache import LRUCache
 
 
 
@@ -24,27 +31,118 @@ def validate_uuid(val):
         return False
 
 
-def get_board_from_db(id: UUID4, db: Session, current_user: User):
+def get_board_from_db(id: UUID4, db: Session, current_user: User | Principal, *options):
+    # Only loads the board once the user is known to have access, pass loader options for relationships the caller needs
+    authorize_board(id, current_user.id, db)
+
     board_query = db.query(Board).filter(Board.id == id)
-    board = board_query.first()
+    board = board_query.options(*options).first()
 
-    check_board_permission(board, current_user.id)
+    if not board:
+        raise board_not_found(id)
 
     return (board_query, board)
 
 
 def check_board_permission(board: Board | None, user_id: UUID4):
+    # For boards that were loaded together with their contributors anyway
     if not board:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Couldn't find board with id {id}")
-
-    is_user_contributor = False
-    is_user_owner = board.owner_id == user_id
-
-    for user in board.contributors:
-        print(user.id)
-        print(user_id)
-        if user.id == user_id:
-            is_user_contributor = True
-    
-    if not is_user_contributor and not is_user_owner:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You don't have access to this board. Please contact the owner of this board if you wish access.")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Couldn't find the requested board")
+
+    if board.owner_id != user_id and not any(user.id == user_id for user in board.contributors):
+        raise no_board_access()
+
+
+def authorize_board(board_id: UUID4, user_id: UUID4, db: Session):
+    if not is_board_member(board_id, user_id, db):
+        raise no_board_access()
+
+
+def check_assignee(board_id: UUID4, user_id: UUID4 | str, db: Session):
+    # A task can only be assigned to a member of its board. That's a mistake in the request, not missing access of the caller.
+    if not validate_uuid(user_id) or not is_board_member(board_id, user_id, db):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="The assigned user is not a member of this board")
+
+
+def is_board_member(board_id: UUID4, user_id: UUID4, db: Session) -> bool:
+    key = (str(user_id), str(board_id))
+    is_member = permission_cache.get(key)
+
+    if is_member is None:
+        generation = permission_cache.generation
+        is_member = db.execute(select(or_(Board.owner_id == user_id,
+                                          exists().where(boards_users.c.board_id == Board.id,
+                                                         boards_users.c.user_id == user_id)))
+                               .where(Board.id == board_id, Board.deleted_at.is_(None))).scalar()
+
+        # No row at all, the board doesn't exist or was deleted. That isn't cached, it might just not be created yet.
+        if is_member is None:
+            raise board_not_found(board_id)
+
+        # A replica may not have replayed the latest membership change yet
+        if not is_replica(db):
+            permission_cache.put(key, is_member, generation)
+
+    return is_member
+
+
+def board_not_found(board_id: UUID4):
+    return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Couldn't find board with id {board_id}")
+
+
+def no_board_access():
+    return HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You don't have access to this board. Please contact the owner of this board if you wish access.")
+
+
+class PermissionCache(LRUCache):
+    """
+    Board memberships keyed by (user_id, board_id).
+
+    Every invalidation starts a new generation. A membership is only stored if no invalidation
+    happened since it was read, so a lookup racing with a membership change can't cache the old state.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        super().__init__(name, maxsize)
+        self.ttl = ttl
+        self.generation = 0
+
+    def put(self, key: Tuple[str, str], is_member: bool, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+        super().put(key, is_member, expires_at=time.time() + self.ttl)
+
+    def invalidate(self, user_id: str | None, board_id: str | None):
+        # None matches every user or board
+        with self._lock:
+            self.generation += 1
+        if user_id and board_id:
+            self.pop((user_id, board_id))
+        else:
+            self.pop_where(lambda key, is_member: user_id in (None, key[0]) and board_id in (None, key[1]))
+
+
+permission_cache = PermissionCache(name="permissions", maxsize=settings.permission_cache_size, ttl=settings.permission_cache_ttl_seconds)
+
+
+def invalidate_board_permissions(db: Session, board_id: UUID4 | None = None, user_ids: Iterable[UUID4] | None = None):
+    # Dropped from the cache once the transaction committed, leave out board_id or user_ids to match all of them
+    changes = db.info.setdefault("permission_changes", set())
+    board_key = str(board_id) if board_id else None
+
+    if user_ids is None:
+        changes.add((None, board_key))
+    else:
+        changes.update((str(user_id), board_key) for user_id in user_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def drop_changed_permissions(session: Session):
+    for (user_id, board_id) in session.info.pop("permission_changes", ()):
+        permission_cache.invalidate(user_id, board_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changed_permissions(session: Session):
+    session.info.pop("permission_changes", None)
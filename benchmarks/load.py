@@ -0,0 +1,301 @@
+"""
+Load test of the endpoints used while working on a board.
+
+Seeds the database configured in the environment with synthetic users and boards, then drives the app
+with a fixed number of concurrent virtual users. Each of them logs in once and then repeats a round of
+board load, task create, task move, subtask toggle, user search and task delete. Created tasks are deleted
+again, so repeated runs see boards of the same size. Point it at a development database:
+
+    python -m benchmarks.load --users 1000 --boards 200 --concurrency 20 --rounds 25 --output before.json
+    python -m benchmarks.load --users 1000 --boards 200 --concurrency 20 --rounds 25 --compare before.json
+
+Per endpoint it reports p50/p95/p99 latency, throughput and the SQL statements per request, as a table
+and as JSON. The statements are taken from the Server-Timing header, see app/utils/instrumentation.py.
+The app runs in-process by default, with --url it drives a running server that uses the same database.
+
+The seeded rows are reused as long as their shape matches the options, otherwise they are replaced.
+Runs are only comparable with the same options and seed.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import httpx
+from sqlalchemy import text
+
+from app.config import settings
+from app.database import SessionLocal, engine
+from app.utils.helpers import hash
+from app.utils.instrumentation import statements_of
+
+
+PASSWORD = "load"
+
+SEED = [
+    """
+    INSERT INTO users (id, first_name, last_name, email, password)
+    SELECT gen_random_uuid(), 'Load', 'User' || i, 'user' || i || '@load.example', :password
+    FROM generate_series(1, :users) AS i
+    """,
+    # User i owns board i and is a contributor of every board b with b = i modulo the number of boards
+    """
+    INSERT INTO boards (id, title, owner_id)
+    SELECT gen_random_uuid(), 'Load board', users.id
+    FROM generate_series(1, :boards) AS i JOIN users ON users.email = 'user' || i || '@load.example'
+    """,
+    """
+    INSERT INTO boards_users (board_id, user_id)
+    SELECT boards.id, users.id
+    FROM generate_series(1, :users) AS i
+    JOIN users ON users.email = 'user' || i || '@load.example'
+    JOIN users AS owners ON owners.email = 'user' || ((i - 1) % :boards + 1) || '@load.example'
+    JOIN boards ON boards.owner_id = owners.id AND boards.title = 'Load board'
+    WHERE i > :boards
+    """,
+    """
+    INSERT INTO stages (id, title, index, color, board_id, rank)
+    SELECT gen_random_uuid(), 'Stage ' || i, i, 'grey', boards.id, lpad(i::text, 4, '0') || 'i'
+    FROM boards CROSS JOIN generate_series(1, :stages) AS i WHERE boards.title = 'Load board'
+    """,
+    """
+    INSERT INTO tasks (id, board_id, stage_id, title, description, rank)
+    SELECT gen_random_uuid(), stages.board_id, stages.id, 'Task ' || i, 'Description of task ' || i, lpad(i::text, 6, '0') || 'i'
+    FROM stages JOIN boards ON boards.id = stages.board_id CROSS JOIN generate_series(1, :tasks) AS i
+    WHERE boards.title = 'Load board'
+    """,
+    """
+    INSERT INTO subtasks (id, board_id, task_id, title, index, is_completed)
+    SELECT gen_random_uuid(), tasks.board_id, tasks.id, 'Subtask ' || i, i, i % 2 = 0
+    FROM tasks JOIN boards ON boards.id = tasks.board_id CROSS JOIN generate_series(1, :subtasks) AS i
+    WHERE boards.title = 'Load board'
+    """,
+]
+
+SHAPE = """
+    SELECT (SELECT count(*) FROM users WHERE email LIKE '%@load.example') AS users,
+           (SELECT count(*) FROM boards WHERE title = 'Load board') AS boards,
+           (SELECT count(*) FROM stages JOIN boards ON boards.id = stages.board_id WHERE boards.title = 'Load board') AS stages,
+           (SELECT count(*) FROM tasks JOIN boards ON boards.id = tasks.board_id WHERE boards.title = 'Load board') AS tasks,
+           (SELECT count(*) FROM subtasks JOIN boards ON boards.id = subtasks.board_id WHERE boards.title = 'Load board') AS subtasks
+"""
+
+CLEAR = [
+    "DELETE FROM boards_users WHERE board_id IN (SELECT id FROM boards WHERE title = 'Load board')",
+    # Stages, tasks and subtasks go with their board through the FK cascades
+    "DELETE FROM boards WHERE title = 'Load board'",
+    "DELETE FROM users WHERE email LIKE '%@load.example'",
+]
+
+
+def seed(args):
+    expected = {"users": args.users, "boards": args.boards, "stages": args.boards * args.stages,
+                "tasks": args.boards * args.stages * args.tasks, "subtasks": args.boards * args.stages * args.tasks * args.subtasks}
+
+    with SessionLocal() as db:
+        if dict(db.execute(text(SHAPE)).mappings().one()) == expected:
+            return
+
+        print(f"Seeding {args.users} users and {args.boards} boards of {args.stages} stages with {args.tasks} tasks "
+              f"of {args.subtasks} subtasks ...", file=sys.stderr)
+        for statement in CLEAR:
+            db.execute(text(statement))
+        # All users share one hash, hashing a password per user would take minutes
+        parameters = {**vars(args), "password": hash(PASSWORD)}
+        for statement in SEED:
+            db.execute(text(statement), parameters)
+        db.commit()
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ANALYZE"))
+
+
+class Recorder():
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+
+        self.samples[endpoint].append((time.perf_counter() - start, response.is_success, statements_of(response)))
+        return response
+
+
+def percentile(values, q: float):
+    # Nearest rank, values have to be sorted
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+
+def summarize(recorder: Recorder, seconds: float):
+    endpoints = {}
+    for (endpoint, samples) in sorted(recorder.samples.items()):
+        latencies = sorted(latency * 1000 for (latency, is_success, statements) in samples)
+        # None if the server doesn't send Server-Timing
+        statements = [statements for (latency, is_success, statements) in samples if statements is not None]
+        endpoints[endpoint] = {
+            "requests": len(samples),
+            "errors": sum(1 for (latency, is_success, statements) in samples if not is_success),
+            "throughput": round(len(samples) / seconds, 2),
+            "mean_ms": round(sum(latencies) / len(latencies), 2),
+            "p50_ms": round(percentile(latencies, 0.50), 2),
+            "p95_ms": round(percentile(latencies, 0.95), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "statements_per_request": round(sum(statements) / len(statements), 2) if statements else None,
+            "statements_max": max(statements) if statements else None,
+        }
+    return endpoints
+
+
+async def log_in(number: int, args, client: httpx.AsyncClient, recorder: Recorder):
+    user = number % args.users + 1
+    response = await recorder.request(client, "POST /login", "POST", "/login", data={"username": f"user{user}@load.example", "password": PASSWORD})
+    response.raise_for_status()
+
+    boards = (await client.get("/boards/")).json()
+    return (boards["own_boards"] or boards["contributing"])[0]["id"]
+
+
+async def work(number: int, args, client: httpx.AsyncClient, recorder: Recorder, board_id: str, rounds: range):
+    for round in rounds:
+        # The same choices in every run, only the interleaving of the virtual users differs
+        rng = random.Random(f"{args.seed}-{number}-{round}")
+
+        board = (await recorder.request(client, "GET /boards/{id}", "GET", f"/boards/{board_id}")).json()
+        stages = [stage["id"] for stage in board["stages"]]
+
+        response = await recorder.request(client, "POST /tasks/", "POST", "/tasks/", json={
+            "title": f"Load {number}-{round}", "description": "Created by the load test", "board_id": board_id,
+            "stage_id": rng.choice(stages), "assigned_user_id": None,
+            "subtasks": [{"title": f"Subtask {i}", "index": i, "is_completed": False, "is_new": True} for i in range(args.subtasks)],
+        })
+        if not response.is_success:
+            continue
+        task = response.json()
+
+        await recorder.request(client, "PATCH /tasks/{id}/move", "PATCH", f"/tasks/{task['id']}/move", json={"stage_id": rng.choice(stages)})
+        if task["subtasks"]:
+            await recorder.request(client, "PUT /subtasks/{id}", "PUT", f"/subtasks/{rng.choice(task['subtasks'])['id']}")
+        await recorder.request(client, "GET /users/", "GET", "/users/", params={"q": f"user{rng.randint(1, args.users)}", "exclude_board_id": board_id})
+        # Keeps the boards at the seeded size for the next run
+        await recorder.request(client, "DELETE /tasks/{id}", "DELETE", f"/tasks/{task['id']}")
+
+
+async def timed(recorder: Recorder, workers):
+    start = time.perf_counter()
+    results = await asyncio.gather(*workers)
+    seconds = time.perf_counter() - start
+    return (summarize(recorder, seconds), results, seconds)
+
+
+async def run(args):
+    from app.main import app
+
+    if args.url:
+        clients = [httpx.AsyncClient(base_url=args.url, timeout=60) for _ in range(args.concurrency)]
+    else:
+        await app.router.startup()
+        transport = httpx.ASGITransport(app=app)
+        clients = [httpx.AsyncClient(transport=transport, base_url="https://testserver", timeout=60) for _ in range(args.concurrency)]
+
+    try:
+        # Every virtual user logs in once, then all of them warm up before the recorded rounds start together
+        recorder = Recorder()
+        (logins, board_ids, seconds) = await timed(recorder, [log_in(number, args, client, recorder) for (number, client) in enumerate(clients)])
+
+        warmup = Recorder()
+        await asyncio.gather(*[work(number, args, client, warmup, board_ids[number], range(args.warmup)) for (number, client) in enumerate(clients)])
+
+        recorder = Recorder()
+        (endpoints, _, seconds) = await timed(recorder, [work(number, args, client, recorder, board_ids[number], range(args.warmup, args.warmup + args.rounds))
+                                                         for (number, client) in enumerate(clients)])
+    finally:
+        for client in clients:
+            await client.aclose()
+        if not args.url:
+            await app.router.shutdown()
+
+    return ({**logins, **endpoints}, seconds)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(endpoints: dict, baseline: dict | None):
+    print(f"{'endpoint':<24} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'statements':>10}")
+    for (endpoint, result) in endpoints.items():
+        statements = f"{result['statements_per_request']:.1f}" if result["statements_per_request"] is not None else "-"
+        print(f"{endpoint:<24} {result['requests']:>8} {result['errors']:>6} {result['throughput']:>8.1f} "
+              f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f} {statements:>10}")
+
+        previous = (baseline or {}).get(endpoint)
+        if previous:
+            change = lambda key: f"{(result[key] - previous[key]) / previous[key] * 100:+.0f}%" if previous[key] else "-"
+            statements = f"{result['statements_per_request'] - previous['statements_per_request']:+.1f}" \
+                if result["statements_per_request"] is not None and previous["statements_per_request"] is not None else "-"
+            print(f"{'  vs baseline':<24} {'':>8} {'':>6} {change('throughput'):>8} "
+                  f"{change('p50_ms'):>8} {change('p95_ms'):>8} {change('p99_ms'):>8} {statements:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="Synthetic users, at least as many as boards")
+    parser.add_argument("--boards", type=int, default=200, help="Synthetic boards")
+    parser.add_argument("--stages", type=int, default=5, help="Stages per board")
+    parser.add_argument("--tasks", type=int, default=20, help="Tasks per stage")
+    parser.add_argument("--subtasks", type=int, default=3, help="Subtasks per task, also used for the created tasks")
+    parser.add_argument("--concurrency", type=int, default=10, help="Virtual users sending requests at the same time")
+    parser.add_argument("--rounds", type=int, default=20, help="Recorded rounds per virtual user")
+    parser.add_argument("--warmup", type=int, default=2, help="Rounds per virtual user before the recording starts")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the random choices of the virtual users")
+    parser.add_argument("--url", help="Drive a running server instead of the app in-process")
+    parser.add_argument("--output", help="Write the results as JSON to this file instead of stdout")
+    parser.add_argument("--compare", help="Results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    if args.users < args.boards:
+        parser.error("--users has to be at least --boards, every board needs its own owner")
+
+    seed(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["endpoints"]
+
+    (endpoints, seconds) = asyncio.run(run(args))
+
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "options": {key: value for (key, value) in vars(args).items() if key not in ("output", "compare")},
+        "database_async": settings.database_async,
+        "seconds": round(seconds, 2),
+        "requests": sum(result["requests"] for (endpoint, result) in endpoints.items() if endpoint != "POST /login"),
+        "endpoints": endpoints,
+    }
+    results["throughput"] = round(results["requests"] / seconds, 2)
+
+    print_table(endpoints, baseline)
+    print(f"\n{results['requests']} requests in {results['seconds']} seconds, {results['throughput']} requests per second", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    sys.exit(1 if any(result["errors"] for result in endpoints.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
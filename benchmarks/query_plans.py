@@ -0,0 +1,311 @@
+"""
+Query plan check for the statements the routers issue.
+
+Fills the database configured in the environment with synthetic boards until the tables are large, runs a
+session of requests against the app in-process and EXPLAINs every statement right before it is executed.
+Exits with status 1 if any plan scans a large table sequentially, point it at a development database:
+
+    python -m benchmarks.query_plans --boards 5000
+
+Every endpoint also has a budget of statements it may run, see QUERY_BUDGETS. A request over its budget
+fails the check right away. The board reads are also run at growing board sizes, see BOARD_SIZES, and
+fail the check if their number of statements grows with the number of tasks and subtasks.
+
+The synthetic data is left behind and reused by later runs, every board has 5 stages with 8 tasks
+of 2 subtasks each. Postgres also runs lookups for the foreign keys when a referenced row is deleted,
+those aren't visible in any plan of the app and are checked separately.
+"""
+import argparse
+import json
+import sys
+import uuid
+from contextlib import contextmanager
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+
+from app.database import SessionLocal, engine
+from app.main import app
+from app.utils.instrumentation import query_budget, statements_of
+
+
+# What Postgres runs per deleted row to find the rows referencing it, one for every foreign key
+FOREIGN_KEY_LOOKUPS = [
+    ("boards.owner_id", "SELECT 1 FROM boards WHERE owner_id = :id"),
+    ("boards_users.user_id", "SELECT 1 FROM boards_users WHERE user_id = :id"),
+    ("boards_users.board_id", "SELECT 1 FROM boards_users WHERE board_id = :id"),
+    ("stages.board_id", "SELECT 1 FROM stages WHERE board_id = :id"),
+    ("tasks.board_id, tasks.stage_id", "SELECT 1 FROM tasks WHERE board_id = :id AND stage_id = :id"),
+    ("tasks.assigned_user_id", "SELECT 1 FROM tasks WHERE assigned_user_id = :id"),
+    ("subtasks.board_id, subtasks.task_id", "SELECT 1 FROM subtasks WHERE board_id = :id AND task_id = :id"),
+    ("tombstones.board_id", "SELECT 1 FROM tombstones WHERE board_id = :id"),
+]
+
+# Defaults of --boards and --min-rows
+SEED_BOARDS = 5000
+MIN_ROWS = 1000
+
+# Statements per request with a cold permission cache and assigned tasks. Lower them when an endpoint gets cheaper.
+QUERY_BUDGETS = {
+    "POST /users/": 2,
+    "GET /users/": 1,
+    "GET /users/{id}": 1,
+    "GET /boards/": 3,
+    "POST /boards/": 9,
+    "GET /boards/{id}": 6,
+    "PUT /boards/{id}": 16,
+    "DELETE /boards/{id}": 5,
+    "GET /boards/{id}/changes": 7,
+    "GET /boards/{id}/search": 3,
+    "POST /boards/{id}/batch": 14,
+    "GET /stages/{id}/tasks": 4,
+    "PATCH /stages/{id}/move": 9,
+    "POST /tasks/": 10,
+    "PUT /tasks/{id}": 6,
+    "DELETE /tasks/{id}": 6,
+    "PATCH /tasks/{id}/move": 8,
+    "PATCH /tasks/stage/{id}": 8,
+    "PATCH /tasks/assignment/{id}": 7,
+    "PUT /subtasks/{id}": 3,
+}
+
+# (tasks, subtasks per task) of the board the reads are repeated with, the statements must not change between them.
+# Even the smallest board has an assigned task and a subtask, loaders skip their statement when there is nothing to load.
+BOARD_SIZES = [(1, 1), (10, 3), (40, 5)]
+
+SEED = [
+    """
+    INSERT INTO users (id, first_name, last_name, email, password)
+    SELECT gen_random_uuid(), 'Seed', 'User' || i, gen_random_uuid() || '@seed.example', '-'
+    FROM generate_series(1, :boards * 2) AS i
+    """,
+    """
+    INSERT INTO boards (id, title, owner_id)
+    SELECT gen_random_uuid(), 'Seed board', id FROM users WHERE email LIKE '%@seed.example' ORDER BY random() LIMIT :boards
+    """,
+    """
+    INSERT INTO boards_users (board_id, user_id)
+    SELECT boards.id, users.id
+    FROM (SELECT id, row_number() OVER () AS i FROM boards WHERE title = 'Seed board') AS boards
+    JOIN (SELECT id, row_number() OVER () AS i FROM users WHERE email LIKE '%@seed.example') AS users ON users.i % :boards = boards.i % :boards
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO stages (id, title, index, color, board_id, rank)
+    SELECT gen_random_uuid(), 'Stage ' || i, i, 'grey', boards.id, i::text
+    FROM boards CROSS JOIN generate_series(1, 5) AS i WHERE boards.title = 'Seed board'
+    """,
+    """
+    INSERT INTO tasks (id, board_id, stage_id, title, description, assigned_user_id, rank)
+    SELECT gen_random_uuid(), boards.id, stages.id, 'Task ' || i, '', CASE WHEN i % 2 = 0 THEN boards.owner_id END, i::text
+    FROM stages JOIN boards ON boards.id = stages.board_id CROSS JOIN generate_series(1, 8) AS i
+    WHERE boards.title = 'Seed board'
+    """,
+    """
+    INSERT INTO subtasks (id, board_id, task_id, title, index, is_completed)
+    SELECT gen_random_uuid(), boards.id, tasks.id, 'Subtask ' || i, i, i = 1
+    FROM tasks JOIN boards ON boards.id = tasks.board_id
+    CROSS JOIN generate_series(1, 2) AS i
+    WHERE boards.title = 'Seed board'
+    """,
+]
+
+
+def seed(boards: int):
+    with SessionLocal() as db:
+        if db.execute(text("SELECT 1 FROM boards WHERE title = 'Seed board' LIMIT 1")).scalar():
+            return
+
+        print(f"Seeding {boards} boards ...")
+        for statement in SEED:
+            db.execute(text(statement), {"boards": boards})
+        db.commit()
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ANALYZE"))
+
+
+def large_tables(min_rows: int):
+    with SessionLocal() as db:
+        return set(db.execute(text("SELECT relname FROM pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace "
+                                   "AND reltuples >= :min_rows"), {"min_rows": min_rows}).scalars())
+
+
+@contextmanager
+def explained_statements():
+    # Yields {statement: plan} of every statement the app runs on the sync primary engine until the block is left
+    plans = {}
+
+    def explain_statement(conn, cursor, statement, parameters, context, executemany):
+        # Same cursor and transaction, so the plan sees the rows the request wrote before
+        if executemany or not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH")) or statement in plans:
+            return
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+        plans[statement] = cursor.fetchone()[0][0]["Plan"]
+
+    event.listen(engine, "before_cursor_execute", explain_statement)
+    try:
+        yield plans
+    finally:
+        event.remove(engine, "before_cursor_execute", explain_statement)
+
+
+def foreign_key_plans():
+    with SessionLocal() as db:
+        return {f"-- foreign key {name}\n{statement}": db.execute(text(f"EXPLAIN (FORMAT JSON) {statement}"), {"id": uuid.uuid4()}).scalar()[0]["Plan"]
+                for (name, statement) in FOREIGN_KEY_LOOKUPS}
+
+
+def sequential_scans(plan: dict, tables: set):
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in tables:
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from sequential_scans(child, tables)
+
+
+def sign_up(client: TestClient, name: str):
+    response = client.post("/users/", json={"user_name": name, "email": f"{uuid.uuid4().hex}@plans.example", "password": "plans"})
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def run_session(client: TestClient, contributor: TestClient):
+    # One pass over the endpoints that are called while working on a board. Deleting a user is left out,
+    # it only deletes the row and the foreign key lookups below cover what that costs.
+    owner_id = sign_up(client, "Plan Owner")
+    contributor_id = sign_up(contributor, "Plan Contributor")
+
+    board = client.post("/boards/", json={
+        "title": "Plans",
+        "owner_id": owner_id,
+        "stages": [{"title": f"Stage {i}", "index": i, "color": "grey"} for i in range(3)],
+        "contributors": [{"id": contributor_id, "is_new": True, "marked_for_deletion": False}],
+    }).json()
+    (first, second, third) = [stage["id"] for stage in board["stages"]]
+
+    task = client.post("/tasks/", json={"title": "Task", "description": "", "board_id": board["id"], "stage_id": first, "assigned_user_id": None,
+                                        "subtasks": [{"title": f"Subtask {i}", "index": i, "is_completed": False, "is_new": True} for i in range(3)]}).json()
+    other = client.post("/tasks/", json={"title": "Other", "description": "", "board_id": board["id"], "stage_id": first,
+                                         "assigned_user_id": None, "subtasks": []}).json()
+
+    client.get("/boards/")
+    client.get(f"/boards/{board['id']}")
+    contributor.get(f"/boards/{board['id']}")
+    contributor.get(f"/boards/{board['id']}", params={"tasks_per_stage": 1})
+    page = client.get(f"/stages/{first}/tasks", params={"limit": 1})
+    client.get(f"/stages/{first}/tasks", params={"limit": 1, "cursor": page.headers["X-Next-Cursor"]})
+    revision = client.get(f"/boards/{board['id']}/changes", params={"since": 0}).json()["revision"]
+
+    client.put(f"/tasks/{task['id']}", json={"title": "Renamed", "description": "", "board_id": board["id"], "stage_id": first, "assigned_user_id": None,
+                                             "subtasks": [dict(subtask, is_new=False, title="Renamed") for subtask in task["subtasks"]]})
+    client.patch(f"/tasks/{task['id']}/move", json={"stage_id": second})
+    client.patch(f"/tasks/{other['id']}/move", json={"stage_id": second, "before_id": task["id"]})
+    client.patch(f"/tasks/stage/{task['id']}", json={"new_stage_id": third})
+    client.patch(f"/tasks/assignment/{task['id']}", json={"assigned_user_id": contributor_id})
+    client.put(f"/subtasks/{task['subtasks'][0]['id']}")
+    client.patch(f"/stages/{third}/move", json={"after_id": first})
+    client.post(f"/boards/{board['id']}/batch", json={"operations": [
+        {"op": "move_task", "task_id": other["id"], "stage_id": third, "after_id": task["id"]},
+        {"op": "edit_task", "task_id": task["id"], "title": "Batched"},
+        {"op": "toggle_subtask", "subtask_id": task["subtasks"][1]["id"]},
+        {"op": "edit_stage", "stage_id": first, "title": "Batched"},
+    ]})
+    client.get(f"/boards/{board['id']}/changes", params={"since": revision})
+    client.get(f"/boards/{board['id']}/search", params={"q": "renamed subtask"})
+    client.get("/users/", params={"q": "plan", "exclude_board_id": board["id"]})
+    client.get(f"/users/{contributor_id}")
+
+    client.put(f"/boards/{board['id']}", json={
+        "title": "Plans",
+        "owner_id": owner_id,
+        "stages": [{"id": first, "title": "Kept", "index": 0, "color": "grey"},
+                   {"id": second, "title": "Deleted", "index": 1, "color": "grey", "markedForDeletion": True},
+                   {"title": "New", "index": 2, "color": "grey"}],
+        "contributors": [{"id": contributor_id, "is_new": False, "marked_for_deletion": True}],
+    })
+    client.delete(f"/tasks/{other['id']}")
+    client.delete(f"/boards/{board['id']}")
+
+
+def statements_by_board_size(client: TestClient):
+    # Returns {read: [statements at every size in BOARD_SIZES]}
+    owner_id = sign_up(client, "Size Owner")
+    board = client.post("/boards/", json={
+        "title": "Sizes",
+        "owner_id": owner_id,
+        "stages": [{"title": f"Stage {i}", "index": i, "color": "grey"} for i in range(3)],
+        "contributors": [],
+    }).json()
+    stage_ids = [stage["id"] for stage in board["stages"]]
+    reads = {
+        "GET /boards/{id}": (f"/boards/{board['id']}", {}),
+        "GET /boards/{id}?tasks_per_stage": (f"/boards/{board['id']}", {"tasks_per_stage": 5}),
+        "GET /boards/{id}/changes": (f"/boards/{board['id']}/changes", {"since": 0}),
+        "GET /stages/{id}/tasks": (f"/stages/{stage_ids[0]}/tasks", {}),
+    }
+
+    # Warms the permission cache, so every size is read with the same cache state
+    client.get(f"/boards/{board['id']}")
+
+    statements = {read: [] for read in reads}
+    tasks = 0
+    for (size, subtasks) in BOARD_SIZES:
+        for i in range(tasks, size):
+            client.post("/tasks/", json={"title": f"Task {i}", "description": "", "board_id": board["id"], "stage_id": stage_ids[i % len(stage_ids)],
+                                         "assigned_user_id": None if i % 2 else owner_id,
+                                         "subtasks": [{"title": f"Subtask {j}", "index": j, "is_completed": False, "is_new": True} for j in range(subtasks)]})
+        tasks = size
+
+        # Every task written above bumped the revision, the snapshot is built again
+        for (read, (url, params)) in reads.items():
+            statements[read].append(statements_of(client.get(url, params=params)))
+
+    client.delete(f"/boards/{board['id']}")
+    return statements
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boards", type=int, default=SEED_BOARDS, help="Synthetic boards to seed")
+    parser.add_argument("--min-rows", type=int, default=MIN_ROWS, help="Tables with at least this many rows count as large")
+    parser.add_argument("--verbose", action="store_true", help="Print every statement with its plan")
+    args = parser.parse_args()
+
+    seed(args.boards)
+    tables = large_tables(args.min_rows)
+    print(f"Large tables: {', '.join(sorted(tables))}")
+
+    with explained_statements() as plans, TestClient(app, base_url="https://testserver") as client, \
+            TestClient(app, base_url="https://testserver") as contributor:
+        # A failing request would skip the statements after it
+        for c in (client, contributor):
+            c.event_hooks["response"].append(lambda response: response.raise_for_status())
+        with query_budget(client, app, QUERY_BUDGETS), query_budget(contributor, app, QUERY_BUDGETS):
+            run_session(client, contributor)
+            statements_by_size = statements_by_board_size(client)
+    plans.update(foreign_key_plans())
+
+    failures = 0
+    for (statement, plan) in plans.items():
+        scanned = sorted(set(sequential_scans(plan, tables)))
+        if scanned:
+            failures += 1
+            print(f"\nSequential scan on {', '.join(scanned)}:\n{statement}")
+        elif args.verbose:
+            print(f"\n{statement}")
+        if args.verbose:
+            print(json.dumps(plan, indent=2))
+
+    growing = 0
+    for (read, statements) in statements_by_size.items():
+        if len(set(statements)) > 1:
+            growing += 1
+            print(f"\n{read} ran {' / '.join(map(str, statements))} statements at the board sizes {BOARD_SIZES}")
+
+    print(f"\n{len(plans)} statements checked, {failures} with a sequential scan on a large table")
+    print(f"{len(statements_by_size)} board reads checked at {len(BOARD_SIZES)} sizes, {growing} with a growing number of statements")
+    sys.exit(1 if failures or growing else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Latency and statement count of PUT /boards/{id} for growing boards.
+
+Runs the app in-process against the database configured in the environment and leaves its data behind,
+point it at a development database:
+
+    python -m benchmarks.update_board --sizes 10 100 500 --repeat 5
+
+Every round renames all existing stages, adds and deletes a tenth of them and swaps a tenth of the contributors.
+The statement count has to stay the same for every size, the latency only grows with the size of the
+request and the board snapshot in the response.
+"""
+import argparse
+import statistics
+import time
+import uuid
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event, insert
+
+from app.database import SessionLocal, engine
+from app.main import app
+from app.models import User
+
+
+def create_users(count: int):
+    ids = [uuid.uuid4() for _ in range(count)]
+    with SessionLocal() as db:
+        db.execute(insert(User), [{"id": id, "first_name": "Bench", "email": f"{id}@bench.example", "password": "-"} for id in ids])
+        db.commit()
+    return [str(id) for id in ids]
+
+
+def sign_up(client: TestClient):
+    response = client.post("/users/", json={"user_name": "Bench Owner", "email": f"{uuid.uuid4().hex}@bench.example", "password": "bench"})
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def run(client: TestClient, size: int, repeat: int):
+    owner_id = sign_up(client)
+    contributors = create_users(size * 2)
+    change = max(size // 10, 1)
+
+    response = client.post("/boards/", json={
+        "title": f"Bench {size}",
+        "owner_id": owner_id,
+        "stages": [{"title": f"Stage {i}", "index": i, "color": "grey"} for i in range(size)],
+        "contributors": [{"id": id, "is_new": True, "marked_for_deletion": False} for id in contributors[:size]],
+    })
+    response.raise_for_status()
+    board = response.json()
+    stages = board["stages"]
+    current, spare = contributors[:size], contributors[size:]
+
+    statements = []
+
+    def count_statement(*args):
+        statements.append(1)
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+
+    timings = []
+    counts = []
+    for round in range(repeat):
+        kept, deleted = stages[change:], stages[:change]
+        removed, added = current[:change], spare[:change]
+
+        payload = {
+            "title": board["title"],
+            "owner_id": owner_id,
+            "stages": [{"id": stage["id"], "title": f"{stage['title']}'", "index": i, "color": stage["color"]} for i, stage in enumerate(kept)]
+                      + [{"id": stage["id"], "title": stage["title"], "index": 0, "color": stage["color"], "markedForDeletion": True} for stage in deleted]
+                      + [{"title": f"New {round}-{i}", "index": len(kept) + i, "color": "grey"} for i in range(change)],
+            "contributors": [{"id": id, "is_new": False, "marked_for_deletion": True} for id in removed]
+                            + [{"id": id, "is_new": True, "marked_for_deletion": False} for id in added],
+        }
+
+        statements.clear()
+        start = time.perf_counter()
+        response = client.put(f"/boards/{board['id']}", json=payload)
+        timings.append(time.perf_counter() - start)
+        response.raise_for_status()
+        counts.append(len(statements))
+
+        stages = response.json()["stages"]
+        current, spare = current[change:] + added, spare[change:] + removed
+
+    event.remove(engine, "before_cursor_execute", count_statement)
+
+    return statistics.median(timings) * 1000, max(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500], help="Stages and contributors per board")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'median ms':>10} {'statements':>11}")
+    with TestClient(app, base_url="https://testserver") as client:
+        for size in args.sizes:
+            (median, statements) = run(client, size, args.repeat)
+            print(f"{size:>6} {median:>10.1f} {statements:>11}")
+
+
+if __name__ == "__main__":
+    main()
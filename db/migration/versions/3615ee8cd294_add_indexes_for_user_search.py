@@ -0,0 +1,38 @@
+"""Add indexes for user search
+
+Revision ID: 3615ee8cd294
+Revises: 67cd0643428a
+Create Date: 2026-10-18 02:32:51.205398
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3615ee8cd294'
+down_revision: Union[str, None] = '67cd0643428a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Prefix matches of GET /users/ with LIKE 'query%' on the lowered names, exact matches on the lowered email
+    op.create_index('ix_users_lower_first_name', 'users', [sa.text('lower(first_name) text_pattern_ops')], unique=False)
+    op.create_index('ix_users_lower_last_name', 'users', [sa.text('lower(last_name) text_pattern_ops')], unique=False)
+    op.create_index('ix_users_lower_email', 'users', [sa.text('lower(email)')], unique=False)
+
+    # Infix matches on the full name need pg_trgm, which isn't installed on every server.
+    # Without it the search only matches emails and name prefixes, see settings.user_search_infix.
+    if op.get_bind().execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar():
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.execute("CREATE INDEX ix_users_full_name_trgm ON users USING gin ((lower(first_name || ' ' || coalesce(last_name, ''))) gin_trgm_ops)")
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_users_full_name_trgm")
+    op.drop_index('ix_users_lower_email', table_name='users')
+    op.drop_index('ix_users_lower_last_name', table_name='users')
+    op.drop_index('ix_users_lower_first_name', table_name='users')
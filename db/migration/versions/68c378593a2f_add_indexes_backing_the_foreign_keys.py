@@ -0,0 +1,38 @@
+"""Add indexes backing the foreign keys
+
+Revision ID: 68c378593a2f
+Revises: 3615ee8cd294
+Create Date: 2026-10-18 02:35:27.481730
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '68c378593a2f'
+down_revision: Union[str, None] = '3615ee8cd294'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # stages.board_id, tasks.stage_id and tombstones.board_id are already covered by the leading columns of
+    # their (parent, order) indexes. The remaining foreign keys get an index that also serves the order their
+    # children are loaded in, and Postgres uses them for the FK checks of cascaded deletes.
+    # Built concurrently, so existing tables stay writable while the indexes are built.
+    with op.get_context().autocommit_block():
+        op.create_index('ix_boards_owner_id_created_at', 'boards', ['owner_id', 'created_at'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_boards_users_user_id_board_id', 'boards_users', ['user_id', 'board_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_subtasks_task_id_index', 'subtasks', ['task_id', 'index'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_tasks_assigned_user_id', 'tasks', ['assigned_user_id'], unique=False, postgresql_concurrently=True,
+                        postgresql_where=sa.text('assigned_user_id IS NOT NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tasks_assigned_user_id', table_name='tasks')
+    op.drop_index('ix_subtasks_task_id_index', table_name='subtasks')
+    op.drop_index('ix_boards_users_user_id_board_id', table_name='boards_users')
+    op.drop_index('ix_boards_owner_id_created_at', table_name='boards')
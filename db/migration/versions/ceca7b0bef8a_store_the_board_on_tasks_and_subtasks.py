@@ -0,0 +1,105 @@
+"""Store the board on tasks and subtasks
+
+Revision ID: ceca7b0bef8a
+Revises: 6d6204ba685e
+Create Date: 2026-10-18 02:52:56.153151
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'ceca7b0bef8a'
+down_revision: Union[str, None] = '6d6204ba685e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 5000
+
+# Each batch is committed on its own, like that a large table isn't locked for the whole backfill
+BACKFILL = {
+    'tasks': """
+        WITH batch AS (SELECT id FROM tasks WHERE id > :last_id AND board_id IS NULL ORDER BY id LIMIT :batch_size)
+        UPDATE tasks SET board_id = stages.board_id FROM batch, stages
+        WHERE tasks.id = batch.id AND stages.id = tasks.stage_id
+        RETURNING tasks.id
+    """,
+    'subtasks': """
+        WITH batch AS (SELECT id FROM subtasks WHERE id > :last_id AND board_id IS NULL ORDER BY id LIMIT :batch_size)
+        UPDATE subtasks SET board_id = tasks.board_id FROM batch, tasks
+        WHERE subtasks.id = batch.id AND tasks.id = subtasks.task_id
+        RETURNING subtasks.id
+    """,
+}
+
+
+def backfill(table: str):
+    connection = op.get_bind()
+    last_id = '00000000-0000-0000-0000-000000000000'
+    while True:
+        ids = connection.execute(sa.text(BACKFILL[table]), {"last_id": last_id, "batch_size": BATCH_SIZE}).scalars().all()
+        if not ids:
+            return
+        last_id = max(ids)
+
+
+def upgrade() -> None:
+    # board_id is denormalized from the stage of a task. The composite foreign keys keep it in sync and cascade
+    # it if a stage is ever moved to another board. Partitioning tasks and subtasks by hash of board_id later
+    # only takes changing their primary keys to (board_id, id), every key referencing them already contains it.
+    op.add_column('tasks', sa.Column('board_id', sa.UUID(), nullable=True))
+    op.add_column('subtasks', sa.Column('board_id', sa.UUID(), nullable=True))
+
+    # Rows written while the backfill runs don't have a board_id yet, they are caught up below
+    with op.get_context().autocommit_block():
+        backfill('tasks')
+        backfill('subtasks')
+
+        op.create_index('uq_stages_board_id_id', 'stages', ['board_id', 'id'], unique=True, postgresql_concurrently=True)
+        op.create_index('uq_tasks_board_id_id', 'tasks', ['board_id', 'id'], unique=True, postgresql_concurrently=True)
+        op.create_index('ix_tasks_board_id_revision', 'tasks', ['board_id', 'revision'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_subtasks_board_id_revision', 'subtasks', ['board_id', 'revision'], unique=False, postgresql_concurrently=True)
+
+    # Only catalog changes, the locks are held for a moment. NOT VALID constraints apply to new rows right away,
+    # the existing rows are checked below without blocking writes.
+    op.create_check_constraint('ck_tasks_board_id_not_null', 'tasks', 'board_id IS NOT NULL', postgresql_not_valid=True)
+    op.create_check_constraint('ck_subtasks_board_id_not_null', 'subtasks', 'board_id IS NOT NULL', postgresql_not_valid=True)
+
+    op.execute("ALTER TABLE stages ADD CONSTRAINT uq_stages_board_id_id UNIQUE USING INDEX uq_stages_board_id_id")
+    op.execute("ALTER TABLE tasks ADD CONSTRAINT uq_tasks_board_id_id UNIQUE USING INDEX uq_tasks_board_id_id")
+
+    op.drop_constraint('tasks_stage_id_fkey', 'tasks', type_='foreignkey')
+    op.create_foreign_key('fk_tasks_board_id_stage_id', 'tasks', 'stages', ['board_id', 'stage_id'], ['board_id', 'id'],
+                          onupdate='CASCADE', ondelete='CASCADE', postgresql_not_valid=True)
+    op.drop_constraint('subtasks_task_id_fkey', 'subtasks', type_='foreignkey')
+    op.create_foreign_key('fk_subtasks_board_id_task_id', 'subtasks', 'tasks', ['board_id', 'task_id'], ['board_id', 'id'],
+                          onupdate='CASCADE', ondelete='CASCADE', postgresql_not_valid=True)
+
+    # Each statement runs in its own transaction. VALIDATE CONSTRAINT scans the table without blocking writes,
+    # SET NOT NULL then relies on the validated check instead of scanning again.
+    with op.get_context().autocommit_block():
+        backfill('tasks')
+        backfill('subtasks')
+
+        for (table, constraints) in [('tasks', ['ck_tasks_board_id_not_null', 'fk_tasks_board_id_stage_id']),
+                                     ('subtasks', ['ck_subtasks_board_id_not_null', 'fk_subtasks_board_id_task_id'])]:
+            for constraint in constraints:
+                op.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}")
+            op.alter_column(table, 'board_id', nullable=False)
+            op.drop_constraint(constraints[0], table, type_='check')
+
+
+def downgrade() -> None:
+    op.drop_constraint('fk_subtasks_board_id_task_id', 'subtasks', type_='foreignkey')
+    op.create_foreign_key('subtasks_task_id_fkey', 'subtasks', 'tasks', ['task_id'], ['id'], ondelete='CASCADE')
+    op.drop_constraint('fk_tasks_board_id_stage_id', 'tasks', type_='foreignkey')
+    op.create_foreign_key('tasks_stage_id_fkey', 'tasks', 'stages', ['stage_id'], ['id'], ondelete='CASCADE')
+    op.drop_constraint('uq_tasks_board_id_id', 'tasks', type_='unique')
+    op.drop_constraint('uq_stages_board_id_id', 'stages', type_='unique')
+    op.drop_index('ix_subtasks_board_id_revision', table_name='subtasks')
+    op.drop_index('ix_tasks_board_id_revision', table_name='tasks')
+    op.drop_column('subtasks', 'board_id')
+    op.drop_column('tasks', 'board_id')
@@ -0,0 +1,34 @@
+"""Add full-text search vectors to tasks and subtasks
+
+Revision ID: f40f7e3b7928
+Revises: 68c378593a2f
+Create Date: 2026-10-18 02:38:28.245955
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'f40f7e3b7928'
+down_revision: Union[str, None] = '68c378593a2f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Stored generated columns, Postgres keeps them up to date on every write. Adding them rewrites both tables once.
+    # The 'simple' configuration doesn't stem, boards are written in more than one language.
+    op.add_column('tasks', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', description), 'B')", persisted=True), nullable=True))
+    op.add_column('subtasks', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("setweight(to_tsvector('simple', title), 'C')", persisted=True), nullable=True))
+    op.create_index('ix_tasks_search_vector', 'tasks', ['search_vector'], unique=False, postgresql_using='gin')
+    op.create_index('ix_subtasks_search_vector', 'subtasks', ['search_vector'], unique=False, postgresql_using='gin')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_subtasks_search_vector', table_name='subtasks')
+    op.drop_index('ix_tasks_search_vector', table_name='tasks')
+    op.drop_column('subtasks', 'search_vector')
+    op.drop_column('tasks', 'search_vector')
@@ -0,0 +1,31 @@
+"""Page tasks by rank and id
+
+Revision ID: f465468be75a
+Revises: ceca7b0bef8a
+Create Date: 2026-10-18 02:58:30.386627
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f465468be75a'
+down_revision: Union[str, None] = 'ceca7b0bef8a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # id breaks ties between equal ranks, a keyset page over (rank, id) then starts right at its cursor.
+    # The new index serves everything the old one did, it is built before the old one is dropped.
+    with op.get_context().autocommit_block():
+        op.create_index('ix_tasks_stage_id_rank_id', 'tasks', ['stage_id', 'rank', 'id'], unique=False, postgresql_concurrently=True)
+        op.drop_index('ix_tasks_stage_id_rank', table_name='tasks', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_tasks_stage_id_rank', 'tasks', ['stage_id', 'rank'], unique=False, postgresql_concurrently=True)
+        op.drop_index('ix_tasks_stage_id_rank_id', table_name='tasks', postgresql_concurrently=True)
@@ -0,0 +1,10 @@
+import os
+
+from prometheus_client import multiprocess
+
+
+# Removes the gauges of exited workers from GET /metrics, also of workers that were killed
+# and never ran their shutdown handlers, see app/utils/prometheus.py
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.exc import OperationalError
+
+
+# app.config reads its settings when it is imported, the tests don't talk to Postgres or a real SMTP server
+for name, value in {
+    "DATABASE_HOSTNAME": "localhost",
+    "DATABASE_PORT": "5432",
+    "DATABASE_PASSWORD": "test",
+    "DATABASE_NAME": "kanban",
+    "DATABASE_USERNAME": "postgres",
+    "SECRET_KEY": "test",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "AUTH_EMAIL_SERVICE_PASSWORD": "",
+    "AUTH_EMAIL_SERVICE_SENDER_ADDRESS": "kanban@example.com",
+    "AUTH_EMAIL_SERVICE_SMTP_SERVER": "localhost",
+    # bcrypt's lowest cost factor, the tests hash passwords but don't measure them
+    "PASSWORD_BCRYPT_ROUNDS": "4",
+}.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture(scope="session")
+def database():
+    # Tests that need Postgres are skipped without one, it has to be migrated with alembic upgrade head
+    from app.database import engine
+
+    try:
+        with engine.connect() as connection:
+            is_migrated = inspect(connection).has_table("users")
+    except OperationalError:
+        pytest.skip("No database reachable with the DATABASE_* settings")
+
+    if not is_migrated:
+        pytest.skip("The database isn't migrated, run alembic upgrade head")
+
+    return engine
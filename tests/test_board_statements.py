@@ -0,0 +1,15 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.utils.instrumentation import query_budget
+from benchmarks.query_plans import BOARD_SIZES, QUERY_BUDGETS, statements_by_board_size
+
+
+def test_board_reads_run_the_same_statements_at_every_size(database):
+    with TestClient(app, base_url="https://testserver") as client:
+        client.event_hooks["response"].append(lambda response: response.raise_for_status())
+        with query_budget(client, app, QUERY_BUDGETS):
+            statements = statements_by_board_size(client)
+
+    growing = {read: counts for (read, counts) in statements.items() if len(set(counts)) > 1}
+    assert not growing, f"Statements at the board sizes {BOARD_SIZES}: {growing}"
@@ -0,0 +1,157 @@
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from app.email_service import Email_outbox
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    """
+    Just enough SMTP for smtplib without TLS and login. Answers the first `fail_first` messages
+    with a temporary error and keeps the recipients of the others.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fail_first: int = 0):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.fail_first = fail_first
+        self.attempts = 0
+        self.delivered: list[str] = []
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 stub ready")
+        recipients = []
+        for raw in self.rfile:
+            command = raw.decode().strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 stub")
+            elif command.startswith("MAIL FROM"):
+                recipients = []
+                self.reply("250 OK")
+            elif command.startswith("RCPT TO"):
+                recipients.append(raw.decode().strip()[len("RCPT TO:"):].strip("<> "))
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                for line in self.rfile:
+                    if line in (b".\r\n", b".\n"):
+                        break
+                with self.server.lock:
+                    self.server.attempts += 1
+                    failed = self.server.attempts <= self.server.fail_first
+                    if not failed:
+                        self.server.delivered.extend(recipients)
+                self.reply("451 Try again later" if failed else "250 Queued")
+            elif command == "RSET" or command == "NOOP":
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("500 Unknown command")
+
+
+@pytest.fixture
+def smtp_stub(request):
+    server = SMTPStub(**getattr(request, "param", {}))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_outbox(port: int, **overrides):
+    options = dict(sender_address="kanban@example.com", password="", host="127.0.0.1", port=port, use_starttls=False,
+                   maxsize=10, batch_size=5, max_attempts=3, backoff=0.05, idle_timeout=1)
+    options.update(overrides)
+    return Email_outbox(**options)
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_delivers_queued_emails(smtp_stub):
+    outbox = make_outbox(smtp_stub.port)
+
+    for i in range(3):
+        assert outbox.enqueue(f"user{i}@example.com", "Subject", "Message")
+
+    assert wait_for(lambda: outbox.sent == 3)
+    outbox.stop(timeout=5)
+    assert sorted(smtp_stub.delivered) == ["user0@example.com", "user1@example.com", "user2@example.com"]
+    assert outbox.stats()["failed"] == 0
+
+
+@pytest.mark.parametrize("smtp_stub", [{"fail_first": 2}], indirect=True)
+def test_retries_temporary_failures(smtp_stub):
+    outbox = make_outbox(smtp_stub.port)
+
+    assert outbox.enqueue("user@example.com", "Subject", "Message")
+
+    assert wait_for(lambda: outbox.sent == 1)
+    outbox.stop(timeout=5)
+    assert smtp_stub.attempts == 3
+    assert smtp_stub.delivered == ["user@example.com"]
+
+
+@pytest.mark.parametrize("smtp_stub", [{"fail_first": 10}], indirect=True)
+def test_gives_up_after_max_attempts(smtp_stub):
+    outbox = make_outbox(smtp_stub.port)
+
+    assert outbox.enqueue("user@example.com", "Subject", "Message")
+
+    assert wait_for(lambda: outbox.failed == 1)
+    outbox.stop(timeout=5)
+    assert smtp_stub.attempts == 3
+    assert smtp_stub.delivered == []
+
+
+def test_unsendable_address_doesnt_stop_the_worker(smtp_stub):
+    outbox = make_outbox(smtp_stub.port)
+
+    # A valid EmailStr that smtplib can't encode without SMTPUTF8
+    assert outbox.enqueue("jürgen@example.com", "Subject", "Message")
+    assert outbox.enqueue("user@example.com", "Subject", "Message")
+
+    assert wait_for(lambda: outbox.sent == 1 and outbox.failed == 1)
+    assert outbox._worker.is_alive()
+    outbox.stop(timeout=5)
+    assert smtp_stub.delivered == ["user@example.com"]
+
+
+def test_stop_returns_with_a_full_outbox():
+    # Accepts the connection but never greets, the worker hangs in its first send until the SMTP timeout
+    with socket.socket() as silent:
+        silent.bind(("127.0.0.1", 0))
+        silent.listen()
+        outbox = make_outbox(silent.getsockname()[1], maxsize=1)
+
+        assert outbox.enqueue("first@example.com", "Subject", "Message")
+        assert wait_for(lambda: outbox.stats()["queued"] == 0)
+        assert outbox.enqueue("second@example.com", "Subject", "Message")
+        assert not outbox.enqueue("third@example.com", "Subject", "Message")
+
+        started = time.monotonic()
+        outbox.stop(timeout=0.5)
+        assert time.monotonic() - started < 2
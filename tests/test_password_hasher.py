@@ -0,0 +1,41 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from app.utils.passwords import PasswordHasher
+
+
+def test_saturated_hasher_answers_503_with_retry_after():
+    hasher = PasswordHasher(workers=1, queue_size=1, retry_after=7)
+    release = threading.Event()
+
+    async def saturate():
+        # One job on the worker and one in the queue fill the hasher
+        blocked = [asyncio.create_task(hasher.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert hasher.stats()["pending"] == 2
+
+        with pytest.raises(HTTPException) as rejected:
+            await hasher.run(release.wait)
+
+        release.set()
+        await asyncio.gather(*blocked)
+        return rejected.value
+
+    error = asyncio.run(saturate())
+
+    assert error.status_code == 503
+    assert error.headers == {"Retry-After": "7"}
+    assert hasher.stats() == {"pending": 0, "limit": 2, "rejected": 1}
+
+
+def test_hasher_accepts_jobs_again_once_one_finished():
+    hasher = PasswordHasher(workers=1, queue_size=0, retry_after=1)
+
+    async def run_twice():
+        return [await hasher.run(lambda: "first"), await hasher.run(lambda: "second")]
+
+    assert asyncio.run(run_twice()) == ["first", "second"]
+    assert hasher.stats()["rejected"] == 0
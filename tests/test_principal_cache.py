@@ -0,0 +1,90 @@
+import asyncio
+import uuid
+from http.cookies import SimpleCookie
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException, Response
+
+from app.oauth2 import create_access_token, get_current_principal, remember_tokens_valid_after, revocation_cache
+from app.router import auth, users
+from app.schemas import NewUserPassword
+
+
+@pytest.fixture
+def signed_in_user():
+    # As after a login, the user's revocation state is cached and no request has to read it from the database
+    user_id = str(uuid.uuid4())
+    remember_tokens_valid_after(SimpleNamespace(id=user_id, deleted_at=None, tokens_valid_after=None))
+    token = create_access_token({"user_id": user_id})
+
+    assert principal_id(token) == user_id
+    yield (user_id, token)
+
+    revocation_cache.pop(user_id)
+
+
+def principal_id(token: str):
+    return str(asyncio.run(get_current_principal(token)).id)
+
+
+def fake_run_db(results: dict):
+    # Stands in for the database, answers each sync function with a fixed result
+    async def run_db(db, fn, *args):
+        return results.get(fn.__name__)
+
+    return run_db
+
+
+def assert_revoked(token: str):
+    with pytest.raises(HTTPException) as rejected:
+        principal_id(token)
+
+    assert rejected.value.status_code == 401
+
+
+def test_password_change_revokes_earlier_tokens(signed_in_user, monkeypatch):
+    (user_id, token) = signed_in_user
+    monkeypatch.setattr(auth, "run_db", fake_run_db({"get_user_by_id": SimpleNamespace(id=user_id)}))
+    response = Response()
+
+    asyncio.run(auth.update_password(NewUserPassword(access_token=token, token_type="bearer", password="new password"), response, db=None))
+
+    assert_revoked(token)
+    new_token = SimpleCookie(response.headers["set-cookie"])["access_token"].value.removeprefix("Bearer ")
+    assert principal_id(new_token) == user_id
+
+
+def test_reset_token_only_works_once(signed_in_user, monkeypatch):
+    (user_id, token) = signed_in_user
+    monkeypatch.setattr(auth, "run_db", fake_run_db({"get_user_by_id": SimpleNamespace(id=user_id)}))
+    reset = NewUserPassword(access_token=token, token_type="bearer", password="new password")
+
+    asyncio.run(auth.update_password(reset, Response(), db=None))
+
+    with pytest.raises(HTTPException) as rejected:
+        asyncio.run(auth.update_password(reset, Response(), db=None))
+    assert rejected.value.status_code == 401
+
+
+def test_account_deletion_revokes_tokens(signed_in_user, monkeypatch):
+    (user_id, token) = signed_in_user
+    monkeypatch.setattr(users, "run_db", fake_run_db({"delete_user_sync": SimpleNamespace(id=uuid.uuid4())}))
+
+    asyncio.run(users.delete_user(Response(), db=None, current_user=SimpleNamespace(id=user_id)))
+
+    assert_revoked(token)
+    assert_revoked(create_access_token({"user_id": user_id}))
+
+
+def test_other_users_stay_signed_in(signed_in_user, monkeypatch):
+    (user_id, token) = signed_in_user
+    other_id = str(uuid.uuid4())
+    remember_tokens_valid_after(SimpleNamespace(id=other_id, deleted_at=None, tokens_valid_after=None))
+    other_token = create_access_token({"user_id": other_id})
+    monkeypatch.setattr(users, "run_db", fake_run_db({"delete_user_sync": SimpleNamespace(id=uuid.uuid4())}))
+
+    asyncio.run(users.delete_user(Response(), db=None, current_user=SimpleNamespace(id=user_id)))
+
+    assert principal_id(other_token) == other_id
+    revocation_cache.pop(other_id)
@@ -0,0 +1,27 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.config import settings
+from app.main import app
+from app.utils.instrumentation import query_budget
+from benchmarks.query_plans import (MIN_ROWS, QUERY_BUDGETS, SEED_BOARDS, explained_statements, foreign_key_plans, large_tables, run_session,
+                                    seed, sequential_scans)
+
+
+@pytest.mark.skipif(settings.database_async, reason="The statements are only EXPLAINed on the sync engine")
+def test_statements_dont_scan_large_tables_sequentially(database):
+    # Seeding the synthetic boards takes a while on the first run, later runs reuse them
+    seed(SEED_BOARDS)
+    tables = large_tables(MIN_ROWS)
+
+    with explained_statements() as plans, TestClient(app, base_url="https://testserver") as client, \
+            TestClient(app, base_url="https://testserver") as contributor:
+        for c in (client, contributor):
+            c.event_hooks["response"].append(lambda response: response.raise_for_status())
+        with query_budget(client, app, QUERY_BUDGETS), query_budget(contributor, app, QUERY_BUDGETS):
+            run_session(client, contributor)
+    plans.update(foreign_key_plans())
+
+    scans = {statement: sorted(set(sequential_scans(plan, tables))) for (statement, plan) in plans.items()}
+    assert tables, f"No table has {MIN_ROWS} rows after seeding"
+    assert not {statement: scanned for (statement, scanned) in scans.items() if scanned}